@@ -0,0 +1,104 @@
+import argparse
+import time
+import timeit
+
+from src.internal.cluster import Cluster, Job, JobNode, Pod
+from src.internal.type import JobStatus
+
+"""
+Micro-benchmark of the Cluster lookups the routers do on every request.
+
+It fills clusters of growing size and times each lookup, the cost per call
+should stay flat as the cluster grows. Run it from the repository root:
+
+    python -m benchmarks.cluster_index [--nodes 10000] [--jobs 1000000]
+"""
+
+PODS = 100
+
+
+def build(nodes: int, jobs: int) -> tuple[Cluster, list[JobNode]]:
+    cluster = Cluster()
+    cluster.initialize("light", cpu_limit=0.3, mem_limit=100, job_slots=4)
+    pods = []
+    for i in range(PODS):
+        pod = Pod(f"pod{i}")
+        cluster.add_pod(pod)
+        pods.append(pod)
+    job_nodes = []
+    for i in range(nodes):
+        pod = pods[i % PODS]
+        node = JobNode(f"node{i}", f"n{i}", pod.get_pod_id(), slots=4)
+        pod.add_node(node)
+        cluster.add_node(node)
+        cluster.add_available_job_node(node)
+        job_nodes.append(node)
+    for i in range(jobs):
+        node = job_nodes[i % nodes]
+        job = Job(f"j{i}", f"job{i}", None, JobStatus.REGISTERED)
+        job.set_running(node.get_node_id())
+        node.add_job(job)
+        node.finish_job(job.get_job_id())
+        job.set_completed()
+    return cluster, job_nodes
+
+
+def measure(fn, number: int) -> float:
+    """Returns the best time per call out of a few runs, in microseconds"""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def run(nodes: int, jobs: int) -> dict[str, float]:
+    cluster, job_nodes = build(nodes, jobs)
+    pod = cluster.get_pods()[-1]
+    node = job_nodes[-1]
+
+    def slot_round_trip():
+        taken = cluster.pop_available_job_node()
+        cluster.release_job_slot(taken)
+
+    def remove_and_add():
+        cluster.remove_available_job_node(node)
+        cluster.add_available_job_node(node)
+
+    return {
+        "get_pod_by_name": measure(
+            lambda: cluster.get_pod_by_name(pod.get_pod_name()), 10000
+        ),
+        "has_dup_pod_name": measure(lambda: cluster.has_dup_pod_name("nope"), 10000),
+        "has_dup_node_name": measure(
+            lambda: cluster.has_dup_node_name("nope", pod.get_pod_id()), 10000
+        ),
+        "get_jobs_under_node_id": measure(
+            lambda: cluster.get_jobs_under_node_id(node.get_node_id()), 1000
+        ),
+        "pop+release slot": measure(slot_round_trip, 10000),
+        "remove+add available": measure(remove_and_add, 10000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster lookup micro-benchmark")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--jobs", type=int, default=1000000)
+    args = parser.parse_args()
+
+    sizes = [(args.nodes // 100, args.jobs // 100), (args.nodes, args.jobs)]
+    results = []
+    for nodes, jobs in sizes:
+        start = time.perf_counter()
+        results.append(run(nodes, jobs))
+        print(
+            f"built and measured {nodes} nodes / {jobs} jobs in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+
+    header = "".join(f"{f'{n} nodes':>16}" for n, _ in sizes)
+    print(f"{'us per call':<24}{header}")
+    for name in results[0]:
+        row = "".join(f"{r[name]:>16.3f}" for r in results)
+        print(f"{name:<24}{row}")
+
+
+if __name__ == "__main__":
+    main()
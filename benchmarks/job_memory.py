@@ -0,0 +1,152 @@
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from src.internal.cluster import Job, JobNode, Pod
+from src.internal.type import JobStatus
+
+"""
+Memory benchmark of the objects the cluster keeps per job.
+
+It creates jobs spread over a few job nodes the way the routers do, and
+reports the bytes they use per 100k jobs, then how much memory listing them
+all (toJSON) leaves behind and how long a listing takes. Every figure is
+measured for the slotted Job with its toJSON cache and for DictJob, the same
+fields in a __dict__ and an uncached toJSON, as jobs were before. The cache
+trades memory for listing time, only the jobs job_ls and the queue list pay
+for it. Run it from the repository root:
+
+    python -m benchmarks.job_memory [--jobs 100000]
+"""
+
+NODES = 100
+
+
+class DictJob(object):
+    """The baseline: the fields of Job in a __dict__, toJSON built every time"""
+
+    def __init__(
+        self,
+        job_id: str,
+        job_name: str,
+        node_id: str | None,
+        job_status: JobStatus = JobStatus.RUNNING,
+        priority: int = 0,
+        timeout: float | None = None,
+        deadline: float | None = None,
+    ):
+        self.__job_id = job_id
+        self.__job_name = sys.intern(job_name)
+        self.__node_id = node_id
+        self.__job_status = job_status
+        self.__priority = priority
+        self.__exec_id = None
+        self.__timeout = timeout
+        self.__deadline = deadline
+        self.__created_at = time.time()
+        self.__started_at = None
+        self.__finished_at = None
+        self.__exit_code = None
+
+    def get_job_id(self) -> str:
+        return self.__job_id
+
+    def set_running(self, node_id: str):
+        self.__node_id = node_id
+        self.__job_status = JobStatus.RUNNING
+        self.__started_at = time.time()
+
+    def set_completed(self):
+        self.__job_status = JobStatus.COMPLETED
+        self.__finished_at = time.time()
+
+    def toJSON(self) -> dict:
+        return {
+            "job_id": self.__job_id,
+            "job_name": self.__job_name,
+            "node_id": self.__node_id,
+            "job_status": self.__job_status,
+            "priority": self.__priority,
+            "timeout": self.__timeout,
+            "deadline": self.__deadline,
+            "created_at": self.__created_at,
+            "started_at": self.__started_at,
+            "finished_at": self.__finished_at,
+            "exit_code": self.__exit_code,
+        }
+
+
+def build(jobs: int, cls: type = Job) -> list[Job]:
+    pod = Pod("pod")
+    nodes = []
+    for i in range(NODES):
+        node = JobNode(f"n{i}", f"node{i:08d}", pod.get_pod_id(), slots=jobs)
+        pod.add_node(node)
+        nodes.append(node)
+    rtn = []
+    for i in range(jobs):
+        node = nodes[i % NODES]
+        job = cls(f"job{i:08d}", "benchmark", None, JobStatus.REGISTERED)
+        job.set_running(node.get_node_id())
+        node.add_job(job)
+        node.finish_job(job.get_job_id())
+        job.set_completed()
+        rtn.append(job)
+    return rtn
+
+
+def list_jobs(jobs: list[Job]) -> float:
+    """Returns how long listing the jobs takes, in seconds"""
+    start = time.perf_counter()
+    [j.toJSON() for j in jobs]
+    return time.perf_counter() - start
+
+
+def measure(jobs: int, cls: type) -> dict[str, float]:
+    """The memory in bytes and listing times in seconds, per 100k jobs"""
+    scale = 100000 / jobs
+    rtn = dict()
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    built_jobs = build(jobs, cls)
+    gc.collect()
+    built = tracemalloc.get_traced_memory()[0]
+    list_jobs(built_jobs)
+    gc.collect()
+    listed = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rtn["jobs and nodes"] = (built - start) * scale
+    rtn["kept after a listing"] = (listed - built) * scale
+
+    del built_jobs
+    built_jobs = build(jobs, cls)  # again, timed without tracemalloc in the way
+    rtn["first listing"] = list_jobs(built_jobs) * scale
+    rtn["next listing"] = list_jobs(built_jobs) * scale
+    return rtn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Job memory benchmark")
+    parser.add_argument("--jobs", type=int, default=100000)
+    args = parser.parse_args()
+
+    before = measure(args.jobs, DictJob)
+    after = measure(args.jobs, Job)
+    print(f"{'per 100k jobs':<24}{'__dict__':>12}{'slotted':>12}")
+    for name in ["jobs and nodes", "kept after a listing"]:
+        print(f"{name:<24}{before[name] / 1e6:>9.1f} MB{after[name] / 1e6:>9.1f} MB")
+    for name in ["first listing", "next listing"]:
+        print(f"{name:<24}{before[name] * 1e3:>9.1f} ms{after[name] * 1e3:>9.1f} ms")
+    print(
+        f"the toJSON cache adds "
+        f"{after['kept after a listing'] / after['jobs and nodes']:.0%} to the "
+        f"memory of the listed jobs and makes listing them again "
+        f"{after['first listing'] / after['next listing']:.0f}x faster"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from src.internal.cluster import Job
+from src.internal.type import JobStatus
+from src.utils.config import cluster, history as history_config
+
+"""
+Finished jobs are moved out of memory into an SQLite archive.
+
+The cluster hands over every job that is over (completed, aborted or failed),
+sync() writes them to the archive and only keeps the most recent ones on their
+nodes, so memory stays flat no matter how many jobs the cluster has run. The
+archive is queried by node, status and submission time, a page at a time.
+
+SQLite calls block, so the routes and the background sync make them on the
+archive thread through run(), the event loop never waits on the disk.
+"""
+
+COLUMNS = (
+    "job_id",
+    "job_name",
+    "node_id",
+    "job_status",
+    "priority",
+    "timeout",
+    "deadline",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "exit_code",
+)
+
+
+class JobArchive(object):
+    def __init__(self, path: str):
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()  # the connection is shared by threads
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                job_name TEXT NOT NULL,
+                node_id TEXT,
+                job_status TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                timeout REAL,
+                deadline REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                exit_code INTEGER
+            )
+            """
+        )
+        columns = [row[1] for row in self.__db.execute("PRAGMA table_info(jobs)")]
+        if "exit_code" not in columns:  # an archive from before exit codes
+            self.__db.execute("ALTER TABLE jobs ADD COLUMN exit_code INTEGER")
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at)"
+        )
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_node ON jobs (node_id, created_at)"
+        )
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (job_status, created_at)"
+        )
+        self.__db.commit()
+
+    def add(self, jobs: list[Job]):
+        rows = []
+        for job in jobs:
+            # not toJSON(), that would keep a cached dict on every archived job
+            data = job.toState()
+            rows.append(tuple(data[column] for column in COLUMNS))
+        with self.__lock:
+            self.__db.executemany(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in COLUMNS)})",
+                rows,
+            )
+            self.__db.commit()
+
+    def query(
+        self,
+        node_id: str | None = None,
+        status: JobStatus | None = None,
+        start: float | None = None,
+        end: float | None = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> tuple[int, list[dict]]:
+        """Returns how many jobs match and a page of them, newest first"""
+        clauses = []
+        params = []
+        if node_id != None:
+            clauses.append("node_id = ?")
+            params.append(node_id)
+        if status != None:
+            clauses.append("job_status = ?")
+            params.append(status.value)
+        if start != None:
+            clauses.append("created_at >= ?")
+            params.append(start)
+        if end != None:
+            clauses.append("created_at < ?")
+            params.append(end)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        with self.__lock:
+            total = self.__db.execute(
+                f"SELECT COUNT(*) FROM jobs {where}", params
+            ).fetchone()[0]
+            rows = self.__db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs {where} "
+                "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return total, [dict(zip(COLUMNS, row)) for row in rows]
+
+    def clear(self):
+        with self.__lock:
+            self.__db.execute("DELETE FROM jobs")
+            self.__db.commit()
+
+
+archive = JobArchive(history_config["path"])
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-archive")
+
+
+async def run(fn: Callable, *args) -> Any:
+    """Calls fn on the archive thread, in the order the calls were made"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+async def sync():
+    """Archives the jobs that are over and prunes the old ones from memory"""
+    jobs = cluster.pop_unarchived_jobs()
+    if len(jobs) > 0:
+        await run(archive.add, jobs)
+    cluster.prune_finished_jobs(history_config["memory_jobs"])
+
+
+async def load_history():
+    while True:
+        await asyncio.sleep(history_config["sync_interval"])
+        await sync()
@@ -1,10 +1,19 @@
 from __future__ import annotations
-from typing import Literal
+from typing import Callable, Literal
 from collections import deque
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
 import secrets
 import string
+import sys
+import time
 
+from src.internal.history import MetricsHistory
 from src.internal.type import JobStatus, JobNodeStatus, ServerNodeStatus
+from src.utils.calculate import calculate_rate
 
 alphabet = string.ascii_letters.lower() + string.digits
 
@@ -12,60 +21,261 @@ alphabet = string.ascii_letters.lower() + string.digits
 A couple notes on the cluster structure, especially the state:
 There are 4 classes: Cluster, Pod, Node and Job.
 
+Objects are slotted to keep the per job memory small (the cluster holds one
+per job). Jobs and pods cache their toJSON() until they change, job_ls and the
+queue list the same jobs over and over.
+
+Every change that has to survive a restart is reported to the journal with the
+new toState() of the object (None once it is removed), src/internal/state.py
+writes them to the state log and rebuilds the cluster from it on startup.
+
 Job
 - a status state
 
 Node
 - a status state
 - a list of jobs
+- for job nodes, a number of slots and the jobs running in them
 
 Pod 
 - a list of nodes
 
 Cluster
 - initialization status
-- a map of pods indexed by pod_id for easy lookup
-- a map of nodes indexed by node_id for easy lookup
+- a map of pods indexed by pod_id, and one by pod name
+- a map of nodes indexed by node_id, and one by (pod_id, node name)
+- the (pod_id, node name) of the nodes being registered
 - a list of currently running jobs
-- a list of available nodes
+- the jobs that are over, until they are archived and pruned from memory
+- the free job slots of every job node, for bin packing
+- a queue of pending jobs waiting for a node, earliest deadline first, then
+  by priority then FIFO, and their scripts by content hash
+- a heap of the running jobs that have a timeout or a deadline
 """
 
 
+class Journal(object):
+    """Where the changes to the cluster state go, nowhere until a sink is set"""
+
+    def __init__(self):
+        self.__sink: Callable[[str, str, dict | None], None] | None = None
+
+    def set_sink(self, sink: Callable[[str, str, dict | None], None] | None):
+        self.__sink = sink
+
+    def record(self, kind: str, key: str, obj: object | None, **extra):
+        """Reports the new state of obj, or that it was removed if obj is None"""
+        if self.__sink == None:
+            return
+        self.__sink(kind, key, None if obj == None else {**obj.toState(), **extra})
+
+    def record_state(self, kind: str, key: str, state: dict | None):
+        """Reports a state that is not the one of an object"""
+        if self.__sink != None:
+            self.__sink(kind, key, state)
+
+
+journal = Journal()
+
+
 class Job(object):
+    __slots__ = (
+        "__job_id",
+        "__job_name",
+        "__node_id",
+        "__job_status",
+        "__priority",
+        "__exec_id",
+        "__timeout",
+        "__deadline",
+        "__created_at",
+        "__started_at",
+        "__finished_at",
+        "__exit_code",
+        "__json",
+    )
+
     def __init__(
         self,
         job_id: str,
         job_name: str,
-        node_id: str,
+        node_id: str | None,
         job_status: JobStatus = JobStatus.RUNNING,
+        priority: int = 0,
+        timeout: float | None = None,
+        deadline: float | None = None,
     ):
         self.__job_id: str = job_id
-        self.__job_name: str = job_name
-        self.__node_id: str = node_id
+        self.__job_name: str = sys.intern(job_name)  # often shared by many jobs
+        self.__node_id: str | None = node_id  # None while the job is queued
         self.__job_status: JobStatus = job_status
+        self.__priority: int = priority
+        self.__exec_id: str | None = None  # the exec running the job's launcher
+        self.__timeout: float | None = timeout  # seconds the job may run for
+        self.__deadline: float | None = deadline  # unix time it must be done by
+        self.__created_at: float = time.time()
+        self.__started_at: float | None = None
+        self.__finished_at: float | None = None
+        self.__exit_code: int | None = None  # of its script, once it exited
+        self.__json: dict | None = None
 
     def get_job_id(self) -> str:
         return self.__job_id
 
+    def get_job_name(self) -> str:
+        return self.__job_name
+
     def get_node_id(self) -> str:
+        if self.__node_id is None:
+            raise Exception(f"job {self.__job_id} is not placed on a node")
         return self.__node_id
 
+    def get_job_status(self) -> JobStatus:
+        return self.__job_status
+
+    def get_priority(self) -> int:
+        return self.__priority
+
+    def get_exec_id(self) -> str | None:
+        return self.__exec_id
+
+    def set_exec_id(self, exec_id: str):
+        self.__exec_id = exec_id
+        journal.record("job", self.__job_id, self)
+
+    def get_timeout(self) -> float | None:
+        return self.__timeout
+
+    def get_deadline(self) -> float | None:
+        return self.__deadline
+
+    def get_created_at(self) -> float:
+        return self.__created_at
+
+    def get_started_at(self) -> float | None:
+        return self.__started_at
+
+    def get_finished_at(self) -> float | None:
+        return self.__finished_at
+
+    def get_exit_code(self) -> int | None:
+        return self.__exit_code
+
+    def is_finished(self) -> bool:
+        return self.__job_status in (
+            JobStatus.COMPLETED,
+            JobStatus.ABORTED,
+            JobStatus.FAILED,
+        )
+
+    def get_expires_at(self) -> float | None:
+        """When the job is out of time, the earliest of its timeout and deadline"""
+        limits = []
+        if self.__timeout != None and self.__started_at != None:
+            limits.append(self.__started_at + self.__timeout)
+        if self.__deadline != None:
+            limits.append(self.__deadline)
+        return min(limits) if limits else None
+
+    def set_running(self, node_id: str):
+        self.__node_id = node_id
+        self.__job_status = JobStatus.RUNNING
+        self.__started_at = time.time()
+        self.__json = None
+        journal.record("job", self.__job_id, self)
+
     def set_completed(self):
         self.__job_status = JobStatus.COMPLETED
+        self.__finished_at = time.time()
+        self.__json = None
+        journal.record("job", self.__job_id, self)
+
+    def set_exited(self, exit_code: int):
+        """The script of the job exited, it failed unless the exit code is 0"""
+        self.__exit_code = exit_code
+        if exit_code == 0:
+            self.__job_status = JobStatus.COMPLETED
+        else:
+            self.__job_status = JobStatus.FAILED
+        self.__finished_at = time.time()
+        self.__json = None
+        journal.record("job", self.__job_id, self)
 
     def set_aborted(self):
         self.__job_status = JobStatus.ABORTED
+        self.__finished_at = time.time()
+        self.__json = None
+        journal.record("job", self.__job_id, self)
+
+    def set_failed(self):
+        self.__job_status = JobStatus.FAILED
+        self.__finished_at = time.time()
+        self.__json = None
+        journal.record("job", self.__job_id, self)
 
     def toJSON(self) -> dict:
-        return {
+        """Cached until the job changes, so it must not be modified"""
+        if self.__json != None:
+            return self.__json
+        self.__json = {
             "job_id": self.__job_id,
             "job_name": self.__job_name,
             "node_id": self.__node_id,
             "job_status": self.__job_status,
+            "priority": self.__priority,
+            "timeout": self.__timeout,
+            "deadline": self.__deadline,
+            "created_at": self.__created_at,
+            "started_at": self.__started_at,
+            "finished_at": self.__finished_at,
+            "exit_code": self.__exit_code,
+        }
+        return self.__json
+
+    def toState(self) -> dict:
+        return {
+            "job_id": self.__job_id,
+            "job_name": self.__job_name,
+            "node_id": self.__node_id,
+            "job_status": self.__job_status.value,
+            "priority": self.__priority,
+            "exec_id": self.__exec_id,
+            "timeout": self.__timeout,
+            "deadline": self.__deadline,
+            "created_at": self.__created_at,
+            "started_at": self.__started_at,
+            "finished_at": self.__finished_at,
+            "exit_code": self.__exit_code,
         }
 
+    @classmethod
+    def fromState(cls, state: dict) -> Job:
+        job = cls(
+            state["job_id"],
+            state["job_name"],
+            state["node_id"],
+            JobStatus(state["job_status"]),
+            state["priority"],
+            state["timeout"],
+            state["deadline"],
+        )
+        job.__exec_id = state["exec_id"]
+        job.__created_at = state["created_at"]
+        job.__started_at = state["started_at"]
+        job.__finished_at = state["finished_at"]
+        job.__exit_code = state.get("exit_code")  # not in older states
+        return job
+
 
 class Node(object):
+    __slots__ = (
+        "__node_id",
+        "__node_name",
+        "__pod_id",
+        "__node_type",
+        "__container_id",
+    )
+
     def __init__(
         self,
         node_name: str,
@@ -77,10 +287,19 @@ class Node(object):
         self.__node_name: str = node_name
         self.__pod_id: str = pod_id
         self.__node_type: Literal["job", "server"] = node_type
+        # a job node can be moved to a fresh container, so this may change
+        self.__container_id: str = node_id
 
     def get_node_id(self) -> str:
         return self.__node_id
 
+    def get_container_id(self) -> str:
+        return self.__container_id
+
+    def set_container_id(self, container_id: str):
+        self.__container_id = container_id
+        journal.record("node", self.__node_id, self)
+
     def get_node_name(self) -> str:
         return self.__node_name
 
@@ -90,39 +309,111 @@ class Node(object):
     def get_node_type(self) -> Literal["job", "server"]:
         return self.__node_type
 
+    def toState(self) -> dict:
+        return {
+            "node_name": self.__node_name,
+            "node_id": self.__node_id,
+            "pod_id": self.__pod_id,
+            "node_type": self.__node_type,
+            "container_id": self.__container_id,
+        }
+
 
 class JobNode(Node):
-    def __init__(self, node_name: str, node_id: str, pod_id: str):
+    __slots__ = ("__slots", "__jobs", "__running", "__uploaded", "__upload_lock")
+
+    def __init__(self, node_name: str, node_id: str, pod_id: str, slots: int = 1):
         super().__init__(node_name, node_id, pod_id, "job")
-        self.__node_status: JobNodeStatus = JobNodeStatus.IDLE
+        self.__slots: int = slots  # how many jobs it runs at the same time
         self.__jobs: dict[str, Job] = dict()  # key is the job id
+        self.__running: dict[str, Job] = dict()  # key is the job id
+        # files already put in the container, so they are only uploaded once
+        self.__uploaded: set[str] = set()
+        # held while files are put in the container, so that the jobs launched
+        # side by side on the node wait for one upload instead of each doing it
+        self.__upload_lock: asyncio.Lock = asyncio.Lock()
 
-    def get_node_status(self) -> JobNodeStatus:
-        return self.__node_status
+    def set_container_id(self, container_id: str):
+        super().set_container_id(container_id)
+        self.__uploaded.clear()  # a fresh container has none of them
+
+    def has_uploaded(self, path: str) -> bool:
+        return path in self.__uploaded
 
-    def set_running(self):
-        self.__node_status = JobNodeStatus.RUNNING
+    def add_uploaded(self, path: str):
+        self.__uploaded.add(path)
 
-    def set_idle(self):
-        self.__node_status = JobNodeStatus.IDLE
+    def get_upload_lock(self) -> asyncio.Lock:
+        return self.__upload_lock
+
+    def get_node_status(self) -> JobNodeStatus:
+        if len(self.__running) > 0:
+            return JobNodeStatus.RUNNING
+        return JobNodeStatus.IDLE
+
+    def get_slots(self) -> int:
+        return self.__slots
 
     def get_jobs(self) -> list[Job]:
         return list(self.__jobs.values())
 
+    def get_running_jobs(self) -> list[Job]:
+        return list(self.__running.values())
+
     def add_job(self, job: Job):
+        """Starts running the job on the node, in one of its slots"""
         if job.get_job_id() in self.__jobs:
             raise Exception("job already exists")
+        if len(self.__running) >= self.__slots:
+            raise Exception(f"node {self.get_node_id()} has no free slot")
         self.__jobs[job.get_job_id()] = job
+        self.__running[job.get_job_id()] = job
+
+    def finish_job(self, job_id: str):
+        """Frees the slot of the job, which stays in the job list"""
+        self.__running.pop(job_id, None)
+
+    def remove_job(self, job_id: str):
+        """Forgets a job that never got to run"""
+        self.__jobs.pop(job_id, None)
+        self.__running.pop(job_id, None)
 
     def toJSON(self) -> dict:
         return {
             "node_name": self.get_node_name(),
             "node_id": self.get_node_id(),
             "node_status": self.get_node_status(),
+            "slots": self.__slots,
+            "running_jobs": len(self.__running),
         }
 
+    def toState(self) -> dict:
+        """Its jobs are stored on their own"""
+        return {**super().toState(), "slots": self.__slots}
+
+    @classmethod
+    def fromState(cls, state: dict) -> JobNode:
+        node = cls(
+            state["node_name"], state["node_id"], state["pod_id"], state["slots"]
+        )
+        node.set_container_id(state["container_id"])
+        return node
+
 
 class ServerNode(Node):
+    __slots__ = (
+        "__node_status",
+        "__port",
+        "__cpu_usage",
+        "__mem_usage",
+        "__network_in",
+        "__network_out",
+        "__network_in_rate",
+        "__network_out_rate",
+        "__network_sampled_at",
+        "__history",
+    )
+
     def __init__(self, node_name: str, node_id: str, pod_id: str, port: int):
         super().__init__(node_name, node_id, pod_id, "server")
         self.__node_status: ServerNodeStatus = ServerNodeStatus.NEW
@@ -131,6 +422,10 @@ class ServerNode(Node):
         self.__mem_usage: int = 0
         self.__network_in: int = 0
         self.__network_out: int = 0
+        self.__network_in_rate: float = 0.0  # bytes per second
+        self.__network_out_rate: float = 0.0  # bytes per second
+        self.__network_sampled_at: float = 0.0
+        self.__history: MetricsHistory = MetricsHistory()
 
     def get_cpu_usage(self) -> float:
         return self.__cpu_usage
@@ -156,14 +451,41 @@ class ServerNode(Node):
     def set_network_out(self, network_out: int):
         self.__network_out = network_out
 
+    def get_network_in_rate(self) -> float:
+        return self.__network_in_rate
+
+    def get_network_out_rate(self) -> float:
+        return self.__network_out_rate
+
+    def update_network(self, network_in: int, network_out: int, sampled_at: float):
+        """Stores the cumulative byte counters and the rates since the last sample"""
+        elapsed = sampled_at - self.__network_sampled_at
+        if elapsed <= 0:
+            return  # the same sample was already counted
+        if self.__network_sampled_at > 0:
+            self.__network_in_rate = calculate_rate(
+                self.__network_in, network_in, elapsed
+            )
+            self.__network_out_rate = calculate_rate(
+                self.__network_out, network_out, elapsed
+            )
+        self.__network_in = network_in
+        self.__network_out = network_out
+        self.__network_sampled_at = sampled_at
+
+    def get_history(self) -> MetricsHistory:
+        return self.__history
+
     def get_node_status(self) -> ServerNodeStatus:
         return self.__node_status
 
     def set_online(self):
         self.__node_status = ServerNodeStatus.ONLINE
+        journal.record("node", self.get_node_id(), self)
 
     def set_paused(self):
         self.__node_status = ServerNodeStatus.PAUSED
+        journal.record("node", self.get_node_id(), self)
 
     def get_port(self) -> int:
         if self.__port is None:
@@ -178,19 +500,61 @@ class ServerNode(Node):
             "port": self.get_port(),
         }
 
+    def toState(self) -> dict:
+        """The usage and its history are not kept, the monitor samples them again"""
+        return {
+            **super().toState(),
+            "node_status": self.__node_status.value,
+            "port": self.__port,
+        }
+
+    @classmethod
+    def fromState(cls, state: dict) -> ServerNode:
+        node = cls(state["node_name"], state["node_id"], state["pod_id"], state["port"])
+        node.set_container_id(state["container_id"])
+        node.__node_status = ServerNodeStatus(state["node_status"])
+        return node
+
 
 class Pod(object):
-    def __init__(self, pod_name: str):
+    __slots__ = (
+        "__pod_name",
+        "__pod_id",
+        "__nodes",
+        "__cpu_percent_cap",
+        "__is_elastic",
+        "__usage",
+        "__network_in_rate",
+        "__network_out_rate",
+        "__lower_threshold",
+        "__upper_threshold",
+        "__network_lower_threshold",
+        "__network_upper_threshold",
+        "__min_nodes",
+        "__max_nodes",
+        "__json",
+    )
+
+    def __init__(self, pod_name: str, pod_id: str | None = None):
         self.__pod_name: str = pod_name
-        self.__pod_id: str = "".join(secrets.choice(alphabet) for _ in range(12))
+        if pod_id == None:
+            pod_id = "".join(secrets.choice(alphabet) for _ in range(12))
+        self.__pod_id: str = pod_id
         self.__nodes: dict[str, ServerNode | JobNode] = dict()  # key is the node id
-        self.__cpu_percent_cap: float
+        self.__cpu_percent_cap: float | None = None  # set when servers launch
         self.__is_elastic: bool = False
         self.__usage: float = 0.0
+        self.__network_in_rate: float = 0.0  # bytes per second, all servers
+        self.__network_out_rate: float = 0.0  # bytes per second, all servers
         self.__lower_threshold: int = 20
         self.__upper_threshold: int = 80
+        # bytes per second per server, the network signal is off while upper is 0
+        self.__network_lower_threshold: int = 0
+        self.__network_upper_threshold: int = 0
         self.__min_nodes: int = 0
         self.__max_nodes: int = 0
+        # the name and id never change
+        self.__json: dict = {"pod_name": self.__pod_name, "pod_id": self.__pod_id}
 
     def get_pod_name(self) -> str:
         return self.__pod_name
@@ -228,24 +592,28 @@ class Pod(object):
 
     def set_cpu_percent_cap(self, cpu_percent_cap: float):
         self.__cpu_percent_cap = cpu_percent_cap
+        journal.record("pod", self.__pod_id, self)
 
-    def get_cpu_percent_cap(self) -> float:
+    def get_cpu_percent_cap(self) -> float | None:
         return self.__cpu_percent_cap
 
     def set_is_elastic(self, is_elastic: bool):
         self.__is_elastic = is_elastic
+        journal.record("pod", self.__pod_id, self)
 
     def get_is_elastic(self) -> bool:
         return self.__is_elastic
 
     def set_min_nodes(self, min_nodes: int):
         self.__min_nodes = min_nodes
+        journal.record("pod", self.__pod_id, self)
 
     def get_min_nodes(self) -> int:
         return self.__min_nodes
 
     def set_max_nodes(self, max_nodes: int):
         self.__max_nodes = max_nodes
+        journal.record("pod", self.__pod_id, self)
 
     def get_max_nodes(self) -> int:
         return self.__max_nodes
@@ -258,9 +626,25 @@ class Pod(object):
 
     def set_lower_threshold(self, lower_threshold: int):
         self.__lower_threshold = lower_threshold
+        journal.record("pod", self.__pod_id, self)
 
     def set_upper_threshold(self, upper_threshold: int):
         self.__upper_threshold = upper_threshold
+        journal.record("pod", self.__pod_id, self)
+
+    def get_network_lower_threshold(self) -> int:
+        return self.__network_lower_threshold
+
+    def get_network_upper_threshold(self) -> int:
+        return self.__network_upper_threshold
+
+    def set_network_lower_threshold(self, network_lower_threshold: int):
+        self.__network_lower_threshold = network_lower_threshold
+        journal.record("pod", self.__pod_id, self)
+
+    def set_network_upper_threshold(self, network_upper_threshold: int):
+        self.__network_upper_threshold = network_upper_threshold
+        journal.record("pod", self.__pod_id, self)
 
     def get_usage(self) -> float:
         return self.__usage
@@ -268,8 +652,49 @@ class Pod(object):
     def set_usage(self, usage: float):
         self.__usage = usage
 
+    def get_network_in_rate(self) -> float:
+        return self.__network_in_rate
+
+    def set_network_in_rate(self, network_in_rate: float):
+        self.__network_in_rate = network_in_rate
+
+    def get_network_out_rate(self) -> float:
+        return self.__network_out_rate
+
+    def set_network_out_rate(self, network_out_rate: float):
+        self.__network_out_rate = network_out_rate
+
     def toJSON(self) -> dict:
-        return {"pod_name": self.__pod_name, "pod_id": self.__pod_id}
+        """Cached, so it must not be modified"""
+        return self.__json
+
+    def toState(self) -> dict:
+        """Its nodes are stored on their own, the usage is sampled again"""
+        return {
+            "pod_name": self.__pod_name,
+            "pod_id": self.__pod_id,
+            "cpu_percent_cap": self.__cpu_percent_cap,
+            "is_elastic": self.__is_elastic,
+            "lower_threshold": self.__lower_threshold,
+            "upper_threshold": self.__upper_threshold,
+            "network_lower_threshold": self.__network_lower_threshold,
+            "network_upper_threshold": self.__network_upper_threshold,
+            "min_nodes": self.__min_nodes,
+            "max_nodes": self.__max_nodes,
+        }
+
+    @classmethod
+    def fromState(cls, state: dict) -> Pod:
+        pod = cls(state["pod_name"], state["pod_id"])
+        pod.__cpu_percent_cap = state["cpu_percent_cap"]
+        pod.__is_elastic = state["is_elastic"]
+        pod.__lower_threshold = state["lower_threshold"]
+        pod.__upper_threshold = state["upper_threshold"]
+        pod.__network_lower_threshold = state["network_lower_threshold"]
+        pod.__network_upper_threshold = state["network_upper_threshold"]
+        pod.__min_nodes = state["min_nodes"]
+        pod.__max_nodes = state["max_nodes"]
+        return pod
 
 
 class Cluster(object):
@@ -277,9 +702,37 @@ class Cluster(object):
         self.__initialized: bool = False
         self.__type: str
         self.__pods: dict[str, Pod] = dict()  # key is the pod id
+        self.__pods_by_name: dict[str, Pod] = dict()  # key is the pod name
         self.__nodes: dict[str, JobNode | ServerNode] = dict()  # key is the node id
-        self.__available_job_nodes: deque[JobNode] = deque()
+        # key is (pod id, node name), node names are only unique within a pod
+        self.__nodes_by_name: dict[tuple[str, str], JobNode | ServerNode] = dict()
+        # (pod id, node name) of the nodes whose container is being created,
+        # they hold their name and count towards the node limit until added
+        self.__registering: set[tuple[str, str]] = set()
+        # Job nodes with a free slot, bucketed by how many they have free. The
+        # node with the fewest free slots is filled first so jobs pack onto as
+        # few nodes as possible and the others stay entirely free
+        self.__free_slots: dict[str, int] = dict()  # key is the node id
+        self.__slot_buckets: dict[int, dict[str, JobNode]] = dict()
+        self.__job_slots: int = 1
         self.__running_job: dict[str, Job] = dict()  # key is the job id
+        # Jobs that left the running list or the queue. The unarchived ones are
+        # written to the job archive once they are over, the finished ones are
+        # the jobs still kept on their node, oldest first
+        self.__unarchived: list[Job] = []
+        self.__finished: deque[Job] = deque()
+        # (expires at, seq, job) of running jobs, finished ones are skipped
+        self.__expiring: list[tuple[float, int, Job]] = []
+        # (job, script, hash of the script) by job id, the heap only orders
+        # them. Cancelled jobs are left in the heap and skipped when they come out
+        self.__pending_jobs: dict[str, tuple[Job, bytes, str]] = dict()
+        # The scripts of the pending jobs by hash, with how many jobs use them,
+        # so a script shared by a batch is journaled once. The jobs of a batch
+        # share the same bytes, which are only hashed once (key is their id)
+        self.__scripts: dict[str, list] = dict()  # [script, jobs using it]
+        self.__script_hashes: dict[int, str] = dict()
+        self.__pending_queue: list[tuple[float, int, int, Job]] = []
+        self.__pending_seq = itertools.count()
         self.__available_port: int = 9999
         self.__cpu_limit: float
         self.__mem_limit: int
@@ -288,10 +741,40 @@ class Cluster(object):
     def is_initialized(self) -> bool:
         return self.__initialized
 
-    def initialize(self, type: str, cpu_limit: float, mem_limit: int):
+    def reset(self):
+        """Forgets the pods, nodes and jobs, the cluster has to be initialized again"""
+        self.__init__()
+
+    def initialize(
+        self, type: str, cpu_limit: float, mem_limit: int, job_slots: int = 1
+    ):
         self.__type = type
         self.__cpu_limit = cpu_limit
         self.__mem_limit = mem_limit
+        self.__job_slots = job_slots
+        self.__initialized = True
+        journal.record("cluster", "cluster", self)
+
+    def toState(self) -> dict:
+        """Its pods, nodes and jobs are stored on their own"""
+        return {
+            "type": self.__type,
+            "cpu_limit": self.__cpu_limit,
+            "mem_limit": self.__mem_limit,
+            "job_slots": self.__job_slots,
+            "cpu_available": getattr(self, "_Cluster__cpu_available", None),
+            "available_port": self.__available_port,
+        }
+
+    def loadState(self, state: dict):
+        """Initializes the cluster as it was, without recording it"""
+        self.__type = state["type"]
+        self.__cpu_limit = state["cpu_limit"]
+        self.__mem_limit = state["mem_limit"]
+        self.__job_slots = state["job_slots"]
+        if state["cpu_available"] != None:
+            self.__cpu_available = state["cpu_available"]
+        self.__available_port = state["available_port"]
         self.__initialized = True
 
     def get_type(self) -> str:
@@ -303,22 +786,26 @@ class Cluster(object):
     def get_mem_limit(self) -> int:
         return self.__mem_limit
 
+    def get_job_slots(self) -> int:
+        return self.__job_slots
+
     def has_dup_pod_name(self, pod_name: str) -> bool:
-        for pod in self.get_pods():
-            if pod.get_pod_name() == pod_name:
-                return True
-        return False
+        return pod_name in self.__pods_by_name
 
     def add_pod(self, pod: Pod):
-        if pod.get_pod_id in self.__pods:
+        if pod.get_pod_id() in self.__pods:
             raise Exception("pod id already exists")
+        if pod.get_pod_name() in self.__pods_by_name:
+            raise Exception("pod name already exists")
         self.__pods[pod.get_pod_id()] = pod
+        self.__pods_by_name[pod.get_pod_name()] = pod
+        journal.record("pod", pod.get_pod_id(), pod)
 
     def get_pod_by_name(self, pod_name: str) -> Pod:
-        for pod in self.get_pods():
-            if pod.get_pod_name() == pod_name:
-                return pod
-        raise Exception(f"pod with name {pod_name} does not exist")
+        try:
+            return self.__pods_by_name[pod_name]
+        except KeyError:
+            raise Exception(f"pod with name {pod_name} does not exist")
 
     def get_pod_by_id(self, pod_id: str) -> Pod:
         try:
@@ -331,21 +818,40 @@ class Cluster(object):
 
     def remove_pod_by_id(self, pod_id: str) -> Pod:
         try:
-            return self.__pods.pop(pod_id)
+            pod = self.__pods.pop(pod_id)
         except KeyError:
             raise Exception(f"pod with id {pod_id} does not exist")
+        del self.__pods_by_name[pod.get_pod_name()]
+        journal.record("pod", pod_id, None)
+        return pod
 
     def has_dup_node_name(self, node_name: str, pod_id: str) -> bool:
-        pod = self.get_pod_by_id(pod_id)
-        for node in pod.get_nodes():
-            if node.get_node_name() == node_name:
-                return True
-        return False
+        self.get_pod_by_id(pod_id)  # raises if the pod does not exist
+        key = (pod_id, node_name)
+        return key in self.__nodes_by_name or key in self.__registering
+
+    def reserve_node(self, node_name: str, pod_id: str):
+        """Holds the name of a node being registered, until release_node"""
+        if self.has_dup_node_name(node_name, pod_id):
+            raise Exception("node name already exists in the pod")
+        self.__registering.add((pod_id, node_name))
+
+    def release_node(self, node_name: str, pod_id: str):
+        self.__registering.discard((pod_id, node_name))
+
+    def get_registering(self, pod_id: str) -> int:
+        """How many nodes of the pod are being registered"""
+        return sum(1 for key in self.__registering if key[0] == pod_id)
 
     def add_node(self, node: JobNode | ServerNode):
         if node.get_node_id() in self.__nodes:
             raise Exception("node id already exists")
+        key = (node.get_pod_id(), node.get_node_name())
+        if key in self.__nodes_by_name:
+            raise Exception("node name already exists in the pod")
         self.__nodes[node.get_node_id()] = node
+        self.__nodes_by_name[key] = node
+        journal.record("node", node.get_node_id(), node)
 
     def get_node_by_id(self, node_id: str) -> JobNode | ServerNode:
         try:
@@ -360,57 +866,265 @@ class Cluster(object):
         if isinstance(node, JobNode) and node.get_node_status() != JobNodeStatus.IDLE:
             raise Exception("job node is not idle")
         try:
-            return self.__nodes.pop(node_id)
+            node = self.__nodes.pop(node_id)
         except KeyError:
             raise Exception("node does not exist")
+        del self.__nodes_by_name[(node.get_pod_id(), node.get_node_name())]
+        journal.record("node", node_id, None)
+        return node
+
+    def __set_free_slots(self, node: JobNode, free: int):
+        node_id = node.get_node_id()
+        previous = self.__free_slots.get(node_id, 0)
+        if previous > 0:
+            bucket = self.__slot_buckets[previous]
+            del bucket[node_id]
+            if len(bucket) == 0:
+                del self.__slot_buckets[previous]
+        self.__free_slots[node_id] = free
+        if free > 0:
+            self.__slot_buckets.setdefault(free, dict())[node_id] = node
 
     def add_available_job_node(self, node: JobNode):
-        self.__available_job_nodes.append(node)
+        """Makes the slots of a job node available, all of them for a new node"""
+        if node.get_node_id() in self.__free_slots:
+            raise Exception("job node is already available")
+        self.__set_free_slots(node, node.get_slots() - len(node.get_running_jobs()))
 
     def has_available_job_nodes(self) -> bool:
-        return (
-            len(self.__available_job_nodes) > 0
-            # the below should never be false, but just in case
-            and self.__available_job_nodes[0].get_node_status() == JobNodeStatus.IDLE
-        )
+        return len(self.__slot_buckets) > 0
 
     def pop_available_job_node(self) -> JobNode:
+        """Takes a slot on the fullest job node that still has one"""
         if not self.has_available_job_nodes():
             raise Exception("no available nodes")
-        return self.__available_job_nodes.popleft()
+        free = min(self.__slot_buckets)
+        bucket = self.__slot_buckets[free]
+        # the most recently filled node, popitem is O(1) where taking the
+        # first one has to skip the deleted entries at the front of the dict
+        _, node = bucket.popitem()
+        if len(bucket) == 0:
+            del self.__slot_buckets[free]
+        self.__free_slots[node.get_node_id()] = 0
+        self.__set_free_slots(node, free - 1)
+        return node
+
+    def release_job_slot(self, node: JobNode):
+        """Gives back a slot taken with pop_available_job_node"""
+        free = self.__free_slots.get(node.get_node_id())
+        if free == None:
+            return  # the node was removed in the meantime
+        if free >= node.get_slots():
+            raise Exception(f"node {node.get_node_id()} has no slot taken")
+        self.__set_free_slots(node, free + 1)
 
     def remove_available_job_node(self, node: JobNode):
-        self.__available_job_nodes.remove(node)
+        if node.get_node_id() in self.__free_slots:
+            self.__set_free_slots(node, 0)
+            del self.__free_slots[node.get_node_id()]
 
     def add_running_job(self, job: Job):
         if job.get_job_id() in self.__running_job:
             raise Exception("job id already exists")
         self.__running_job[job.get_job_id()] = job
-
-    def remove_running_job(self, job_id: str) -> Job:
+        journal.record("job", job.get_job_id(), job)
+        if job.get_expires_at() != None:
+            heapq.heappush(
+                self.__expiring,
+                (job.get_expires_at(), next(self.__pending_seq), job),
+            )
+
+    def remove_running_job(self, job_id: str, finished: bool = True) -> Job:
+        """Takes the job out of the running list, finished=False if it never ran"""
         try:
-            return self.__running_job.pop(job_id)
+            job = self.__running_job.pop(job_id)
         except KeyError:
             raise Exception(f"job with id {job_id} does not exist in the running list")
+        if finished:
+            self.add_finished_job(job)
+        else:
+            journal.record("job", job_id, None)
+        return job
+
+    def add_finished_job(self, job: Job):
+        """Keeps a job that is over (or being stopped) until it is archived"""
+        self.__unarchived.append(job)
+        self.__finished.append(job)
+
+    def get_running_jobs(self, node_id: str | None = None) -> list[Job]:
+        if node_id:
+            node = self.__nodes.get(node_id)
+            return node.get_running_jobs() if isinstance(node, JobNode) else []
+        return list(self.__running_job.values())
+
+    def get_stopping_jobs(self, node_id: str | None = None) -> list[Job]:
+        """The jobs out of the running list whose final status is not set yet"""
+        return [
+            job
+            for job in self.__unarchived
+            if not job.is_finished() and (not node_id or job.get_node_id() == node_id)
+        ]
+
+    def pop_unarchived_jobs(self) -> list[Job]:
+        """Returns the jobs that are over since the last call"""
+        rtn = [job for job in self.__unarchived if job.is_finished()]
+        # the others are still being stopped, their status is not final yet
+        self.__unarchived = [job for job in self.__unarchived if not job.is_finished()]
+        return rtn
+
+    def prune_finished_jobs(self, keep: int):
+        """Forgets all but the keep most recently finished jobs of the nodes"""
+        while len(self.__finished) > keep:
+            job = self.__finished.popleft()
+            node = self.__nodes.get(job.get_node_id())
+            if isinstance(node, JobNode):
+                node.remove_job(job.get_job_id())
+            journal.record("job", job.get_job_id(), None)
+
+    def pop_expired_jobs(self, now: float) -> list[Job]:
+        """Returns the running jobs that are out of time, they stay in the running list"""
+        rtn = []
+        while self.__expiring and self.__expiring[0][0] <= now:
+            _, _, job = heapq.heappop(self.__expiring)
+            if self.__running_job.get(job.get_job_id()) is job:
+                rtn.append(job)
+        return rtn
+
+    def has_running_job(self, job_id: str) -> bool:
+        return job_id in self.__running_job
+
+    def has_job(self, job_id: str) -> bool:
+        return job_id in self.__running_job or job_id in self.__pending_jobs
+
+    def add_pending_job(self, job: Job, script: bytes):
+        if job.get_job_id() in self.__pending_jobs:
+            raise Exception("job id already exists")
+        # the script is only needed while the job waits for a node
+        script_hash = self.__hold_script(script)
+        self.__pending_jobs[job.get_job_id()] = (job, script, script_hash)
+        journal.record("job", job.get_job_id(), job, script_hash=script_hash)
+        deadline = job.get_deadline()
+        heapq.heappush(
+            self.__pending_queue,
+            (
+                deadline if deadline != None else math.inf,
+                -job.get_priority(),
+                next(self.__pending_seq),
+                job,
+            ),
+        )
+
+    def has_pending_jobs(self) -> bool:
+        return len(self.__pending_jobs) > 0
+
+    def pop_pending_job(self) -> tuple[Job, bytes]:
+        """
+        Returns the job with the earliest deadline, or without deadlines the
+        highest priority job that has been waiting the longest
+        """
+        while self.__pending_queue:
+            job = heapq.heappop(self.__pending_queue)[-1]
+            if self.__is_pending(job):
+                _, script, script_hash = self.__pending_jobs.pop(job.get_job_id())
+                self.__drop_script(script_hash)
+                return job, script
+        raise Exception("no pending jobs")
+
+    def pop_expired_pending_jobs(self, now: float) -> list[Job]:
+        """Takes the pending jobs whose deadline passed out of the queue"""
+        rtn = []
+        while self.__pending_queue and self.__pending_queue[0][0] <= now:
+            job = heapq.heappop(self.__pending_queue)[-1]
+            if self.__is_pending(job):
+                _, _, script_hash = self.__pending_jobs.pop(job.get_job_id())
+                self.__drop_script(script_hash)
+                rtn.append(job)
+        self.__unarchived.extend(rtn)
+        return rtn
+
+    def remove_pending_job(self, job_id: str) -> Job:
+        try:
+            job, _, script_hash = self.__pending_jobs.pop(job_id)
+        except KeyError:
+            raise Exception(f"job with id {job_id} does not exist in the pending queue")
+        self.__drop_script(script_hash)
+        self.__unarchived.append(job)
+        if len(self.__pending_queue) > 2 * len(self.__pending_jobs) + 16:
+            # drop the cancelled entries once they make up most of the heap
+            self.__pending_queue = [
+                entry for entry in self.__pending_queue if self.__is_pending(entry[-1])
+            ]
+            heapq.heapify(self.__pending_queue)
+        return job
+
+    def get_pending_entries(self) -> list[tuple[Job, str]]:
+        """Returns the pending jobs with the hash of their script, in no particular order"""
+        return [
+            (job, script_hash) for job, _, script_hash in self.__pending_jobs.values()
+        ]
+
+    def get_pending_scripts(self) -> dict[str, bytes]:
+        """Returns the scripts of the pending jobs, key is their hash"""
+        return {script_hash: entry[0] for script_hash, entry in self.__scripts.items()}
+
+    def __hold_script(self, script: bytes) -> str:
+        """Counts one more pending job using the script, returns its hash"""
+        script_hash = self.__script_hashes.get(id(script))
+        if script_hash == None:
+            script_hash = hashlib.sha256(script).hexdigest()
+        entry = self.__scripts.get(script_hash)
+        if entry == None:
+            # it holds the bytes, so their id is not reused while it is a key
+            entry = self.__scripts[script_hash] = [script, 0]
+            self.__script_hashes[id(script)] = script_hash
+            journal.record_state("script", script_hash, {"script": script.hex()})
+        entry[1] += 1
+        return script_hash
+
+    def __drop_script(self, script_hash: str):
+        entry = self.__scripts[script_hash]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.__scripts[script_hash]
+            del self.__script_hashes[id(entry[0])]
+            journal.record_state("script", script_hash, None)
+
+    def get_pending_jobs(self) -> list[Job]:
+        """Returns the pending jobs in the order they will be dispatched"""
+        return [
+            entry[-1]
+            for entry in sorted(self.__pending_queue)
+            if self.__is_pending(entry[-1])
+        ]
+
+    def __is_pending(self, job: Job) -> bool:
+        entry = self.__pending_jobs.get(job.get_job_id())
+        return entry != None and entry[0] is job
 
     def get_jobs_under_node_id(self, node_id: str | None = None) -> list[Job]:
+        if node_id:
+            node = self.__nodes.get(node_id)
+            return node.get_jobs() if isinstance(node, JobNode) else []
         rtn = []
-        for pod in self.get_pods():
-            for node in pod.get_nodes():
-                if isinstance(node, JobNode):
-                    if node_id:
-                        if node.get_node_id() == node_id:
-                            rtn.extend(node.get_jobs())
-                    else:
-                        rtn.extend(node.get_jobs())
+        for node in self.__nodes.values():
+            if isinstance(node, JobNode):
+                rtn.extend(node.get_jobs())
         return rtn
 
     def get_available_port(self) -> int:
         self.__available_port += 1
+        journal.record("cluster", "cluster", self)
         return self.__available_port
 
+    def reserve_port(self, port: int):
+        """Makes sure a port that is already taken is never handed out"""
+        if port > self.__available_port:
+            self.__available_port = port
+            journal.record("cluster", "cluster", self)
+
     def set_cpu_available(self, cpu_available: int):
         self.__cpu_available = cpu_available
+        journal.record("cluster", "cluster", self)
 
     def get_cpu_available(self) -> int:
         return self.__cpu_available
@@ -0,0 +1,109 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+"""
+Fixed memory metrics history for a server node.
+
+Every tier is a ring buffer made of one compact array per column, so a server
+always costs the same amount of memory no matter how long the cluster runs:
+- raw: every sample the load monitor takes (a few minutes worth)
+- 10s: the raw samples averaged over 10 second buckets (an hour worth)
+- 1m: the raw samples averaged over 1 minute buckets (a day worth)
+
+The timestamps in a ring are sorted, so a range query is two binary searches
+followed by array slices.
+"""
+
+COLUMNS = ("timestamp", "cpu", "mem", "rx", "tx")
+TIERS = {
+    # name: (bucket size in seconds, capacity)
+    "raw": (0, 512),
+    "10s": (10, 360),
+    "1m": (60, 1440),
+}
+
+
+class RingBuffer(object):
+    def __init__(self, capacity: int):
+        self.__capacity: int = capacity
+        self.__columns: list[array] = [array("d", bytes(8 * capacity)) for _ in COLUMNS]
+        self.__start: int = 0  # position of the oldest row
+        self.__size: int = 0
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __getitem__(self, i: int) -> float:
+        # only used by bisect, returns the timestamp of the i-th oldest row
+        return self.__columns[0][(self.__start + i) % self.__capacity]
+
+    def append(self, row: tuple[float, ...]):
+        end = (self.__start + self.__size) % self.__capacity
+        for column, value in zip(self.__columns, row):
+            column[end] = value
+        if self.__size < self.__capacity:
+            self.__size += 1
+        else:
+            self.__start = (self.__start + 1) % self.__capacity
+
+    def query(self, start: float, end: float) -> dict[str, list[float]]:
+        """Returns the rows with start <= timestamp <= end, column by column"""
+        lo = bisect_left(self, start)
+        hi = bisect_right(self, end)
+        a = (self.__start + lo) % self.__capacity
+        b = (self.__start + hi) % self.__capacity
+        rtn = {}
+        for name, column in zip(COLUMNS, self.__columns):
+            if hi <= lo:
+                rtn[name] = []
+            elif a < b:
+                rtn[name] = column[a:b].tolist()
+            else:  # the range wraps around the end of the ring
+                rtn[name] = column[a:].tolist() + column[:b].tolist()
+        return rtn
+
+
+class MetricsHistory(object):
+    def __init__(self):
+        self.__rings: dict[str, RingBuffer] = {
+            tier: RingBuffer(capacity) for tier, (_, capacity) in TIERS.items()
+        }
+        # running sums of the bucket currently being filled, per rolled up tier
+        self.__buckets: dict[str, float] = {
+            tier: -1.0 for tier, (size, _) in TIERS.items() if size > 0
+        }
+        self.__sums: dict[str, list[float]] = {
+            tier: [0.0] * len(COLUMNS) for tier in self.__buckets
+        }
+        self.__counts: dict[str, int] = {tier: 0 for tier in self.__buckets}
+
+    def record(self, timestamp: float, cpu: float, mem: int, rx: int, tx: int):
+        row = (timestamp, float(cpu), float(mem), float(rx), float(tx))
+        self.__rings["raw"].append(row)
+        for tier in self.__buckets:
+            size = TIERS[tier][0]
+            bucket = timestamp - timestamp % size
+            if bucket != self.__buckets[tier]:
+                self.__flush(tier)
+                self.__buckets[tier] = bucket
+            sums = self.__sums[tier]
+            for i in range(1, len(COLUMNS)):
+                sums[i] += row[i]
+            self.__counts[tier] += 1
+
+    def __flush(self, tier: str):
+        count = self.__counts[tier]
+        if count == 0:
+            return
+        sums = self.__sums[tier]
+        row = (self.__buckets[tier],) + tuple(s / count for s in sums[1:])
+        self.__rings[tier].append(row)
+        self.__sums[tier] = [0.0] * len(COLUMNS)
+        self.__counts[tier] = 0
+
+    def query(
+        self, tier: str = "raw", start: float = 0.0, end: float = float("inf")
+    ) -> dict[str, list[float]]:
+        if tier not in self.__rings:
+            raise Exception(f"unknown history resolution {tier}")
+        return self.__rings[tier].query(start, end)
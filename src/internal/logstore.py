@@ -0,0 +1,378 @@
+import asyncio
+import gzip
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Iterator
+
+from src.utils.config import cluster, log as log_config
+
+try:
+    import zstandard
+except ImportError:  # only needed when the logs are stored as zstd
+    zstandard = None
+
+"""
+Job logs live in tmp/<node_id>/<job_id>.log[.gz|.zst]. The store keeps an index
+of them so that finding the log of a job or listing the logs of a node does not
+walk the whole tmp directory. The index is updated on every write and rebuilt
+from disk when the cluster starts.
+
+Running jobs stream their output in chunks, so a log grows while the job runs
+and can be read (or followed) by range. Every chunk is compressed on its own
+and appended to the file: gzip members and zstd frames can be concatenated,
+and reading the file back decompresses them as one stream.
+
+Storage is bounded in three ways:
+- job_cap: a log stops growing (and is marked truncated) at that many bytes
+- node_cap: the oldest logs of a node are dropped once it holds more than that
+- max_age / max_total: a background task drops logs older than max_age seconds
+  and then the oldest ones until all the logs fit in max_total bytes
+
+Compressing and writing block, so the routes make every change to the logs on
+the log thread through run(), one at a time and in order. The event loop only
+looks entries up, reading a log happens in the threads of StreamingResponse.
+"""
+
+CHUNK_SIZE = 64 * 1024
+SUFFIXES = {"none": ".log", "gzip": ".log.gz", "zstd": ".log.zst"}
+
+
+class LogEntry(object):
+    def __init__(
+        self,
+        job_id: str,
+        node_id: str,
+        path: str,
+        size: int,
+        length: int | None,
+        offset: int | None,
+    ):
+        self.__job_id: str = job_id
+        self.__node_id: str = node_id
+        self.__path: str = path
+        self.__size: int = size  # bytes on disk
+        # bytes of output stored, unknown for compressed logs found on disk
+        self.__length: int | None = length
+        # bytes of job output received so far, more than stored once truncated
+        self.__offset: int | None = offset
+        self.__truncated: bool = False
+        self.__updated_at: float = time.time()
+
+    def get_job_id(self) -> str:
+        return self.__job_id
+
+    def get_node_id(self) -> str:
+        return self.__node_id
+
+    def get_path(self) -> str:
+        return self.__path
+
+    def get_size(self) -> int:
+        return self.__size
+
+    def set_size(self, size: int):
+        self.__size = size
+
+    def get_length(self) -> int | None:
+        return self.__length
+
+    def set_length(self, length: int):
+        self.__length = length
+
+    def get_offset(self) -> int | None:
+        return self.__offset
+
+    def set_offset(self, offset: int):
+        self.__offset = offset
+
+    def is_truncated(self) -> bool:
+        return self.__truncated
+
+    def set_truncated(self):
+        self.__truncated = True
+
+    def get_updated_at(self) -> float:
+        return self.__updated_at
+
+    def set_updated_at(self, updated_at: float):
+        self.__updated_at = updated_at
+
+
+class LogStore(object):
+    def __init__(
+        self,
+        root: str,
+        compression: str,
+        level: int,
+        job_cap: int,
+        node_cap: int,
+    ):
+        if compression not in SUFFIXES:
+            raise Exception(f"unknown log compression {compression}")
+        if compression == "zstd" and zstandard == None:
+            raise Exception("zstd log compression needs the zstandard package")
+        self.__root: str = root
+        self.__compression: str = compression
+        self.__level: int = level
+        self.__job_cap: int = job_cap  # 0 means no cap
+        self.__node_cap: int = node_cap  # 0 means no cap
+        # key is the job id, in the order the logs were created (oldest first)
+        self.__entries: dict[str, LogEntry] = dict()
+        # job ids of every node in the order their logs were created
+        self.__nodes: dict[str, dict[str, None]] = dict()  # key is the node id
+        self.__node_sizes: dict[str, int] = dict()  # bytes on disk per node
+        self.__total_size: int = 0
+
+    def __add(self, entry: LogEntry):
+        node_id = entry.get_node_id()
+        self.__entries[entry.get_job_id()] = entry
+        self.__nodes.setdefault(node_id, dict())[entry.get_job_id()] = None
+        self.__node_sizes[node_id] = self.__node_sizes.get(node_id, 0)
+        self.__grow(entry, entry.get_size())
+
+    def __grow(self, entry: LogEntry, size: int):
+        """Adds bytes written to the log to the node and total sizes"""
+        self.__node_sizes[entry.get_node_id()] += size
+        self.__total_size += size
+
+    def __remove(self, entry: LogEntry):
+        job_id, node_id = entry.get_job_id(), entry.get_node_id()
+        self.__entries.pop(job_id)
+        del self.__nodes[node_id][job_id]
+        self.__node_sizes[node_id] -= entry.get_size()
+        self.__total_size -= entry.get_size()
+        if len(self.__nodes[node_id]) == 0:
+            del self.__nodes[node_id]
+            del self.__node_sizes[node_id]
+        try:
+            os.remove(entry.get_path())
+        except FileNotFoundError:
+            pass
+
+    def __compress(self, data: bytes) -> bytes:
+        if self.__compression == "gzip":
+            return gzip.compress(data, compresslevel=self.__level)
+        if self.__compression == "zstd":
+            return zstandard.ZstdCompressor(level=self.__level).compress(data)
+        return data
+
+    def __open(self, entry: LogEntry) -> BinaryIO:
+        """Opens the log for reading, decompressing it on the fly"""
+        path = entry.get_path()
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        if path.endswith(".zst"):
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), read_across_frames=True, closefd=True
+            )
+        return open(path, "rb")
+
+    def __measure(self, entry: LogEntry):
+        """Finds out how much output a log found on disk holds"""
+        length = 0
+        with self.__open(entry) as f:
+            while data := f.read(CHUNK_SIZE):
+                length += len(data)
+        entry.set_length(length)
+        entry.set_offset(length)
+
+    def __create(self, node_id: str, job_id: str) -> LogEntry:
+        os.makedirs(os.path.join(self.__root, node_id), exist_ok=True)
+        path = os.path.join(self.__root, node_id, job_id + SUFFIXES[self.__compression])
+        open(path, "wb").close()
+        entry = LogEntry(job_id, node_id, path, 0, 0, 0)
+        self.__add(entry)
+        return entry
+
+    def __store(self, entry: LogEntry, data: bytes):
+        """Appends output to the log, up to the job cap"""
+        if entry.is_truncated():
+            return
+        if self.__job_cap > 0 and entry.get_length() + len(data) > self.__job_cap:
+            data = data[: self.__job_cap - entry.get_length()]
+            data += f"\n[log truncated at {self.__job_cap} bytes]\n".encode()
+            entry.set_truncated()
+        compressed = self.__compress(data)
+        with open(entry.get_path(), "ab") as f:
+            f.write(compressed)
+        entry.set_length(entry.get_length() + len(data))
+        entry.set_updated_at(time.time())
+        entry.set_size(entry.get_size() + len(compressed))
+        self.__grow(entry, len(compressed))
+        self.__enforce_node_cap(entry)
+
+    def __enforce_node_cap(self, entry: LogEntry):
+        """Drops the oldest logs of the node, but never the one being written"""
+        node_id = entry.get_node_id()
+        if self.__node_cap <= 0:
+            return
+        for job_id in list(self.__nodes[node_id]):
+            if self.__node_sizes[node_id] <= self.__node_cap:
+                return
+            if job_id != entry.get_job_id():
+                self.__remove(self.__entries[job_id])
+
+    def write(self, node_id: str, job_id: str, data: bytes) -> LogEntry:
+        """Replaces the whole log of a job"""
+        if job_id in self.__entries:
+            self.__remove(self.__entries[job_id])
+        entry = self.__create(node_id, job_id)
+        self.__store(entry, data)
+        entry.set_offset(len(data))
+        return entry
+
+    def touch(self, node_id: str, job_id: str):
+        """Creates an empty log for a job that did not print anything"""
+        if job_id not in self.__entries:
+            self.write(node_id, job_id, b"")
+
+    def append(self, node_id: str, job_id: str, offset: int, data: bytes) -> LogEntry:
+        """
+        Appends a chunk of job output that starts at the given offset. A chunk
+        that was already received (the launcher retried it) is only counted once.
+        """
+        entry = self.__entries.get(job_id)
+        if entry == None:
+            entry = self.__create(node_id, job_id)
+        if entry.get_offset() == None:
+            self.__measure(entry)
+        if offset > entry.get_offset():
+            raise Exception(
+                f"log chunk of job {job_id} starts at {offset} but only {entry.get_offset()} bytes were received"
+            )
+        data = data[entry.get_offset() - offset :]
+        if len(data) == 0:
+            return entry
+        self.__store(entry, data)
+        entry.set_offset(entry.get_offset() + len(data))
+        return entry
+
+    def get(self, job_id: str) -> LogEntry | None:
+        return self.__entries.get(job_id)
+
+    def get_node_entries(self, node_id: str) -> list[LogEntry]:
+        # copied in one go, the log thread may be adding to it
+        job_ids = list(self.__nodes.get(node_id, ()))
+        return [e for e in map(self.__entries.get, job_ids) if e != None]
+
+    def get_total_size(self) -> int:
+        return self.__total_size
+
+    def iter_range(
+        self, entry: LogEntry, offset: int = 0, limit: int | None = None
+    ) -> Iterator[bytes]:
+        """Yields the log from the offset in chunks, up to limit bytes if given"""
+        # stop at what is stored now, a chunk may be half written past that
+        end = entry.get_length()
+        if limit != None:
+            end = offset + limit if end == None else min(end, offset + limit)
+        if end != None and offset >= end:
+            return
+        try:
+            with self.__open(entry) as f:
+                position = 0
+                if entry.get_path().endswith(".log"):
+                    f.seek(offset)
+                    position = offset
+                # compressed streams can only be skipped by reading them
+                while end == None or position < end:
+                    size = (
+                        CHUNK_SIZE if end == None else min(CHUNK_SIZE, end - position)
+                    )
+                    if position < offset:
+                        size = min(size, offset - position)
+                    data = f.read(size)
+                    if len(data) == 0:
+                        return
+                    if position >= offset:
+                        yield data
+                    position += len(data)
+        except FileNotFoundError:
+            return  # dropped by the retention before it was opened
+
+    def iter_node(self, node_id: str) -> Iterator[bytes]:
+        """Yields every log of the node, oldest first, each one after a newline"""
+        for entry in self.get_node_entries(node_id):
+            yield b"\n"
+            yield from self.iter_range(entry)
+
+    def retain(self, max_age: float, max_total: int):
+        """
+        Drops the logs that were not written to for max_age seconds, then the
+        oldest ones until the total fits in max_total bytes. The logs of
+        running jobs are kept. A limit of 0 disables it.
+        """
+        now = time.time()
+        dropped = 0
+        for entry in list(self.__entries.values()):
+            if cluster.has_running_job(entry.get_job_id()):
+                continue
+            expired = max_age > 0 and now - entry.get_updated_at() > max_age
+            oversized = max_total > 0 and self.__total_size > max_total
+            if expired or oversized:
+                self.__remove(entry)
+                dropped += 1
+        if dropped > 0:
+            print(f"Log retention dropped {dropped} job logs")
+
+    def rebuild(self):
+        """Indexes the logs already on disk, oldest first"""
+        self.__entries.clear()
+        self.__nodes.clear()
+        self.__node_sizes.clear()
+        self.__total_size = 0
+        if not os.path.isdir(self.__root):
+            return
+        found = []
+        for node in os.scandir(self.__root):
+            if not node.is_dir():
+                continue
+            for file in os.scandir(node.path):
+                for suffix in SUFFIXES.values():
+                    if file.is_file() and file.name.endswith(suffix):
+                        stat = file.stat()
+                        job_id = file.name[: -len(suffix)]
+                        found.append(
+                            (stat.st_mtime, node.name, job_id, file.path, stat.st_size)
+                        )
+        for mtime, node_id, job_id, path, size in sorted(found):
+            if job_id in self.__entries:
+                continue  # the same job stored twice, keep the oldest one
+            # only an uncompressed log tells its length without reading it
+            length = size if path.endswith(".log") else None
+            entry = LogEntry(job_id, node_id, path, size, length, length)
+            entry.set_updated_at(mtime)
+            self.__add(entry)
+        print(f"Indexed {len(self.__entries)} job logs")
+
+    def clear(self):
+        """Deletes every log, on disk and in the index"""
+        shutil.rmtree(self.__root, ignore_errors=True)
+        self.__entries.clear()
+        self.__nodes.clear()
+        self.__node_sizes.clear()
+        self.__total_size = 0
+
+
+logs = LogStore(
+    "tmp",
+    log_config["compression"],
+    log_config["level"],
+    log_config["job_cap"],
+    log_config["node_cap"],
+)
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-logs")
+
+
+async def run(fn: Callable, *args) -> Any:
+    """Calls fn on the log thread, in the order the calls were made"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+async def load_retention():
+    while True:
+        await asyncio.sleep(log_config["retention_interval"])
+        await run(logs.retain, log_config["max_age"], log_config["max_total"])
@@ -1,135 +1,437 @@
 import asyncio
+import math
 import random
 import string
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Literal
 
 import httpx
 import docker.errors
 
-from src.utils.config import cluster, dc
-from src.utils.calculate import calculate_cpu_percent
-from src.utils.config import address
+from src.internal.cgroup import collector as cgroup_collector
+from src.internal.cluster import Pod, ServerNode
+from src.internal.stats import subscriptions
+from src.internal.type import ServerNodeStatus
+from src.utils.config import cluster, adc
+from src.utils.calculate import calculate_cpu_percent, calculate_read_time
+from src.utils.config import address, monitor
+
+# Reading the cgroup files is fast but still blocking, so it runs on this pool.
+# Docker stats calls go through adc, where docker.limits.stats caps them.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="load-monitor")
+
+
+async def collect_stats(servers: list[ServerNode]) -> dict[str, dict]:
+    """Fetches the stats of all the given servers at once, keyed by node id"""
+    if monitor["backend"] == "cgroup":
+        node_ids = [server.get_node_id() for server in servers]
+        await cgroup_collector.resolve_all(node_ids)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, cgroup_collector.collect, node_ids)
+
+    rtn = {}
+    missing = []
+    for server in servers:
+        sample = subscriptions.get_latest(server.get_node_id())
+        if sample != None:
+            rtn[server.get_node_id()] = sample
+            continue
+        # No cached sample yet (stream just opened or dropped), so (re)open the
+        # stream for the next tick and poll the daemon this one time
+        subscriptions.subscribe(server.get_node_id())
+        missing.append(server)
+
+    results = await asyncio.gather(
+        *[adc.stats(server.get_node_id()) for server in missing],
+        return_exceptions=True,
+    )
+
+    for server, result in zip(missing, results):
+        if isinstance(result, docker.errors.APIError):
+            print(result)
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        rtn[server.get_node_id()] = result
+    return rtn
+
+
+"""
+The scaling policy engine. The raw usage of a pod jumps around a lot between
+two 0.5s ticks, and acting on every spike makes the pod flap between sizes and
+pay the container start-up cost over and over. So for every elastic pod:
+- the usage is smoothed first, with an EWMA or a percentile over a time window
+- high (low) load must last for the scale up (down) window before we act
+- nothing happens during the cooldown that follows every action
+"""
+
+
+class Smoother(object):
+    def __init__(self, policy: "ScalingPolicy"):
+        self.__policy: ScalingPolicy = policy
+        self.__ewma: float | None = None
+        self.__samples: deque[tuple[float, float]] = deque()  # (timestamp, value)
+
+    def observe(self, now: float, value: float) -> float:
+        alpha = self.__policy.get_alpha()
+        if self.__ewma == None:
+            self.__ewma = value
+        else:
+            self.__ewma = alpha * value + (1 - alpha) * self.__ewma
+
+        self.__samples.append((now, value))
+        while self.__samples[0][0] < now - self.__policy.get_window():
+            self.__samples.popleft()
+
+        if self.__policy.get_smoothing() == "ewma":
+            return self.__ewma
+        values = sorted(value for _, value in self.__samples)
+        index = round(self.__policy.get_percentile() / 100 * (len(values) - 1))
+        return values[index]
+
+
+class ScalingPolicy(object):
+    def __init__(self):
+        self.__smoothing: Literal["ewma", "percentile"] = "ewma"
+        self.__alpha: float = 0.3  # weight of the newest sample in the EWMA
+        self.__window: float = 30.0  # seconds of samples for the percentile
+        self.__percentile: float = 90.0
+        self.__scale_up_window: float = 5.0  # seconds
+        self.__scale_down_window: float = 60.0  # seconds
+        self.__cooldown: float = 30.0  # seconds
+        # "step" moves one node per decision based on the pod thresholds,
+        # "target" resizes the pod in one go to reach the target utilization
+        self.__mode: Literal["step", "target"] = "step"
+        self.__target_utilization: float = 50.0  # percentage
+        self.reset()
+
+    def reset(self):
+        self.__usage: Smoother = Smoother(self)
+        self.__network: Smoother = Smoother(self)
+        self.__high_since: float | None = None
+        self.__low_since: float | None = None
+        self.__last_action: float = 0.0
+
+    def get_smoothing(self) -> Literal["ewma", "percentile"]:
+        return self.__smoothing
+
+    def set_smoothing(self, smoothing: Literal["ewma", "percentile"]):
+        self.__smoothing = smoothing
+
+    def get_alpha(self) -> float:
+        return self.__alpha
+
+    def set_alpha(self, alpha: float):
+        if not 0 < alpha <= 1:
+            raise Exception("alpha must be in (0, 1]")
+        self.__alpha = alpha
+
+    def get_window(self) -> float:
+        return self.__window
+
+    def set_window(self, window: float):
+        if window <= 0:
+            raise Exception("window must be positive")
+        self.__window = window
+
+    def get_percentile(self) -> float:
+        return self.__percentile
+
+    def set_percentile(self, percentile: float):
+        if not 0 <= percentile <= 100:
+            raise Exception("percentile must be in [0, 100]")
+        self.__percentile = percentile
+
+    def get_scale_up_window(self) -> float:
+        return self.__scale_up_window
+
+    def set_scale_up_window(self, scale_up_window: float):
+        if scale_up_window < 0:
+            raise Exception("scale up window must not be negative")
+        self.__scale_up_window = scale_up_window
+
+    def get_scale_down_window(self) -> float:
+        return self.__scale_down_window
+
+    def set_scale_down_window(self, scale_down_window: float):
+        if scale_down_window < 0:
+            raise Exception("scale down window must not be negative")
+        self.__scale_down_window = scale_down_window
+
+    def get_cooldown(self) -> float:
+        return self.__cooldown
+
+    def set_cooldown(self, cooldown: float):
+        if cooldown < 0:
+            raise Exception("cooldown must not be negative")
+        self.__cooldown = cooldown
+
+    def get_mode(self) -> Literal["step", "target"]:
+        return self.__mode
+
+    def set_mode(self, mode: Literal["step", "target"]):
+        self.__mode = mode
+
+    def get_target_utilization(self) -> float:
+        return self.__target_utilization
+
+    def set_target_utilization(self, target_utilization: float):
+        if target_utilization <= 0:
+            raise Exception("target utilization must be positive")
+        self.__target_utilization = target_utilization
+
+    def observe(self, now: float, usage: float, network: float) -> tuple[float, float]:
+        """Returns the smoothed cpu usage and network throughput"""
+        return self.__usage.observe(now, usage), self.__network.observe(now, network)
+
+    def decide(self, now: float, high: bool, low: bool) -> Literal["up", "down"] | None:
+        self.__high_since = (self.__high_since or now) if high else None
+        self.__low_since = (self.__low_since or now) if low else None
+
+        if now - self.__last_action < self.__cooldown:
+            return None
+        if high and now - self.__high_since >= self.__scale_up_window:  # type: ignore
+            return "up"
+        if low and now - self.__low_since >= self.__scale_down_window:  # type: ignore
+            return "down"
+        return None
+
+    def record_action(self, now: float):
+        self.__last_action = now
+        self.__high_since = None
+        self.__low_since = None
+
+    def toJSON(self) -> dict:
+        return {
+            "smoothing": self.__smoothing,
+            "alpha": self.__alpha,
+            "window": self.__window,
+            "percentile": self.__percentile,
+            "scale_up_window": self.__scale_up_window,
+            "scale_down_window": self.__scale_down_window,
+            "cooldown": self.__cooldown,
+            "mode": self.__mode,
+            "target_utilization": self.__target_utilization,
+        }
+
+
+policies: dict[str, ScalingPolicy] = dict()  # key is the pod id
+
+
+def get_policy(pod_id: str) -> ScalingPolicy:
+    if pod_id not in policies:
+        policies[pod_id] = ScalingPolicy()
+    return policies[pod_id]
 
 
 async def load_monitor():
     while True:
-        await asyncio.sleep(0.5)
+        await asyncio.sleep(monitor["interval"])
         if cluster.is_initialized():
             print("--------------------")
             print(f"{datetime.now()} - Load monitor is running")
 
-            for pod in cluster.get_pods():
-                total = 0
-                usage = 0
-                for server in pod.get_server_nodes():
-                    if server.get_node_status() != "online":
-                        continue
-                    try:
-                        container = dc.containers.get(server.get_node_id())
-                        stats = container.stats(stream=False)  # type: ignore
-
-                        cpu_usage: float = calculate_cpu_percent(
-                            stats, pod.get_cpu_percent_cap()
-                        )  # percentage
-                        mem_usage: int = stats["memory_stats"]["usage"]  # bytes
-                        network_in: int = stats["networks"]["eth0"]["rx_bytes"]
-                        network_out: int = stats["networks"]["eth0"]["tx_bytes"]
-
-                        server.set_cpu_usage(cpu_usage)
-                        server.set_mem_usage(mem_usage)
-                        server.set_network_in(network_in)
-                        server.set_network_out(network_out)
-
-                        total += 1
-                        usage += cpu_usage
-                    except docker.errors.APIError as e:
-                        print(e)
-
-                if total == 0:
-                    print("No active server nodes found")
-                    continue
-
-                average = usage / total
-                pod.set_usage(average)
-
-                if not pod.get_is_elastic():
-                    continue
-
-                if average > pod.get_upper_threshold():
-                    print(
-                        f"Pod {pod.get_pod_id()} is experiencing high load, {average}%"
-                    )
-                    print("Trying to scale up...")
-                    current_amount = len(pod.get_nodes())
-                    if current_amount >= pod.get_max_nodes():
-                        print("Cannot scale up, reached maximum pod node limit")
-                        continue
-
-                    async with httpx.AsyncClient(base_url=address["manager"]) as client:
-                        resp = (
-                            await client.post(
-                                "/cloud/node/",
-                                params={
-                                    "node_type": "server",
-                                    "pod_id": pod.get_pod_id(),
-                                    "node_name": "auto-"
-                                    + "".join(
-                                        random.choices(
-                                            string.ascii_letters + string.digits, k=8
-                                        )
-                                    ),
-                                },
-                                timeout=None,
-                            )
-                        ).json()
-                        if resp["status"]:
-                            print("Successful added a new server node")
-                            resp = (
-                                await client.post(
-                                    "/cloud/server/launch/",
-                                    params={
-                                        "pod_id": pod.get_pod_id(),
-                                    },
-                                    timeout=None,
-                                )
-                            ).json()
-                            if resp["status"]:
-                                print("Successfully launched a new server node")
-                            else:
-                                print("Failed to launch a new server node")
-                                print(resp["msg"])
-
-                        else:
-                            print("Failed to add a new server node")
-                            print(resp["msg"])
-
-                elif average < pod.get_lower_threshold():
-                    print(
-                        f"Pod {pod.get_pod_id()} is experiencing low load, {average}%"
-                    )
-                    print("Trying to scale down...")
-                    current_amount = len(pod.get_server_nodes())
-                    if current_amount <= pod.get_min_nodes():
-                        print("Cannot scale down, reached minimum pod node limit")
-                        continue
-
-                    async with httpx.AsyncClient(base_url=address["manager"]) as client:
-                        resp = (
-                            await client.delete(
-                                "/cloud/node/",
-                                params={
-                                    "node_id": pod.get_server_nodes()[-1].get_node_id()
-                                },
-                                timeout=None,
-                            )
-                        ).json()
-                        if resp["status"]:
-                            print("Scale down successful")
-                        else:
-                            print("Scale down failed")
-                            print(resp["msg"])
-
-                else:
-                    print(
-                        f"Pod {pod.get_pod_id()} is experiencing normal load, {average}%"
-                    )
+            start_time = time.perf_counter()
+            pods = cluster.get_pods()
+            servers = [
+                server
+                for pod in pods
+                for server in pod.get_server_nodes()
+                if server.get_node_status() == ServerNodeStatus.ONLINE
+            ]
+            stats = await collect_stats(servers)
+            print(
+                f"Collected stats of {len(stats)}/{len(servers)} servers in "
+                f"{time.perf_counter() - start_time:.3f}s"
+            )
+
+            for pod in pods:
+                await update_pod(pod, stats)
+
+            print(f"Load monitor tick took {time.perf_counter() - start_time:.3f}s")
+
+
+async def update_pod(pod: Pod, stats: dict[str, dict]):
+    timestamp = time.time()
+    total = 0  # the servers that were sampled, the online ones
+    usage = 0
+    network_in_rate = 0.0
+    network_out_rate = 0.0
+    for server in pod.get_server_nodes():
+        if server.get_node_id() not in stats:
+            continue
+        try:
+            stat = stats[server.get_node_id()]
+            cpu_usage: float = calculate_cpu_percent(
+                stat, pod.get_cpu_percent_cap()
+            )  # percentage
+            mem_usage: int = stat["memory_stats"]["usage"]  # bytes
+            network_in: int = stat["networks"]["eth0"]["rx_bytes"]
+            network_out: int = stat["networks"]["eth0"]["tx_bytes"]
+            sampled_at: float = calculate_read_time(stat)
+        except KeyError as e:
+            # a container that is shutting down reports empty stats
+            print(f"Incomplete stats for server {server.get_node_id()}: {e}")
+            continue
+
+        server.set_cpu_usage(cpu_usage)
+        server.set_mem_usage(mem_usage)
+        server.update_network(network_in, network_out, sampled_at)
+        server.get_history().record(
+            timestamp,
+            cpu_usage,
+            mem_usage,
+            server.get_network_in_rate(),
+            server.get_network_out_rate(),
+        )
+
+        total += 1
+        usage += cpu_usage
+        network_in_rate += server.get_network_in_rate()
+        network_out_rate += server.get_network_out_rate()
+
+    if total == 0:
+        print("No active server nodes found")
+        return
+
+    average = usage / total
+    pod.set_usage(average)
+    pod.set_network_in_rate(network_in_rate)
+    pod.set_network_out_rate(network_out_rate)
+
+    if not pod.get_is_elastic():
+        return
+
+    # Express servers tend to saturate the network before the cpu, so pods can
+    # also scale on the average throughput per server
+    now = time.time()
+    policy = get_policy(pod.get_pod_id())
+    average, network_average = policy.observe(
+        now, average, (network_in_rate + network_out_rate) / total
+    )
+    current = len(pod.get_server_nodes())
+    if policy.get_mode() == "target":
+        # Target tracking: size the pod so that the current load would sit at
+        # the target utilization, and get there in a single decision. The load
+        # is spread over the sampled servers only, the new and paused ones
+        # carry none, so they are kept on top of the servers the load needs
+        needed = math.ceil(total * average / policy.get_target_utilization())
+        if pod.get_network_upper_threshold() > 0:
+            needed = max(
+                needed,
+                math.ceil(total * network_average / pod.get_network_upper_threshold()),
+            )
+        desired = current - total + needed
+        desired = min(max(desired, pod.get_min_nodes()), pod.get_max_nodes())
+        high = desired > current
+        low = desired < current
+    else:
+        network_high = False
+        network_low = True
+        if pod.get_network_upper_threshold() > 0:
+            network_high = network_average > pod.get_network_upper_threshold()
+            network_low = network_average < pod.get_network_lower_threshold()
+
+        high = average > pod.get_upper_threshold() or network_high
+        low = average < pod.get_lower_threshold() and network_low
+        desired = current + 1 if high else current - 1 if low else current
+
+    load = "high" if high else "low" if low else "normal"
+    print(
+        f"Pod {pod.get_pod_id()} is experiencing {load} load, {average:.1f}%, "
+        f"{network_average:.0f}B/s per server (smoothed)"
+    )
+
+    action = policy.decide(now, high, low)
+    if action == "up":
+        print(f"Trying to scale up from {current} to {desired} nodes...")
+        if current >= pod.get_max_nodes():
+            print("Cannot scale up, reached maximum pod node limit")
+            return
+        policy.record_action(now)
+        await scale_up(pod, min(desired, pod.get_max_nodes()) - current)
+
+    elif action == "down":
+        print(f"Trying to scale down from {current} to {desired} nodes...")
+        if current <= pod.get_min_nodes():
+            print("Cannot scale down, reached minimum pod node limit")
+            return
+        policy.record_action(now)
+        await scale_down(pod, current - max(desired, pod.get_min_nodes()))
+
+
+async def scale_up(pod: Pod, count: int = 1):
+    """Registers count server nodes at once, then launches them in one call"""
+    async with httpx.AsyncClient(base_url=address["manager"]) as client:
+        resps = await asyncio.gather(
+            *[
+                client.post(
+                    "/cloud/node/",
+                    params={
+                        "node_type": "server",
+                        "pod_id": pod.get_pod_id(),
+                        "node_name": "auto-"
+                        + "".join(
+                            random.choices(string.ascii_letters + string.digits, k=8)
+                        ),
+                    },
+                    timeout=None,
+                )
+                for _ in range(count)
+            ]
+        )
+        added = 0
+        for resp in resps:
+            resp = resp.json()
+            if resp["status"]:
+                added += 1
+            else:
+                print("Failed to add a new server node")
+                print(resp["msg"])
+        if added == 0:
+            return
+
+        print(f"Successful added {added} new server nodes")
+        resp = (
+            await client.post(
+                "/cloud/server/launch/",
+                params={
+                    "pod_id": pod.get_pod_id(),
+                },
+                timeout=None,
+            )
+        ).json()
+        if resp["status"]:
+            print(f"Successfully launched {added} new server nodes")
+        else:
+            print("Failed to launch the new server nodes")
+            print(resp["msg"])
+
+
+async def scale_down(pod: Pod, count: int = 1):
+    """Removes the count most recently added online server nodes at once"""
+    async with httpx.AsyncClient(base_url=address["manager"]) as client:
+        resps = await asyncio.gather(
+            *[
+                client.delete(
+                    "/cloud/node/",
+                    params={"node_id": server.get_node_id()},
+                    timeout=None,
+                )
+                for server in [
+                    server
+                    for server in pod.get_server_nodes()
+                    if server.get_node_status() == ServerNodeStatus.ONLINE
+                ][-count:]
+            ]
+        )
+        for resp in resps:
+            resp = resp.json()
+            if resp["status"]:
+                print("Scale down successful")
+            else:
+                print("Scale down failed")
+                print(resp["msg"])
@@ -0,0 +1,151 @@
+import asyncio
+import secrets
+from collections import deque
+
+from src.internal.cluster import JobNode, Pod, alphabet
+from src.utils.config import cluster, cluster_type, adc, pool as pool_config
+from src.utils.image import job_runner_image
+from src.utils.labels import container_labels
+
+"""
+A warm pool of job containers. Every pod keeps a few containers that are
+already created and started, so registering a job node or replacing the
+container of an aborted job does not wait on the Docker daemon. The pool is
+refilled in the background and never makes a pod go over the node_limit of the
+cluster type (pooled containers count towards it).
+"""
+
+
+async def create_job_container(name: str, labels: dict[str, str]) -> str:
+    """Creates and starts a job container, returns its short id"""
+    container_id = await adc.create(
+        job_runner_image(),
+        name,
+        ["tail", "-f", "/dev/null"],  # keep it running
+        extra_hosts={"host.docker.internal": "host-gateway"},
+        init=True,  # reaps the processes of killed jobs
+        # the slots of a node split the cpu and mem of the cluster type, so the
+        # jobs of a node cannot take more than their slots from other nodes
+        nano_cpus=int(cluster.get_cpu_limit() * 1000000000),
+        mem_limit=str(cluster.get_mem_limit()) + "m",
+        labels=labels,
+    )
+    print("ID: " + container_id)
+    await adc.start(container_id)
+    return container_id
+
+
+class WarmPool(object):
+    def __init__(self, default_size: int):
+        self.__default_size: int = default_size
+        self.__sizes: dict[str, int] = dict()  # key is the pod id
+        self.__containers: dict[str, deque[str]] = dict()  # key is the pod id
+        self.__pending: dict[str, int] = dict()  # containers being created
+        self.__tasks: set[asyncio.Task] = set()
+
+    def get_size(self, pod_id: str) -> int:
+        return self.__sizes.get(pod_id, self.__default_size)
+
+    def set_size(self, pod_id: str, size: int):
+        self.__sizes[pod_id] = size
+
+    def get_warm(self, pod_id: str) -> int:
+        return len(self.__containers.get(pod_id, ()))
+
+    def __get_target(self, pod: Pod) -> int:
+        limit = cluster_type[cluster.get_type()]["node_limit"]
+        if pod.get_is_elastic():
+            return 0  # elastic pods do not have job nodes
+        # the nodes being registered may not come from the pool
+        nodes = len(pod.get_nodes()) + cluster.get_registering(pod.get_pod_id())
+        return min(self.get_size(pod.get_pod_id()), limit - nodes)
+
+    def has_size(self, pod_id: str) -> bool:
+        """Whether the size of the pool of this pod was set explicitly"""
+        return pod_id in self.__sizes
+
+    def adopt(self, pod_id: str, container_id: str):
+        """Puts back a warm container that was already running before a restart"""
+        self.__containers.setdefault(pod_id, deque()).append(container_id)
+
+    def put_back(self, pod_id: str, container_id: str):
+        """Returns a container taken from the pool that did not become a node"""
+        if pod_id not in self.__containers:
+            # the pod was drained meanwhile
+            self.__spawn(self.__remove(container_id))
+            return
+        self.__containers[pod_id].appendleft(container_id)
+
+    def take(self, pod_id: str) -> str | None:
+        """Returns the id of a running container, or None if the pool is empty"""
+        containers = self.__containers.get(pod_id)
+        if not containers:
+            return None
+        return containers.popleft()
+
+    async def swap(self, node: JobNode) -> bool:
+        """Moves a job node onto a warm container, returns False if there is none"""
+        container_id = self.take(node.get_pod_id())
+        if container_id == None:
+            return False
+        old_container_id = node.get_container_id()
+        # renaming is instant, the old container is removed in the background
+        await adc.rename(
+            old_container_id, f"{node.get_pod_id()}_retired_{old_container_id}"
+        )
+        await adc.rename(container_id, f"{node.get_pod_id()}_{node.get_node_name()}")
+        node.set_container_id(container_id)
+        self.__spawn(self.__remove(old_container_id))
+        self.schedule_refill(cluster.get_pod_by_id(node.get_pod_id()))
+        return True
+
+    def schedule_refill(self, pod: Pod):
+        self.__spawn(self.refill(pod))
+
+    def __spawn(self, coroutine):
+        # keep a reference, the event loop only holds weak ones to its tasks
+        task = asyncio.create_task(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def refill(self, pod: Pod):
+        pod_id = pod.get_pod_id()
+        containers = self.__containers.setdefault(pod_id, deque())
+        while len(containers) + self.__pending.get(pod_id, 0) < self.__get_target(pod):
+            self.__pending[pod_id] = self.__pending.get(pod_id, 0) + 1
+            try:
+                name = f"{pod_id}_warm_" + "".join(
+                    secrets.choice(alphabet) for _ in range(8)
+                )
+                container_id = await create_job_container(
+                    name, container_labels(pod, "warm")
+                )
+            except Exception as e:
+                print(f"Failed to refill the warm pool of pod {pod_id}: {e}")
+                return
+            finally:
+                self.__pending[pod_id] -= 1
+
+            if self.__containers.get(pod_id) is not containers:
+                # the pod was drained while we were creating the container
+                await self.__remove(container_id)
+                return
+            containers.append(container_id)
+
+    async def drain(self, pod_id: str):
+        """Removes all the warm containers of a pod"""
+        containers = self.__containers.pop(pod_id, ())
+        await asyncio.gather(*[self.__remove(c) for c in containers])
+
+    async def remove_pod(self, pod_id: str):
+        await self.drain(pod_id)
+        self.__sizes.pop(pod_id, None)
+
+    async def __remove(self, container_id: str):
+        try:
+            await adc.remove(container_id)
+        except Exception as e:
+            print(e)
+
+
+warm_pool = WarmPool(pool_config["size"])
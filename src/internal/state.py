@@ -0,0 +1,453 @@
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from src.internal.archive import archive, sync
+from src.internal.cluster import Job, JobNode, Pod, ServerNode, journal
+from src.internal.pool import warm_pool
+from src.internal.type import JobStatus, ServerNodeStatus
+from src.utils.config import cluster, adc, state as state_config
+from src.utils.labels import (
+    CLUSTER_TYPE,
+    NODE_NAME,
+    NODE_TYPE,
+    POD_ID,
+    POD_NAME,
+    PORT,
+    list_cluster_containers,
+)
+
+"""
+The cluster state survives restarts.
+
+Every change the objects report to the journal (see src/internal/cluster.py)
+becomes a record {"seq", "kind", "key", "state"} holding the new state of one
+cluster, pod, node or job, or None once it is removed. The scripts of pending
+jobs are records of their own, keyed by their hash, so a script that a batch
+shares is stored once. The records are buffered and appended to the log of a
+backend after every request and every flush_interval, and once compact_every
+of them piled up the backend replaces the log with a snapshot of the whole
+state. Writing blocks, so the backend is only called on the state thread
+through run(), in order, and the event loop never waits on the disk.
+
+On startup the snapshot is loaded and the records newer than it replayed on
+top, which only rebuilds dicts, then the cluster is rebuilt from them and
+reconciled against the containers of the cluster (found by their labels, see
+src/utils/labels.py): nodes whose container is gone are dropped, stopped ones
+started again, and warm or leftover containers adopted or removed. Nothing is
+wiped. Without a saved state, init rebuilds the pods and nodes from the labels.
+Only a reset (DELETE /cloud/) removes the containers and clears the state.
+
+A backend only has to load, append, compact and clear, so an etcd one (see
+run_etcd.sh) can be added next to the file and SQLite ones.
+"""
+
+KINDS = ("cluster", "pod", "node", "job", "script")
+
+
+class FileBackend(object):
+    """A snapshot.json and an append-only wal.jsonl in a directory"""
+
+    def __init__(self, path: str, fsync: bool):
+        os.makedirs(path, exist_ok=True)
+        self.__snapshot: str = os.path.join(path, "snapshot.json")
+        self.__wal: str = os.path.join(path, "wal.jsonl")
+        self.__fsync: bool = fsync
+
+    def load(self) -> tuple[dict | None, list[dict]]:
+        snapshot = None
+        if os.path.exists(self.__snapshot):
+            with open(self.__snapshot, "r") as f:
+                snapshot = json.load(f)
+        records = []
+        if os.path.exists(self.__wal):
+            with open(self.__wal, "r") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # the last record was cut by a crash
+        return snapshot, records
+
+    def append(self, records: list[dict]):
+        with open(self.__wal, "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in records))
+            f.flush()
+            if self.__fsync:
+                os.fsync(f.fileno())
+
+    def compact(self, snapshot: dict):
+        # the records left behind by a crash before the truncate are older than
+        # the snapshot, load skips them by their seq
+        with open(self.__snapshot + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.__snapshot + ".tmp", self.__snapshot)
+        open(self.__wal, "w").close()
+
+    def clear(self):
+        for path in [self.__snapshot, self.__wal]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SQLiteBackend(object):
+    """The snapshot and the log as two tables of a database"""
+
+    def __init__(self, path: str, fsync: bool):
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot (id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS wal (seq INTEGER PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        self.__db.commit()
+
+    def load(self) -> tuple[dict | None, list[dict]]:
+        row = self.__db.execute("SELECT data FROM snapshot WHERE id = 0").fetchone()
+        records = [
+            json.loads(record)
+            for (record,) in self.__db.execute("SELECT record FROM wal ORDER BY seq")
+        ]
+        return (json.loads(row[0]) if row != None else None), records
+
+    def append(self, records: list[dict]):
+        self.__db.executemany(
+            "INSERT OR REPLACE INTO wal (seq, record) VALUES (?, ?)",
+            [(r["seq"], json.dumps(r)) for r in records],
+        )
+        self.__db.commit()
+
+    def compact(self, snapshot: dict):
+        self.__db.execute(
+            "INSERT OR REPLACE INTO snapshot (id, data) VALUES (0, ?)",
+            (json.dumps(snapshot),),
+        )
+        self.__db.execute("DELETE FROM wal")
+        self.__db.commit()
+
+    def clear(self):
+        self.__db.execute("DELETE FROM snapshot")
+        self.__db.execute("DELETE FROM wal")
+        self.__db.commit()
+
+
+BACKENDS = {"file": FileBackend, "sqlite": SQLiteBackend}
+
+
+def dump() -> dict:
+    """The whole state of the cluster, as the records would rebuild it"""
+    rtn = {kind: dict() for kind in KINDS}
+    if not cluster.is_initialized():
+        return rtn
+    rtn["cluster"]["cluster"] = cluster.toState()
+    for pod in cluster.get_pods():
+        rtn["pod"][pod.get_pod_id()] = pod.toState()
+        for node in pod.get_nodes():
+            rtn["node"][node.get_node_id()] = node.toState()
+            if isinstance(node, JobNode):
+                for job in node.get_jobs():
+                    rtn["job"][job.get_job_id()] = job.toState()
+    for job, script_hash in cluster.get_pending_entries():
+        rtn["job"][job.get_job_id()] = {**job.toState(), "script_hash": script_hash}
+    for script_hash, script in cluster.get_pending_scripts().items():
+        rtn["script"][script_hash] = {"script": script.hex()}
+    return rtn
+
+
+class StateLog(object):
+    def __init__(self, backend: FileBackend | SQLiteBackend, compact_every: int):
+        self.__backend: FileBackend | SQLiteBackend = backend
+        self.__compact_every: int = compact_every
+        self.__buffer: list[dict] = []
+        self.__seq: int = 0  # of the last record
+        self.__since_snapshot: int = 0  # records in the log
+
+    def record(self, kind: str, key: str, state: dict | None):
+        self.__seq += 1
+        self.__buffer.append(
+            {"seq": self.__seq, "kind": kind, "key": key, "state": state}
+        )
+
+    async def flush(self):
+        """Appends the buffered records to the log, compacting it when it is long"""
+        if len(self.__buffer) == 0:
+            return
+        records, self.__buffer = self.__buffer, []
+        self.__since_snapshot += len(records)
+        await run(self.__backend.append, records)
+        if self.__since_snapshot >= self.__compact_every:
+            await self.compact()
+
+    async def compact(self):
+        self.__since_snapshot = 0
+        # archive the finished jobs first, the snapshot only has the ones in memory
+        await sync()
+        # the snapshot has the buffered records, the ones already handed to the
+        # state thread are written before it
+        self.__buffer = []
+        await run(self.__backend.compact, {"seq": self.__seq, "state": dump()})
+
+    def load(self) -> dict:
+        """Returns the state of the snapshot with the newer records replayed on it"""
+        snapshot, records = self.__backend.load()
+        rtn = {kind: dict() for kind in KINDS}
+        if snapshot != None:
+            rtn.update(snapshot["state"])  # older snapshots lack some kinds
+            self.__seq = snapshot["seq"]
+        for record in records:
+            if record["seq"] <= self.__seq:
+                continue  # already in the snapshot
+            self.__seq = record["seq"]
+            if record["state"] == None:
+                rtn[record["kind"]].pop(record["key"], None)
+            else:
+                rtn[record["kind"]][record["key"]] = record["state"]
+        self.__since_snapshot = len(records)
+        return rtn
+
+    async def clear(self):
+        self.__buffer = []
+        self.__since_snapshot = 0
+        await run(self.__backend.clear)
+
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cluster-state")
+
+
+async def run(fn: Callable, *args) -> Any:
+    """Calls fn on the state thread, in the order the calls were made"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+state_log: StateLog | None = None
+if state_config["backend"] in BACKENDS:
+    state_log = StateLog(
+        BACKENDS[state_config["backend"]](state_config["path"], state_config["fsync"]),
+        state_config["compact_every"],
+    )
+elif state_config["backend"] != "none":
+    raise Exception(f"unknown state backend {state_config['backend']}")
+
+
+def restore(state: dict):
+    """Rebuilds the cluster as it was, the journal must not record it"""
+    cluster.loadState(state["cluster"]["cluster"])
+    for pod_state in state["pod"].values():
+        cluster.add_pod(Pod.fromState(pod_state))
+
+    nodes: dict[str, JobNode | ServerNode] = dict()
+    for node_state in state["node"].values():
+        if node_state["pod_id"] not in state["pod"]:
+            continue
+        if node_state["node_type"] == "job":
+            node = JobNode.fromState(node_state)
+        else:
+            node = ServerNode.fromState(node_state)
+        cluster.get_pod_by_id(node.get_pod_id()).add_node(node)
+        cluster.add_node(node)
+        nodes[node.get_node_id()] = node
+
+    running = []
+    scripts = {
+        script_hash: bytes.fromhex(script_state["script"])
+        for script_hash, script_state in state["script"].items()
+    }
+    for job_state in sorted(state["job"].values(), key=lambda s: s["created_at"]):
+        script = scripts.get(job_state.pop("script_hash", None))
+        if "script" in job_state:
+            script = bytes.fromhex(job_state.pop("script"))  # an older state
+        job = Job.fromState(job_state)
+        if job.get_job_status() == JobStatus.REGISTERED:
+            if script != None:
+                cluster.add_pending_job(job, script)
+        elif job.get_job_status() == JobStatus.RUNNING:
+            running.append(job)
+        else:
+            # a job cancelled or out of time in the queue was never placed
+            restore_finished_job(job, nodes.get(job_state["node_id"]))
+    for job in running:
+        node = nodes.get(job.get_node_id())
+        if (
+            isinstance(node, JobNode)
+            and len(node.get_running_jobs()) < node.get_slots()
+        ):
+            node.add_job(job)
+            cluster.add_running_job(job)
+        else:
+            job.set_failed()  # its node is gone
+            restore_finished_job(job, node)
+
+    for node in nodes.values():
+        if isinstance(node, JobNode):
+            cluster.add_available_job_node(node)
+
+
+def restore_finished_job(job: Job, node: JobNode | ServerNode | None):
+    if isinstance(node, JobNode):
+        node.add_job(job)
+        node.finish_job(job.get_job_id())
+        cluster.add_finished_job(job)
+    else:
+        archive.add([job])  # cancelled in the queue, or its node is gone
+
+
+def fail_running_jobs(node: JobNode):
+    """Fails the jobs that were running in a container that is gone or stopped"""
+    for job in node.get_running_jobs():
+        print(f"Job {job.get_job_id()} was lost with its container")
+        cluster.remove_running_job(job.get_job_id())
+        job.set_failed()
+        node.finish_job(job.get_job_id())
+        cluster.release_job_slot(node)
+
+
+async def reconcile():
+    """Matches the restored nodes and the warm pool with the containers there are"""
+    containers = {c["Id"][0:12]: c for c in await list_cluster_containers()}
+    for node in [n for pod in cluster.get_pods() for n in pod.get_nodes()]:
+        container = containers.pop(node.get_container_id(), None)
+        if container == None:
+            print(f"Container of node {node.get_node_id()} is gone, removing it")
+            if isinstance(node, JobNode):
+                fail_running_jobs(node)
+                cluster.remove_available_job_node(node)
+            cluster.get_pod_by_id(node.get_pod_id()).remove_node_by_id(
+                node.get_node_id()
+            )
+            cluster.remove_node_by_id(node.get_node_id())
+            continue
+        if container["State"] == "running":
+            continue
+        if isinstance(node, JobNode):
+            fail_running_jobs(node)
+        elif node.get_node_status() != ServerNodeStatus.ONLINE:
+            continue  # paused or never launched, it stays stopped
+        print(f"Container of node {node.get_node_id()} was stopped, starting it")
+        await adc.start(node.get_container_id())
+    await settle_leftovers(containers)
+
+
+async def adopt_containers(type: str) -> int:
+    """
+    Rebuilds the pods and nodes of a cluster that has no saved state from the
+    labels of its containers, returns how many nodes it adopted. The jobs and
+    the pod settings are not in the labels, the pods start with the defaults.
+    """
+    containers = {c["Id"][0:12]: c for c in await list_cluster_containers()}
+    pods: dict[str, Pod] = dict()  # the adopted ones, key is the pod id
+    for container_id, container in list(containers.items()):
+        labels = container["Labels"]
+        name = container["Names"][0].lstrip("/")
+        # a warm container that became a node only has it in its name
+        node_name = labels.get(NODE_NAME, name.partition("_")[2])
+        if labels.get(CLUSTER_TYPE) != type or node_name.startswith(
+            ("warm_", "retired_")
+        ):
+            continue  # not a node of this cluster type
+        pod = pods.get(labels[POD_ID])
+        if pod == None:
+            pod = Pod(labels[POD_NAME], labels[POD_ID])
+            cluster.add_pod(pod)
+            pods[pod.get_pod_id()] = pod
+
+        if labels[NODE_TYPE] == "server":
+            node = ServerNode(
+                node_name, container_id, pod.get_pod_id(), int(labels[PORT])
+            )
+            cluster.reserve_port(node.get_port())
+            if container["State"] == "running":
+                node.set_online()
+            elif container["State"] == "exited":
+                node.set_paused()
+        else:
+            node = JobNode(
+                node_name, container_id, pod.get_pod_id(), cluster.get_job_slots()
+            )
+            if container["State"] != "running":
+                await adc.start(container_id)
+        pod.add_node(node)
+        cluster.add_node(node)
+        if isinstance(node, JobNode):
+            cluster.add_available_job_node(node)
+        del containers[container_id]
+
+    for pod in pods.values():
+        servers = pod.get_server_nodes()
+        if len(servers) > 0:
+            # as when the servers were launched, see src/routers/server.py
+            pod.set_cpu_percent_cap(
+                min(cluster.get_cpu_limit(), cluster.get_cpu_available() / len(servers))
+            )
+    await settle_leftovers(containers)
+    return sum(len(pod.get_nodes()) for pod in pods.values())
+
+
+async def settle_leftovers(containers: dict[str, dict]):
+    """
+    Puts the running warm containers of the pods back in the pool and removes
+    the other containers of the cluster that are not nodes, key is the short id
+    """
+    for container_id, container in containers.items():
+        pod_id = container["Labels"].get(POD_ID)
+        name = container["Names"][0].lstrip("/")
+        try:
+            cluster.get_pod_by_id(pod_id)
+            warm = name.startswith(f"{pod_id}_warm_")
+        except Exception:
+            warm = False
+        if warm and container["State"] == "running":
+            warm_pool.adopt(pod_id, container_id)
+        else:
+            print(f"Removing leftover container {name}")
+            await adc.remove(container_id)
+    for pod in cluster.get_pods():
+        # a pool is only filled for the job nodes (see node_register), or if
+        # its size was set
+        has_job_nodes = any(isinstance(n, JobNode) for n in pod.get_nodes())
+        if has_job_nodes or warm_pool.has_size(pod.get_pod_id()):
+            warm_pool.schedule_refill(pod)
+
+
+async def load_state():
+    """Restores the cluster on startup, then records every change"""
+    if state_log == None:
+        return
+    state = state_log.load()
+    if "cluster" in state["cluster"]:
+        restore(state)
+        print(
+            f"Restored {len(state['pod'])} pods, {len(state['node'])} nodes and "
+            f"{len(state['job'])} jobs"
+        )
+    journal.set_sink(state_log.record)
+    if cluster.is_initialized():
+        await reconcile()
+    await state_log.compact()
+
+
+async def clear_state():
+    """Forgets the saved state, once the cluster was reset"""
+    if state_log != None:
+        await state_log.clear()
+
+
+async def flush_state():
+    if state_log != None:
+        await state_log.flush()
+
+
+async def load_state_flush():
+    while True:
+        await asyncio.sleep(state_config["flush_interval"])
+        await flush_state()
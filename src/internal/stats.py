@@ -0,0 +1,88 @@
+import threading
+
+import docker.errors
+import requests.exceptions
+
+from src.utils.config import adc, monitor
+
+"""
+Every online server node keeps one long-lived stats stream open against the
+Docker daemon. The daemon pushes a new sample roughly every second and we only
+keep the latest one in memory, so the load monitor can read it for free instead
+of doing a 1-2s round trip per server on every tick.
+"""
+
+
+class StatsSubscription(object):
+    def __init__(self, node_id: str):
+        self.__node_id: str = node_id
+        self.__latest: dict | None = None
+        self.__closed = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name=f"stats-{node_id}", daemon=True
+        )
+
+    def get_node_id(self) -> str:
+        return self.__node_id
+
+    def get_latest(self) -> dict | None:
+        return self.__latest
+
+    def is_alive(self) -> bool:
+        return self.__thread.is_alive() and not self.__closed.is_set()
+
+    def start(self):
+        self.__thread.start()
+
+    def close(self):
+        # The stream is blocking, so the reader thread notices this on the next
+        # sample (about a second later) and drops the connection
+        self.__closed.set()
+
+    def __run(self):
+        try:
+            for sample in adc.stats_stream(self.__node_id):
+                if self.__closed.is_set():
+                    break
+                self.__latest = sample
+        except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+            print(f"Stats stream of {self.__node_id} stopped: {e}")
+        finally:
+            self.__closed.set()
+
+
+class StatsSubscriptions(object):
+    def __init__(self):
+        self.__subscriptions: dict[str, StatsSubscription] = dict()  # key is node id
+        self.__lock = threading.Lock()
+
+    def subscribe(self, node_id: str):
+        if monitor["backend"] != "docker":
+            return  # the other backends do not use the stats API at all
+        with self.__lock:
+            subscription = self.__subscriptions.get(node_id)
+            if subscription != None and subscription.is_alive():
+                return
+            subscription = StatsSubscription(node_id)
+            self.__subscriptions[node_id] = subscription
+            subscription.start()
+
+    def unsubscribe(self, node_id: str):
+        with self.__lock:
+            subscription = self.__subscriptions.pop(node_id, None)
+        if subscription != None:
+            subscription.close()
+
+    def is_subscribed(self, node_id: str) -> bool:
+        subscription = self.__subscriptions.get(node_id)
+        return subscription != None and subscription.is_alive()
+
+    def get_latest(self, node_id: str) -> dict | None:
+        """Returns the latest sample of a live stream, or None if there is none"""
+        subscription = self.__subscriptions.get(node_id)
+        if subscription == None or not subscription.is_alive():
+            return None
+        return subscription.get_latest()
+
+
+subscriptions = StatsSubscriptions()
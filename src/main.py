@@ -5,6 +5,10 @@ from fastapi import FastAPI, Request
 
 from src.routers import init, internal, job, server, node, pod, elasticity
 from src.internal.monitor import load_monitor
+from src.internal.archive import load_history
+from src.internal.logstore import logs, load_retention
+from src.internal.state import flush_state, load_state, load_state_flush
+from src.routers.job import load_reaper, recover_running_jobs
 
 app = FastAPI()
 
@@ -18,6 +22,7 @@ async def ping() -> str:
 async def add_process_time_header(request: Request, call_next):
     start_time = time.time()
     response = await call_next(request)
+    await flush_state()  # what the request changed is on disk before it returns
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = str(process_time)
     return response
@@ -25,7 +30,14 @@ async def add_process_time_header(request: Request, call_next):
 
 @app.on_event("startup")
 async def startup_event():
+    logs.rebuild()
+    await load_state()
+    await recover_running_jobs()
     asyncio.create_task(load_monitor())
+    asyncio.create_task(load_retention())
+    asyncio.create_task(load_reaper())
+    asyncio.create_task(load_history())
+    asyncio.create_task(load_state_flush())
 
 
 app.include_router(init.router)
@@ -1,5 +1,6 @@
 import random
 import string
+from typing import Literal
 
 from fastapi import APIRouter, Depends
 import httpx
@@ -7,6 +8,8 @@ from src.internal.type import Resp
 from src.routers.node import node_rm, node_register
 from src.utils.config import cluster, cluster_type, address
 from src.internal.auth import verify_setup
+from src.internal.monitor import get_policy
+from src.internal.pool import warm_pool
 
 
 router = APIRouter(tags=["elasticity"])
@@ -24,6 +27,71 @@ async def set_upper_threshold(pod_id: str, upper_threshold: int) -> Resp:
     return Resp(status=True)
 
 
+@router.post("/cloud/elasticity/network/", dependencies=[Depends(verify_setup)])
+async def set_network_threshold(
+    pod_id: str, network_lower_threshold: int, network_upper_threshold: int
+) -> Resp:
+    """Thresholds are in bytes per second per server, an upper of 0 disables them"""
+    if network_lower_threshold < 0 or (
+        network_upper_threshold > 0
+        and network_lower_threshold >= network_upper_threshold
+    ):
+        return Resp(
+            status=False,
+            msg="Invalid network thresholds, lower must be in [0, upper)",
+        )
+    pod = cluster.get_pod_by_id(pod_id)
+    pod.set_network_lower_threshold(network_lower_threshold)
+    pod.set_network_upper_threshold(network_upper_threshold)
+    return Resp(status=True)
+
+
+@router.get("/cloud/elasticity/policy/", dependencies=[Depends(verify_setup)])
+async def get_scaling_policy(pod_id: str) -> Resp:
+    cluster.get_pod_by_id(pod_id)
+    return Resp(status=True, data=get_policy(pod_id).toJSON())
+
+
+@router.post("/cloud/elasticity/policy/", dependencies=[Depends(verify_setup)])
+async def set_scaling_policy(
+    pod_id: str,
+    smoothing: Literal["ewma", "percentile"] | None = None,
+    alpha: float | None = None,
+    window: float | None = None,
+    percentile: float | None = None,
+    scale_up_window: float | None = None,
+    scale_down_window: float | None = None,
+    cooldown: float | None = None,
+    mode: Literal["step", "target"] | None = None,
+    target_utilization: float | None = None,
+) -> Resp:
+    """Only the given parameters are changed, windows and cooldown are in seconds"""
+    cluster.get_pod_by_id(pod_id)
+    policy = get_policy(pod_id)
+    try:
+        if smoothing != None:
+            policy.set_smoothing(smoothing)
+        if alpha != None:
+            policy.set_alpha(alpha)
+        if window != None:
+            policy.set_window(window)
+        if percentile != None:
+            policy.set_percentile(percentile)
+        if scale_up_window != None:
+            policy.set_scale_up_window(scale_up_window)
+        if scale_down_window != None:
+            policy.set_scale_down_window(scale_down_window)
+        if cooldown != None:
+            policy.set_cooldown(cooldown)
+        if mode != None:
+            policy.set_mode(mode)
+        if target_utilization != None:
+            policy.set_target_utilization(target_utilization)
+    except Exception as e:
+        return Resp(status=False, msg=f"cluster: {e}", data=policy.toJSON())
+    return Resp(status=True, data=policy.toJSON())
+
+
 @router.post("/cloud/elasticity/enable/", dependencies=[Depends(verify_setup)])
 async def enable(pod_id: str, min_node: int, max_node: int) -> Resp:
     if (
@@ -37,6 +105,8 @@ async def enable(pod_id: str, min_node: int, max_node: int) -> Resp:
         )
     pod = cluster.get_pod_by_id(pod_id)
     pod.set_is_elastic(True)
+    get_policy(pod_id).reset()
+    await warm_pool.drain(pod_id)
     pod.set_max_nodes(max_node)
     pod.set_min_nodes(min_node)
 
@@ -1,8 +1,26 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from src.internal.type import Resp
-from src.utils.config import cluster, dc, cluster_type
+from src.internal.archive import archive, run
+from src.internal.auth import verify_setup
+from src.internal.cgroup import collector as cgroup_collector
+from src.internal.monitor import policies
+from src.internal.pool import warm_pool
+from src.internal.state import adopt_containers, clear_state
+from src.internal.stats import subscriptions
+from src.internal.logstore import logs, run as run_logs
+from src.utils.config import cluster, adc, cluster_type, job as job_config
+from src.utils.calculate import calculate_job_slots
+from src.utils.labels import list_cluster_containers
+from src.utils.image import (
+    build_cached,
+    pull_cached,
+    EXPRESS_PATH,
+    EXPRESS_REPOSITORY,
+    JOB_RUNNER_PATH,
+    JOB_RUNNER_REPOSITORY,
+)
 
-import shutil
+import asyncio
 import docker.errors
 
 
@@ -16,29 +34,68 @@ async def init(type: str) -> Resp:
         return Resp(status=True, msg="cluster: warning already initialized")
 
     try:
-        dc.images.pull("ubuntu")  # Assume all containers run on Ubuntu
-        dc.images.build(path="example/express", tag="aob-example-express:1.0")
+        # only pulled or built when missing, so a second init takes seconds
+        await pull_cached("ubuntu")  # Assume all containers run on Ubuntu
+        await build_cached(EXPRESS_PATH, EXPRESS_REPOSITORY)
+        # job nodes run on this image, so jobs do not install their tooling
+        await build_cached(JOB_RUNNER_PATH, JOB_RUNNER_REPOSITORY)
 
-        # TODO: do some filtering instead of wiping everything
-        for container in dc.containers.list(all=True):
-            dc.api.stop(container.id)
-            dc.api.remove_container(container.id, force=True)
-
-        try:
-            shutil.rmtree("tmp")
-        except OSError as e:
-            print("tmp was already cleaned")
+        await run_logs(logs.clear)  # the logs live in tmp
+        await run(archive.clear)
 
         cluster.initialize(
             type,
             cpu_limit=cluster_type[type]["cpu"],
             mem_limit=cluster_type[type]["mem"],
+            job_slots=cluster_type[type].get(
+                "job_slots",
+                calculate_job_slots(
+                    cluster_type[type]["cpu"],
+                    cluster_type[type]["mem"],
+                    job_config["slot_cpu"],
+                    job_config["slot_mem"],
+                ),
+            ),
         )
 
-        cluster.set_cpu_available(int(dc.info()["NCPU"]))
-        print(f"Docker CPU available: {dc.info()['NCPU']}")
+        info = await adc.info()
+        cluster.set_cpu_available(int(info["NCPU"]))
+        print(f"Docker CPU available: {info['NCPU']}")
+
+        # Only the containers labelled with this cluster are touched, other
+        # clusters may share the Docker host. The nodes of this cluster type
+        # are adopted, the other containers removed.
+        adopted = await adopt_containers(type)
+        print(f"Adopted {adopted} nodes from their containers")
         return Resp(status=True, msg="cluster: setup completed")
 
     except docker.errors.APIError as e:
         print(e)
         return Resp(status=False, msg="cluster: docker.errors.APIError")
+
+
+@router.delete("/cloud/", dependencies=[Depends(verify_setup)])
+async def reset() -> Resp:
+    """
+    Tears the cluster down: removes all its containers and forgets its pods,
+    nodes, jobs, logs and saved state, init sets it up from scratch again
+    """
+    try:
+        for pod in cluster.get_pods():
+            policies.pop(pod.get_pod_id(), None)
+            await warm_pool.remove_pod(pod.get_pod_id())
+            for node in pod.get_server_nodes():
+                subscriptions.unsubscribe(node.get_node_id())
+                cgroup_collector.forget(node.get_node_id())
+        containers = await list_cluster_containers()
+        await asyncio.gather(*[adc.remove(c["Id"]) for c in containers])
+    except docker.errors.APIError as e:
+        print(e)
+        return Resp(status=False, msg="cluster: docker.errors.APIError")
+
+    cluster.reset()
+    await clear_state()
+    await run(archive.clear)
+    await run_logs(logs.clear)
+    print(f"Reset the cluster, removed {len(containers)} containers")
+    return Resp(status=True, msg="cluster: reset, init it to use it again")
@@ -1,52 +1,42 @@
-import httpx
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
-from src.internal.cluster import ServerNode
 from src.internal.type import Resp
-from src.utils.config import cluster, address
+from src.utils.config import cluster
 from src.internal.auth import verify_setup
+from src.internal.logstore import logs, run
+from src.routers.job import complete_job
 
 
 router = APIRouter(tags=["internal"])
 
 
 class Log(BaseModel):
-    data: str
+    # the launcher streams the output to /internal/log, so this is only set by
+    # callers that send the whole output at the end
+    data: str | None = None
 
 
 @router.post("/internal/callback", dependencies=[Depends(verify_setup)])
-async def callback(job_id: str, node_id: str, exit_code: str, log: Log) -> Resp:
-    # TODO: Handle None output
-    assert address["manager"] != None
-    job = cluster.remove_running_job(job_id)
-    if job == None:
-        raise Exception(
-            f"cluster: job {job_id} received from callback is not in the running list"
-        )
-
-    job.set_completed()
-    node = cluster.get_node_by_id(job.get_node_id())
-    if node == None:
-        raise Exception(f"cluster: node {job.get_node_id()} does not exist")
-    if isinstance(node, ServerNode):
-        raise Exception(f"cluster: node {job.get_node_id()} is not a job node")
-
-    node.set_idle()
-    cluster.add_available_job_node(node)
-
-    with open(f"tmp/{node_id}/{job_id}.log", "w") as f:
-        f.write(log.data if log.data else "")
-
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            address["manager"] + "/internal/callback/",
-            params={"job_id": job_id},
-        )
-        print(r)
-
+async def callback(job_id: str, node_id: str, exit_code: int, log: Log) -> Resp:
+    await complete_job(
+        job_id, node_id, exit_code, log.data.encode() if log.data != None else None
+    )
     return Resp(status=True)
 
 
+@router.post("/internal/log", dependencies=[Depends(verify_setup)])
+async def log_ingest(job_id: str, node_id: str, offset: int, request: Request) -> Resp:
+    """Appends a chunk of output streamed by a running job to its log"""
+    if not cluster.has_running_job(job_id):
+        return Resp(status=False, msg=f"cluster: job {job_id} is not running")
+    try:
+        entry = await run(logs.append, node_id, job_id, offset, await request.body())
+    except Exception as e:
+        print(e)
+        return Resp(status=False, msg=f"cluster: {e}")
+    return Resp(status=True, data=entry.get_offset())
+
+
 @router.get("/internal/available", dependencies=[Depends(verify_setup)])
 async def available() -> Resp:
     return Resp(status=cluster.has_available_job_nodes())
@@ -1,31 +1,118 @@
-from fastapi import APIRouter, Depends, UploadFile
-from src.internal.cluster import Job, ServerNode
-from src.utils.config import cluster, dc, address
+from fastapi import APIRouter, Depends, Response, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from src.internal.cluster import Job, JobNode, ServerNode
+from src.utils.config import cluster, adc, address, job as job_config
+from src.internal.archive import archive, run, sync
 from src.internal.auth import verify_setup
-from src.internal.type import Resp, JobNodeStatus, JobStatus
+from src.internal.logstore import logs, CHUNK_SIZE, run as run_logs
+from src.internal.pool import warm_pool
+from src.internal.type import Resp, JobStatus
+import asyncio
+import docker.errors
+import hashlib
+import httpx
+import io
 import os
 import tarfile
+import time
+from typing import Literal
 
 
 router = APIRouter(tags=["job"])
 
+LOG_INTERVAL = 1  # seconds between two shipments of a running job's output
+WATCH_READ_SIZE = 1024 * 1024  # bytes of output the watcher reads per exec
+WATCH_MAX_FAILURES = 5  # failed checks of an exec in a row before it is lost
+
+tasks: set[asyncio.Task] = set()  # the completion watchers
+
 
 @router.get("/cloud/job/", dependencies=[Depends(verify_setup)])
-async def job_ls(node_id: str | None = None) -> Resp:
-    """monitoring: 3. cloud job ls [NODE_ID]"""
-    rtn = cluster.get_jobs_under_node_id(node_id)
-    return Resp(status=True, data=[j.toJSON() for j in rtn])
+async def job_ls(
+    node_id: str | None = None,
+    status: JobStatus | None = None,
+    start: float | None = None,
+    end: float | None = None,
+    limit: int = 100,
+    offset: int = 0,
+) -> Resp:
+    """
+    monitoring: 3. cloud job ls [NODE_ID]
+
+    Lists the jobs submitted between start and end (unix times), live ones
+    first then the archived ones newest first, a page of limit jobs at a time
+    """
+    await sync()  # so that a job that just finished is found in the archive
+    live = cluster.get_running_jobs(node_id)
+    # the ones being stopped are in neither the running list nor the archive
+    live.extend(cluster.get_stopping_jobs(node_id))
+    if node_id == None:
+        live.extend(cluster.get_pending_jobs())
+    live = [
+        j
+        for j in live
+        if (status == None or j.get_job_status() == status)
+        and (start == None or j.get_created_at() >= start)
+        and (end == None or j.get_created_at() < end)
+    ]
+    rtn = [j.toJSON() for j in live[offset : offset + limit]]
+    total, archived = await run(
+        archive.query,
+        node_id,
+        status,
+        start,
+        end,
+        limit - len(rtn),
+        max(0, offset - len(live)),
+    )
+    rtn.extend(archived)
+    return Resp(status=True, data={"total": len(live) + total, "jobs": rtn})
 
 
 @router.post("/cloud/job/", dependencies=[Depends(verify_setup)])
-async def job_launch(job_name: str, job_id: str, job_script: UploadFile) -> Resp:
-    """management: 6. cloud launch PATH_TO_JOB"""
+async def job_launch(
+    job_name: str,
+    job_id: str,
+    job_script: UploadFile,
+    priority: int = 0,
+    timeout: float | None = None,
+    deadline: float | None = None,
+) -> Resp:
+    """
+    management: 6. cloud launch PATH_TO_JOB
+
+    timeout is how many seconds the job may run for and deadline the unix time
+    it has to be done by, a job that runs out of either is aborted and FAILED
+    """
     # Doing some sanity checks
     assert address["cluster"] != None
     # IMPORTANT: we assume the manager won't create jobs with the same ID!
+    if cluster.has_job(job_id):
+        return Resp(status=False, msg=f"cluster: job {job_id} already exists")
+    reason = check_limits(timeout, deadline)
+    if reason != None:
+        return Resp(status=False, msg=f"cluster: {reason}")
+
+    job = Job(
+        job_name=job_name,
+        job_id=job_id,
+        node_id=None,
+        job_status=JobStatus.REGISTERED,
+        priority=priority,
+        timeout=timeout,
+        deadline=deadline,
+    )
+    script = await job_script.read()
+
+    # Wait in the pending queue until a job node frees up
     if not cluster.has_available_job_nodes():
+        cluster.add_pending_job(job, script)
+        depth = len(cluster.get_pending_jobs())
         return Resp(
-            status=False, msg=f"cluster: unexpected failure there is no available node"
+            status=True,
+            msg=f"cluster: job {job_id} queued, there is no available node",
+            data={"queued": True, "depth": depth},
         )
 
     try:
@@ -34,104 +121,668 @@ async def job_launch(job_name: str, job_id: str, job_script: UploadFile) -> Resp
         print(e)
         return Resp(status=False, msg=f"cluster: unexpected failure {e}")
 
-    if node.get_node_status() != JobNodeStatus.IDLE:
-        return Resp(
-            status=False, msg="cluster: unexpected failure the node is not IDLE"
+    try:
+        await launch_job(node, job, script)
+    except Exception as e:
+        print(e)
+        cluster.release_job_slot(node)
+        return Resp(status=False, msg=f"cluster: unexpected failure {e}")
+
+    return Resp(
+        status=True,
+        msg=f"cluster: job {job_id} launched on node {node.get_node_name()}",
+        data={
+            "node_id": node.get_node_id(),
+            "node_name": node.get_node_name(),
+            "pod_id": node.get_pod_id(),
+        },
+    )
+
+
+def check_limits(timeout: float | None, deadline: float | None) -> str | None:
+    """Returns why the time limits of a job are invalid, if they are"""
+    if timeout != None and timeout <= 0:
+        return "timeout must be positive"
+    if deadline != None and deadline <= time.time():
+        return "deadline has already passed"
+    return None
+
+
+class BatchJob(BaseModel):
+    job_id: str
+    job_name: str | None = None  # defaults to the job id
+    script: str | None = None  # defaults to the script of the batch
+
+
+class Batch(BaseModel):
+    # either one script for all the job ids, or jobs that bring their own
+    script: str | None = None
+    job_name: str | None = None  # name of the job ids, defaults to each job id
+    job_ids: list[str] = []
+    jobs: list[BatchJob] = []
+    priority: int = 0
+    timeout: float | None = None  # same as for a single job, applies to each
+    deadline: float | None = None
+    # what happens to the jobs that do not fit on the available nodes
+    overflow: Literal["queue", "reject"] = "queue"
+
+
+@router.post("/cloud/job/batch/", dependencies=[Depends(verify_setup)])
+async def job_launch_batch(batch: Batch) -> Resp:
+    """Launches many jobs in one request, what does not fit is queued or rejected"""
+    assert address["cluster"] != None
+    reason = check_limits(batch.timeout, batch.deadline)
+    if reason != None:
+        return Resp(status=False, msg=f"cluster: {reason}")
+    shared = batch.script.encode() if batch.script != None else None
+    entries = [
+        BatchJob(job_id=job_id, job_name=batch.job_name) for job_id in batch.job_ids
+    ] + batch.jobs
+
+    launched: list[tuple[Job, JobNode, bytes]] = []
+    queued: list[str] = []
+    rejected: list[dict] = []
+    seen: set[str] = set()
+    for entry in entries:
+        reason = None
+        if cluster.has_job(entry.job_id) or entry.job_id in seen:
+            reason = f"job {entry.job_id} already exists"
+        elif entry.script == None and shared == None:
+            reason = f"job {entry.job_id} has no script"
+        if reason != None:
+            rejected.append({"job_id": entry.job_id, "reason": reason})
+            continue
+        seen.add(entry.job_id)
+
+        job = Job(
+            job_name=entry.job_name if entry.job_name != None else entry.job_id,
+            job_id=entry.job_id,
+            node_id=None,
+            job_status=JobStatus.REGISTERED,
+            priority=batch.priority,
+            timeout=batch.timeout,
+            deadline=batch.deadline,
         )
+        # the jobs of the shared script all point to the same bytes
+        script = entry.script.encode() if entry.script != None else shared
+        if cluster.has_available_job_nodes():
+            node = cluster.pop_available_job_node()
+            launched.append((job, node, script))
+        elif batch.overflow == "queue":
+            cluster.add_pending_job(job, script)
+            queued.append(entry.job_id)
+        else:
+            rejected.append(
+                {"job_id": entry.job_id, "reason": "there is no available node"}
+            )
+
+    # The jobs packed on the same node share one upload, the nodes are
+    # launched side by side
+    by_node: dict[str, list[tuple[Job, bytes]]] = dict()
+    nodes: dict[str, JobNode] = dict()
+    for job, node, script in launched:
+        by_node.setdefault(node.get_node_id(), []).append((job, script))
+        nodes[node.get_node_id()] = node
+    results = await asyncio.gather(
+        *[launch_jobs(nodes[node_id], jobs) for node_id, jobs in by_node.items()]
+    )
+    failures: dict[str, Exception] = dict()  # key is the job id
+    for jobs, errors in zip(by_node.values(), results):
+        for (job, _), error in zip(jobs, errors):
+            if error != None:
+                failures[job.get_job_id()] = error
+    placed = []
+    for job, node, _ in launched:
+        error = failures.get(job.get_job_id())
+        if error != None:
+            print(f"Failed to launch job {job.get_job_id()}: {error}")
+            job.set_failed()
+            cluster.add_finished_job(job)
+            cluster.release_job_slot(node)
+            rejected.append({"job_id": job.get_job_id(), "reason": str(error)})
+            continue
+        placed.append({"job_id": job.get_job_id(), "node_id": node.get_node_id()})
+
+    return Resp(
+        status=len(rejected) == 0,
+        msg=f"cluster: {len(placed)} jobs launched, {len(queued)} queued and {len(rejected)} rejected",
+        data={"launched": placed, "queued": queued, "rejected": rejected},
+    )
+
 
-    # Passed all sanity checks, now we can prepare the job scripts
+def build_archive(files: dict[str, bytes]) -> bytes:
+    """Packs the files as executables into an in-memory tar, keyed by their path"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = 0o755
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+async def launch_job(node: JobNode, job: Job, script: bytes):
+    """Runs the job on a node it took a slot of"""
+    error = (await launch_jobs(node, [(job, script)]))[0]
+    if error != None:
+        raise error
+
+
+async def launch_jobs(
+    node: JobNode, entries: list[tuple[Job, bytes]]
+) -> list[Exception | None]:
+    """
+    Runs jobs on a node they each took a slot of, their files are uploaded in
+    one go before their execs start. Returns what the launch of each job
+    failed with, None if it started. The caller gives back the failed slots.
+    """
     script_path = os.path.join("tmp", node.get_node_id())
-    os.makedirs(script_path, exist_ok=True)
-    with open(os.path.join(script_path, f"{job_id}.sh"), "wb") as f:
-        f.write(await job_script.read())
-    with open(os.path.join(script_path, "launcher.sh"), "w") as f:
-        script = f"""
-apt-get update && apt install curl jq -y
-chmod +x {script_path+"/"+job_id}.sh
-output=$(./{script_path+"/"+job_id}.sh)
+    launcher_file = os.path.join(script_path, "launcher.sh")
+    files = {}
+    if not node.has_uploaded(launcher_file):
+        # the same for every job on the node, it takes the job id and script
+        files[launcher_file] = build_launcher(node).encode()
+    script_files = []
+    digests: dict[int, str] = dict()  # the jobs of a batch share their bytes
+    for job, script in entries:
+        # Keep the script for auditing, under the job id
+        if job_config["audit_scripts"]:
+            os.makedirs(script_path, exist_ok=True)
+            with open(os.path.join(script_path, f"{job.get_job_id()}.sh"), "wb") as f:
+                f.write(script)
+
+        # Scripts are stored in the container by content, so jobs that share
+        # a script (a batch) only upload it once per container
+        if id(script) not in digests:
+            digests[id(script)] = hashlib.sha256(script).hexdigest()[:16]
+        script_file = os.path.join(script_path, digests[id(script)] + ".sh")
+        files[script_file] = script
+        script_files.append(script_file)
+
+        # Add the job to the cluster
+        job.set_running(node.get_node_id())
+        node.add_job(job)
+        cluster.add_running_job(job)
+
+    try:
+        await upload(node, files)
+    except Exception as e:
+        for job, _ in entries:
+            unplace_job(node, job)
+        return [e] * len(entries)
+    results = await asyncio.gather(
+        *[
+            start_job(node, job, launcher_file, script_file)
+            for (job, _), script_file in zip(entries, script_files)
+        ],
+        return_exceptions=True,
+    )
+    return [result if isinstance(result, Exception) else None for result in results]
+
+
+async def upload(node: JobNode, files: dict[str, bytes]):
+    """
+    Puts the files the container of the node does not have yet in it. Launches
+    on the same node wait for the upload in flight, so a file is uploaded once
+    and never replaced while a job may be starting from it.
+    """
+    async with node.get_upload_lock():
+        files = {p: data for p, data in files.items() if not node.has_uploaded(p)}
+        if len(files) == 0:
+            return
+        await adc.put_archive(node.get_container_id(), "/", build_archive(files))
+        for path in files:
+            node.add_uploaded(path)
+
+
+async def start_job(node: JobNode, job: Job, launcher_file: str, script_file: str):
+    """Starts the launcher of a job whose files are in the container"""
+    try:
+        # setsid puts the launcher and the job in their own process group, so
+        # an abort can signal all of them at once. The exec is already a
+        # session leader, so setsid forks, --wait keeps the exec alive (and
+        # its exit code the launcher's) until the job is over
+        exec_id = await adc.exec_start(
+            node.get_container_id(),
+            [
+                "setsid",
+                "--wait",
+                "/bin/bash",
+                launcher_file,
+                job.get_job_id(),
+                script_file,
+            ],
+        )
+    except Exception:
+        unplace_job(node, job)
+        raise
+    job.set_exec_id(exec_id)
+    if job_config["completion"] == "watch":
+        spawn(watch_job(node, job))
+
+
+def unplace_job(node: JobNode, job: Job):
+    """Takes a job that never started off its node, the caller gives the slot back"""
+    cluster.remove_running_job(job.get_job_id(), finished=False)
+    node.remove_job(job.get_job_id())
+
+
+def spawn(coroutine):
+    # keep a reference, the event loop only holds weak ones to its tasks
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+async def watch_job(node: JobNode, job: Job):
+    """
+    Follows the exec of a job through the Docker API until it exits, then
+    reads its output into the log and completes it like the callback. One
+    inspect per running job and watch interval, the Docker calls are bounded
+    by adc. A job whose exec is lost is FAILED.
+    """
+    job_id = job.get_job_id()
+    try:
+        state = await wait_exec(job)
+    except Exception as e:
+        if cluster.has_running_job(job_id):
+            print(f"Job {job_id} is lost: {e}")
+            fail_lost_job(node, job)
+            await dispatch_pending_jobs()
+        return
+    if state == None:
+        return  # aborted or out of time
+    entry = logs.get(job_id)  # the chunks the launcher shipped, if it did
+    offset = entry.get_offset() if entry != None else None
+    await read_output(node, job_id, offset if offset != None else 0)
+    if cluster.has_running_job(job_id):
+        await remove_job_files(node, job_id)
+        await complete_job(job_id, node.get_node_id(), state["ExitCode"])
+
+
+async def wait_exec(job: Job, while_running: bool = True) -> dict | None:
+    """
+    Inspects the exec of a job every watch interval until it exits, returns
+    its last state. With while_running, returns None once the job left the
+    running list. Raises if the exec is lost: the daemon does not know it (it
+    was restarted) or WATCH_MAX_FAILURES checks in a row failed.
+    """
+    job_id = job.get_job_id()
+    failures = 0
+    while True:
+        await asyncio.sleep(job_config["watch_interval"])
+        if while_running and not cluster.has_running_job(job_id):
+            return None
+        if job.get_exec_id() == None:
+            raise Exception("it was never started")
+        try:
+            state = await adc.exec_inspect(job.get_exec_id())
+        except docker.errors.NotFound:
+            raise
+        except Exception as e:
+            failures += 1
+            print(f"Failed to check on job {job_id} ({failures} in a row): {e}")
+            if failures >= WATCH_MAX_FAILURES:
+                raise
+            continue
+        failures = 0
+        if not state["Running"]:
+            return state
+
+
+def fail_lost_job(node: JobNode, job: Job):
+    """Fails a running job whose exec is gone and gives its slot back"""
+    cluster.remove_running_job(job.get_job_id())
+    job.set_failed()
+    node.finish_job(job.get_job_id())
+    cluster.release_job_slot(node)
+
+
+async def read_output(node: JobNode, job_id: str, offset: int) -> int:
+    """Appends the output the job wrote since offset to its log, returns the new offset"""
+    output = os.path.join("tmp", node.get_node_id(), f"{job_id}.out")
+    while True:
+        exit_code, data = await adc.exec_run(
+            node.get_container_id(),
+            [
+                "/bin/bash",
+                "-c",
+                f"[ -f {output} ] && tail -c +{offset + 1} {output} | head -c {WATCH_READ_SIZE}",
+            ],
+        )
+        if exit_code != 0 or len(data) == 0:
+            return offset
+        await run_logs(logs.append, node.get_node_id(), job_id, offset, data)
+        offset += len(data)
+        if len(data) < WATCH_READ_SIZE:
+            return offset
+
+
+async def remove_job_files(node: JobNode, job_id: str):
+    """Removes the output and pid files the launcher of a job left in its container"""
+    path = os.path.join("tmp", node.get_node_id(), job_id)
+    try:
+        await adc.exec_run(
+            node.get_container_id(),
+            ["rm", "-f", f"{path}.out", f"{path}.out.chunk", f"{path}.pid"],
+        )
+    except Exception as e:
+        print(f"Failed to remove the files of job {job_id}: {e}")
+
+
+async def complete_job(
+    job_id: str, node_id: str, exit_code: int, log: bytes | None = None
+):
+    """
+    Frees the slot of a job that exited, from the callback or the watcher. It
+    is COMPLETED if its script exited with 0, FAILED otherwise.
+    """
+    assert address["manager"] != None
+    if not cluster.has_running_job(job_id):
+        # aborted or out of time, its slot is freed when it is stopped
+        print(f"Ignoring the exit of job {job_id}, it was stopped")
+        return
+    job = cluster.remove_running_job(job_id)
+
+    job.set_exited(exit_code)
+    node = cluster.get_node_by_id(job.get_node_id())
+    if node == None:
+        raise Exception(f"cluster: node {job.get_node_id()} does not exist")
+    if isinstance(node, ServerNode):
+        raise Exception(f"cluster: node {job.get_node_id()} is not a job node")
+
+    node.finish_job(job_id)
+    cluster.release_job_slot(node)
+
+    if log != None:
+        await run_logs(logs.write, node_id, job_id, log)
+    else:
+        await run_logs(logs.touch, node_id, job_id)
+
+    await dispatch_pending_jobs()
+
+    async with httpx.AsyncClient() as client:
+        r = await client.post(
+            address["manager"] + "/internal/callback/",
+            params={"job_id": job_id},
+        )
+        print(r)
+
+
+def build_launcher(node: JobNode) -> str:
+    """
+    The launcher runs the job with its output going to a file in the container
+    and ships it to the cluster in chunks while the job runs, the callback only
+    carries the exit code. Once the callback went through it removes its files.
+    With the completion watcher it only runs the job, the watcher reads the
+    output and removes the files. Either way it exits with the exit code of the
+    job, so does its exec.
+    Usage: launcher.sh JOB_ID SCRIPT
+    """
+    if job_config["completion"] == "watch":
+        # the cluster reads the output and the exit code through the exec
+        return f"""
+job_id=$1
+echo $$ > "{os.path.join("tmp", node.get_node_id())}/$job_id.pid"
+./$2 > "{os.path.join("tmp", node.get_node_id())}/$job_id.out" 2>&1
+"""
+    base = f"http://host.docker.internal:{address['cluster'].split(':')[2]}/internal"
+    return f"""
+job_id=$1
+query="job_id=$job_id&node_id={node.get_node_id()}"
+output="{os.path.join("tmp", node.get_node_id())}/$job_id.out"
+pid_file="{os.path.join("tmp", node.get_node_id())}/$job_id.pid"
+echo $$ > "$pid_file"
+./$2 > "$output" 2>&1 &
+pid=$!
+offset=0
+ship() {{
+  while [ "$(stat -c %s "$output")" -gt "$offset" ]; do
+    tail -c +$((offset + 1)) "$output" | head -c {CHUNK_SIZE} > "$output.chunk"
+    curl -sf -X 'POST' "{base}/log?$query&offset=$offset" -H 'Content-Type: application/octet-stream' --data-binary @"$output.chunk" > /dev/null || return
+    offset=$((offset + $(stat -c %s "$output.chunk")))
+  done
+}}
+while kill -0 $pid 2> /dev/null; do
+  ship
+  sleep {LOG_INTERVAL}
+done
+wait $pid
 exit_code=$?
-json_payload=$(echo '{{}}' | jq --arg output "$output" '.data = $output')
-curl -X 'POST' "http://host.docker.internal:{address["cluster"].split(":")[2]}/internal/callback?job_id={job_id}&node_id={node.get_node_id()}&exit_code=$exit_code" -H 'accept: application/json' -H 'Content-Type: application/json' -d "$json_payload"
+ship
+# kept if the callback failed, the cluster reads the output when it recovers the job
+curl -sf -X 'POST' "{base}/callback?$query&exit_code=$exit_code" -H 'accept: application/json' -H 'Content-Type: application/json' -d '{{}}' > /dev/null && rm -f "$output" "$output.chunk" "$pid_file"
+exit $exit_code
 """
-        f.write(script)
 
-    with tarfile.open(os.path.join(script_path, f"{job_id}.tar"), "w") as tar:
-        tar.add(os.path.join(script_path, f"{job_id}.sh"))
-        tar.add(os.path.join(script_path, "launcher.sh"))
 
-    # Add the job to the cluster
-    job = Job(
-        job_name=job_name,
-        job_id=job_id,
-        node_id=node.get_node_id(),
-        job_status=JobStatus.RUNNING,
-    )
+async def kill_job(node: JobNode, job: Job) -> bool:
+    """
+    Stops the job by signalling the process group of its launcher, SIGTERM
+    first and SIGKILL if it is still there after the abort timeout. Returns
+    False if the job could not be confirmed dead.
+    """
+    pid_file = os.path.join("tmp", node.get_node_id(), f"{job.get_job_id()}.pid")
+    steps = max(1, int(job_config["abort_timeout"] * 10))
+    # kill -0 also sees zombies, so look for live members of the group in /proc
+    script = f"""
+pgid=$(cat {pid_file}) || exit 1
+alive() {{
+  for stat in /proc/[0-9]*/stat; do
+    fields=$(cat $stat 2> /dev/null) || continue
+    set -- ${{fields##*) }}
+    [ "$3" = "$pgid" ] && [ "$1" != Z ] && return 0
+  done
+  return 1
+}}
+kill -TERM -- -$pgid 2> /dev/null || exit 0
+for i in $(seq {steps}); do
+  alive || exit 0
+  sleep 0.1
+done
+kill -KILL -- -$pgid 2> /dev/null
+sleep 0.1
+! alive
+"""
     try:
-        node.add_job(job)
-        cluster.add_running_job(job)
-        node.set_running()
+        exit_code, _ = await adc.exec_run(
+            node.get_container_id(), ["/bin/bash", "-c", script]
+        )
     except Exception as e:
-        print(e)
-        return Resp(status=False, msg=f"cluster: unexpected failure {e}")
+        print(f"Failed to kill job {job.get_job_id()}: {e}")
+        return False
+    return exit_code == 0
 
-    # Launch the job in the Docker container
-    container = dc.containers.get(node.get_node_id())
-    with open(os.path.join(script_path, f"{job_id}.tar"), "rb") as tar:
-        container.put_archive("/", tar)  # type: ignore
 
-    launcher = os.path.join(script_path, "launcher.sh")
-    container.exec_run(["/bin/bash", "-c", f"chmod +x {launcher}"], detach=True)  # type: ignore
-    container.exec_run(["/bin/bash", "-c", f"{launcher}"], detach=True)  # type: ignore
+async def dispatch_pending_jobs():
+    """Hands pending jobs to the available job nodes, called when a node frees up"""
+    while cluster.has_pending_jobs() and cluster.has_available_job_nodes():
+        job, script = cluster.pop_pending_job()
+        node = cluster.pop_available_job_node()
+        try:
+            await launch_job(node, job, script)
+            print(f"Dispatched pending job {job.get_job_id()} to {node.get_node_id()}")
+        except Exception as e:
+            print(f"Failed to dispatch pending job {job.get_job_id()}: {e}")
+            job.set_failed()
+            cluster.add_finished_job(job)  # it was accepted, so it stays listed
+            cluster.release_job_slot(node)
+
 
+@router.get("/cloud/job/queue/", dependencies=[Depends(verify_setup)])
+async def job_queue() -> Resp:
+    """Lists the pending jobs in the order they will be dispatched"""
+    pending = cluster.get_pending_jobs()
     return Resp(
         status=True,
-        msg=f"cluster: job {job_id} launched on node {node.get_node_name()}",
-        data={
-            "node_id": node.get_node_id(),
-            "node_name": node.get_node_name(),
-            "pod_id": node.get_pod_id(),
-        },
+        data={"depth": len(pending), "jobs": [j.toJSON() for j in pending]},
     )
 
 
+@router.delete("/cloud/job/queue/", dependencies=[Depends(verify_setup)])
+async def job_cancel(job_id: str) -> Resp:
+    """Cancels a job that is still waiting in the pending queue"""
+    try:
+        job = cluster.remove_pending_job(job_id)
+    except Exception as e:
+        print(e)
+        return Resp(status=False, msg=f"cluster: {e}")
+    job.set_aborted()
+    return Resp(status=True, msg=f"cluster: queued job {job_id} cancelled")
+
+
+async def stop_running_job(job_id: str) -> Job:
+    """Kills a running job and hands its node back, the caller sets the status"""
+    job = cluster.remove_running_job(job_id)
+    node = cluster.get_node_by_id(job.get_node_id())
+    if isinstance(node, ServerNode):
+        raise Exception(f"node {node.get_node_id()} is not a job node")
+    # Only when the job cannot be killed, swap in a warm container or restart
+    # this one, both take far longer than a signal. Not while other jobs run
+    # on the node, they would be killed along with it: the job keeps its slot
+    # until it exits instead, so the node is not oversubscribed.
+    held = False
+    try:
+        if not await kill_job(node, job):
+            if len(node.get_running_jobs()) > 1:
+                print(f"Job {job_id} did not stop, node {node.get_node_id()} is busy")
+                held = True
+            else:
+                print(f"Job {job_id} did not stop, replacing its container")
+                try:
+                    if not await warm_pool.swap(node):
+                        await adc.restart(node.get_container_id())
+                except Exception as e:
+                    print(
+                        f"Failed to replace the container of {node.get_node_id()}: {e}"
+                    )
+    finally:
+        if held:
+            spawn(release_when_exited(node, job))
+        else:
+            node.finish_job(job_id)
+            cluster.release_job_slot(node)
+    if not held:
+        await remove_job_files(node, job_id)
+    return job
+
+
+async def release_when_exited(node: JobNode, job: Job):
+    """Holds the slot of a job that could not be killed until its exec exits"""
+    job_id = job.get_job_id()
+    try:
+        await wait_exec(job, while_running=False)
+        print(f"Job {job_id} exited, its slot on {node.get_node_id()} is free")
+    except Exception as e:
+        print(f"Job {job_id} is lost, freeing its slot on {node.get_node_id()}: {e}")
+    node.finish_job(job_id)
+    cluster.release_job_slot(node)
+    await remove_job_files(node, job_id)
+    await dispatch_pending_jobs()
+
+
 @router.delete("/cloud/job/", dependencies=[Depends(verify_setup)])
 async def job_abort(job_id: str) -> Resp:
     """management: 7. cloud abort JOB_ID"""
-    # TODO: Actually abort the job in the Docker container
     try:
-        job = cluster.remove_running_job(job_id)
+        job = await stop_running_job(job_id)
         job.set_aborted()
-        node = cluster.get_node_by_id(job.get_node_id())
-        if isinstance(node, ServerNode):
-            return Resp(
-                status=False,
-                msg=f"cluster: node {node.get_node_id()} is not a job node",
-            )
-        container = dc.containers.get(node.get_node_id())
-        container.restart()  # type: ignore
-        cluster.add_available_job_node(node)
     except Exception as e:
         print(e)
         return Resp(status=False, msg=f"cluster: {e}")
 
+    await dispatch_pending_jobs()
     return Resp(status=True, msg=f"cluster: job {job_id} aborted")
 
 
+async def reap_expired_jobs():
+    """Fails the jobs that ran out of time, running or still waiting for a node"""
+    now = time.time()
+    for job in cluster.pop_expired_pending_jobs(now):
+        print(f"Job {job.get_job_id()} missed its deadline in the queue")
+        job.set_failed()
+
+    expired = cluster.pop_expired_jobs(now)
+    for job in expired:
+        print(f"Job {job.get_job_id()} ran out of time, aborting it")
+    results = await asyncio.gather(
+        *[stop_running_job(job.get_job_id()) for job in expired],
+        return_exceptions=True,
+    )
+    for job, result in zip(expired, results):
+        if isinstance(result, Exception):
+            print(f"Failed to stop job {job.get_job_id()}: {result}")
+        job.set_failed()
+    if len(expired) > 0:
+        await dispatch_pending_jobs()
+
+
+async def recover_running_jobs():
+    """
+    Takes over the jobs that were still running when the cluster restarted. A
+    job whose exec ended meanwhile lost its callback, so the watcher completes
+    it with the exit code of the exec. One that still runs calls back as
+    usual, or is watched if that is the completion mode.
+    """
+    for job in cluster.get_running_jobs():
+        node = cluster.get_node_by_id(job.get_node_id())
+        assert isinstance(node, JobNode)
+        try:
+            if job.get_exec_id() == None:
+                raise Exception("it was never started")
+            state = await adc.exec_inspect(job.get_exec_id())
+        except Exception as e:
+            print(f"Job {job.get_job_id()} cannot be recovered: {e}")
+            fail_lost_job(node, job)
+            continue
+        if state["Running"] and job_config["completion"] != "watch":
+            continue  # its launcher calls back when it exits
+        spawn(watch_job(node, job))
+    await dispatch_pending_jobs()  # the slots freed while the cluster was down
+
+
+async def load_reaper():
+    while True:
+        await asyncio.sleep(job_config["reaper_interval"])
+        if cluster.is_initialized():
+            await reap_expired_jobs()
+
+
 @router.get("/cloud/job/log/", dependencies=[Depends(verify_setup)])
-async def job_log(job_id: str) -> Resp:
+async def job_log(
+    job_id: str, offset: int = 0, limit: int | None = None, follow: bool = False
+) -> Response:
     """monitoring: 4. cloud job log JOB_ID"""
-    log = ""
-    found = False
-    for root, _, files in os.walk("tmp/"):
-        for file in files:
-            if file == job_id + ".log":
-                with open(os.path.join(root, file), "r") as f:
-                    log = f.read()
-                    found = True
-    if not found:
+    entry = logs.get(job_id)
+    if follow and cluster.has_running_job(job_id):
+        return StreamingResponse(
+            follow_log(job_id, offset, limit), media_type="text/plain"
+        )
+    if entry == None:
         return Resp(
             status=False,
             msg=f"cluster: no log found for job {job_id}",
             data=f"no log found for job {job_id}",
         )
-    return Resp(status=True, data=log)
+    return StreamingResponse(
+        logs.iter_range(entry, offset, limit), media_type="text/plain"
+    )
+
+
+async def follow_log(job_id: str, offset: int, limit: int | None):
+    """Streams the log of a running job as it grows, until the job is over"""
+    while limit == None or limit > 0:
+        # checked before reading so the last chunks are sent once the job is over
+        running = cluster.has_running_job(job_id)
+        entry = logs.get(job_id)
+        if entry != None:
+            for data in logs.iter_range(entry, offset, limit):
+                offset += len(data)
+                if limit != None:
+                    limit -= len(data)
+                yield data
+        if not running:
+            return
+        await asyncio.sleep(LOG_INTERVAL)
@@ -1,13 +1,20 @@
-import os
 from typing import Literal
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Response
+from fastapi.responses import StreamingResponse
 import docker.errors
 
 from src.internal.type import Resp
-from src.internal.cluster import JobNode, ServerNode
-from src.utils.config import cluster, dc, cluster_type
+from src.internal.cluster import JobNode, Pod, ServerNode
+from src.utils.config import cluster, adc, cluster_type
+from src.internal.pool import create_job_container, warm_pool
 from src.internal.auth import verify_setup
+from src.internal.logstore import logs
+from src.internal.stats import subscriptions
+from src.internal.cgroup import collector as cgroup_collector
+from src.utils.image import express_image
+from src.utils.labels import container_labels
+from src.routers.job import dispatch_pending_jobs
 
 
 router = APIRouter(tags=["node"])
@@ -71,80 +78,87 @@ async def node_register(
         )
 
     allowed_amount = cluster_type[cluster.get_type()]["node_limit"]
-    current_amount = len(pod.get_nodes())
+    current_amount = len(pod.get_nodes()) + cluster.get_registering(pod_id)
     if current_amount >= allowed_amount:
         return Resp(
             status=False,
             msg=f"cluster: node limit reached for pod with id {pod_id}",
         )
 
+    # Hold the name and a place under the limit until the node is added,
+    # registrations running side by side would all pass the checks otherwise
+    cluster.reserve_node(node_name, pod_id)
     try:
-        container = None
-        port = None
-        node = None
-        if node_type == "job":
-            container = dc.api.create_container(
-                image="ubuntu",
-                name=f"{pod_id}_{node_name}",
-                command=["tail", "-f", "/dev/null"],  # keep it running
-                detach=True,
-                host_config=dc.api.create_host_config(
-                    extra_hosts={"host.docker.internal": "host-gateway"}
-                ),
-            )
-            print("ID: " + container.get("Id"))
-            container = dc.containers.get(container.get("Id"))
-            container.start()  # type: ignore
-            node = JobNode(
-                node_name=node_name,
-                node_id=container.id[0:12],  # type: ignore
-                pod_id=pod_id,
-            )  # type: ignore
-        elif node_type == "server":
-            port = cluster.get_available_port()
-            img = dc.images.get("aob-example-express:1.0")
-            identifier = f"{cluster.get_type()}_{pod_id}_{node_name}"
-            container = dc.containers.create(
-                image=img,
-                name=f"{pod_id}_{node_name}",
-                command=[
-                    "node",
-                    "app.js",
-                    identifier,
-                ],
-                detach=True,
-                ports={3000: port},
-                nano_cpus=int(cluster.get_cpu_limit() * 1000000000),
-                mem_limit=str(cluster.get_mem_limit()) + "m",
-            )
-            print(f"{identifier} registered on port: {port}")
-            node = ServerNode(
-                node_name=node_name,
-                node_id=container.id[0:12],  # type: ignore
-                pod_id=pod_id,
-                port=port,
-            )  # type: ignore
-
-        assert container != None  # type: ignore
-
+        node = await create_node(pod, node_name, node_type)
         try:
             pod.add_node(node)
             cluster.add_node(node)
             if isinstance(node, JobNode):
                 cluster.add_available_job_node(node)
+                warm_pool.schedule_refill(pod)
         except Exception as e:
             print(e)
             return Resp(status=False, msg=f"cluster: {e}")
-
-        return Resp(
-            status=True,
-            msg=f"cluster: node {node_name} created in pod with id {pod.get_pod_id()}",
-            data=node.get_node_id(),
-        )
-
     except docker.errors.APIError as e:
         print(e)
         return Resp(status=False, msg=f"cluster: docker.errors.APIError")
+    finally:
+        cluster.release_node(node_name, pod_id)
+
+    await dispatch_pending_jobs()
+    return Resp(
+        status=True,
+        msg=f"cluster: node {node_name} created in pod with id {pod.get_pod_id()}",
+        data=node.get_node_id(),
+    )
+
+
+async def create_node(
+    pod: Pod, node_name: str, node_type: Literal["job", "server"]
+) -> JobNode | ServerNode:
+    """Creates the container of a node, the node is not added to the cluster"""
+    pod_id = pod.get_pod_id()
+    if node_type == "job":
+        container = warm_pool.take(pod_id)
+        if container == None:
+            container = await create_job_container(
+                f"{pod_id}_{node_name}", container_labels(pod, "job", node_name)
+            )
+        else:
+            try:
+                await adc.rename(container, f"{pod_id}_{node_name}")
+            except Exception:
+                warm_pool.put_back(pod_id, container)  # still warm, not a node
+                raise
+        return JobNode(
+            node_name=node_name,
+            node_id=container,
+            pod_id=pod_id,
+            slots=cluster.get_job_slots(),
+        )
+
+    port = cluster.get_available_port()
+    identifier = f"{cluster.get_type()}_{pod_id}_{node_name}"
+    container = await adc.create(
+        express_image(),
+        f"{pod_id}_{node_name}",
+        [
+            "node",
+            "app.js",
+            identifier,
+        ],
+        ports={3000: port},
+        nano_cpus=int(cluster.get_cpu_limit() * 1000000000),
+        mem_limit=str(cluster.get_mem_limit()) + "m",
+        labels=container_labels(pod, "server", node_name, port),
+    )
+    print(f"{identifier} registered on port: {port}")
+    return ServerNode(
+        node_name=node_name,
+        node_id=container,
+        pod_id=pod_id,
+        port=port,
+    )
 
 
 @router.delete("/cloud/node/", dependencies=[Depends(verify_setup)])
@@ -158,7 +172,7 @@ async def node_rm(node_id: str) -> Resp:
         return Resp(status=False, msg=f"cluster: {e}")
 
     try:
-        dc.api.remove_container(container=node_id, force=True)
+        await adc.remove(node.get_container_id())
 
         data = {"delete": False}
         try:
@@ -167,6 +181,8 @@ async def node_rm(node_id: str) -> Resp:
             if isinstance(node, JobNode):
                 cluster.remove_available_job_node(node)
             else:
+                subscriptions.unsubscribe(node_id)
+                cgroup_collector.forget(node_id)
                 data["delete"] = True
         except Exception as e:
             print(e)
@@ -183,20 +199,13 @@ async def node_rm(node_id: str) -> Resp:
 
 
 @router.get("/cloud/node/log/", dependencies=[Depends(verify_setup)])
-async def node_log(node_id: str) -> Resp:
+async def node_log(node_id: str) -> Response:
     """monitoring: 5. cloud node log NODE_ID"""
-    log = ""
-    found = False
-    for root, _, files in os.walk("tmp/" + node_id):
-        for file in files:
-            if file.endswith(".log"):
-                with open(os.path.join(root, file), "r") as f:
-                    log += "\n" + f.read()
-                    found = True
-    if not found:
+    entries = logs.get_node_entries(node_id)
+    if len(entries) == 0:
         return Resp(
             status=False,
             msg=f"cluster: no log found for node {node_id}",
             data=f"no log found for node {node_id}",
         )
-    return Resp(status=True, data=log)
+    return StreamingResponse(logs.iter_node(node_id), media_type="text/plain")
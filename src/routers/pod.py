@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends
 from src.internal.type import Resp
 from src.internal.cluster import Pod
-from src.utils.config import cluster
+from src.utils.config import cluster, cluster_type
 from src.internal.auth import verify_setup
+from src.internal.monitor import policies
+from src.internal.pool import warm_pool
 
 
 router = APIRouter(tags=["pod"])
@@ -20,6 +22,8 @@ async def pod_ls():
                 pod_type=cluster.get_type(),
                 is_elastic=pod.get_is_elastic(),
                 usage=pod.get_usage(),
+                network_in_rate=pod.get_network_in_rate(),
+                network_out_rate=pod.get_network_out_rate(),
                 total_nodes=len(pod.get_nodes()),
             )
         )
@@ -67,8 +71,32 @@ async def pod_rm(pod_id: str):
     # Remove pod
     try:
         cluster.remove_pod_by_id(pod.get_pod_id())
+        policies.pop(pod.get_pod_id(), None)
+        await warm_pool.remove_pod(pod.get_pod_id())
     except Exception as e:
         print(e)
         return Resp(status=False, msg=f"cluster: {e}")
 
     return Resp(status=True, msg=f"cluster: pod {pod_id} is removed from pods")
+
+
+@router.post("/cloud/pod/pool/", dependencies=[Depends(verify_setup)])
+async def pod_pool(pod_id: str, size: int):
+    """Sets how many warm job containers the pod keeps around"""
+    try:
+        pod = cluster.get_pod_by_id(pod_id)
+    except Exception as e:
+        print(e)
+        return Resp(status=False, msg=f"cluster: {e}")
+
+    if size < 0 or size > cluster_type[cluster.get_type()]["node_limit"]:
+        return Resp(
+            status=False,
+            msg="cluster: invalid pool size, it must fit in [0, node limit]",
+        )
+
+    warm_pool.set_size(pod_id, size)
+    if warm_pool.get_warm(pod_id) > size:
+        await warm_pool.drain(pod_id)
+    warm_pool.schedule_refill(pod)
+    return Resp(status=True, msg=f"cluster: pool size of pod {pod_id} set to {size}")
@@ -1,7 +1,10 @@
+from typing import Literal
+
 from fastapi import APIRouter, Depends
-from src.utils.config import cluster, dc
+from src.utils.config import cluster, adc
 from src.internal.auth import verify_setup
 from src.internal.type import Resp
+from src.internal.stats import subscriptions
 import docker.errors
 
 
@@ -25,6 +28,8 @@ async def server_stat(pod_id: str, node_id: str | None = None) -> Resp:
                     "mem_usage": server.get_mem_usage(),
                     "network_in": server.get_network_in(),
                     "network_out": server.get_network_out(),
+                    "network_in_rate": server.get_network_in_rate(),
+                    "network_out_rate": server.get_network_out_rate(),
                 },
             )
 
@@ -35,6 +40,32 @@ async def server_stat(pod_id: str, node_id: str | None = None) -> Resp:
         return Resp(status=False, msg=f"cluster: pod {pod_id} ls failed: {e}")
 
 
+@router.get("/cloud/server/history/", dependencies=[Depends(verify_setup)])
+async def server_history(
+    pod_id: str,
+    node_id: str | None = None,
+    resolution: Literal["raw", "10s", "1m"] = "raw",
+    start: float = 0.0,
+    end: float | None = None,
+) -> Resp:
+    """cloud server history POD_ID [NODE_ID]"""
+    try:
+        pod = cluster.get_pod_by_id(pod_id)
+        data = {}
+        for server in pod.get_server_nodes():
+            if node_id != None and node_id != server.get_node_id():
+                continue
+            data[server.get_node_id()] = server.get_history().query(
+                resolution, start, end if end != None else float("inf")
+            )
+
+        return Resp(status=True, data=data)
+
+    except Exception as e:
+        print(e)
+        return Resp(status=False, msg=f"cluster: pod {pod_id} history failed: {e}")
+
+
 @router.post("/cloud/server/launch/", dependencies=[Depends(verify_setup)])
 async def server_launch(pod_id: str) -> Resp:
     """cloud server launch POD_ID"""
@@ -44,11 +75,11 @@ async def server_launch(pod_id: str) -> Resp:
         ports = []
         for server in servers:
             try:
-                container = dc.containers.get(server.get_node_id())
-                print(container.status)  # type: ignore
-                if container.status == "running":  # type: ignore
+                status = await adc.status(server.get_node_id())
+                print(status)
+                if status == "running":
                     continue
-                container.start()  # type: ignore
+                await adc.start(server.get_node_id())
                 ports.append(
                     dict(
                         node_id=server.get_node_id(),
@@ -60,6 +91,7 @@ async def server_launch(pod_id: str) -> Resp:
                 return Resp(status=False, msg=f"cluster: docker.errors.APIError")
 
             server.set_online()
+            subscriptions.subscribe(server.get_node_id())
             pod.set_cpu_percent_cap(
                 min(cluster.get_cpu_limit(), cluster.get_cpu_available() / len(servers))
             )
@@ -84,11 +116,11 @@ async def server_resume(pod_id: str) -> Resp:
         ports = []
         for server in servers:
             try:
-                container = dc.containers.get(server.get_node_id())
-                print(container.status)  # type: ignore
-                if container.status == "running":  # type: ignore
+                status = await adc.status(server.get_node_id())
+                print(status)
+                if status == "running":
                     continue
-                container.start()  # type: ignore
+                await adc.start(server.get_node_id())
                 ports.append(
                     dict(
                         node_id=server.get_node_id(),
@@ -101,6 +133,7 @@ async def server_resume(pod_id: str) -> Resp:
                 return Resp(status=False, msg=f"cluster: docker.errors.APIError")
 
             server.set_online()
+            subscriptions.subscribe(server.get_node_id())
 
     except Exception as e:
         print(e)
@@ -118,11 +151,11 @@ async def server_pause(pod_id: str) -> Resp:
         ports = []
         for server in servers:
             try:
-                container = dc.containers.get(server.get_node_id())
-                print(container.status)  # type: ignore
-                if container.status == "exited":  # type: ignore
+                status = await adc.status(server.get_node_id())
+                print(status)
+                if status == "exited":
                     continue
-                container.stop(timeout=2)  # type: ignore
+                await adc.stop(server.get_node_id(), timeout=2)
                 ports.append(
                     dict(
                         node_id=server.get_node_id(),
@@ -135,6 +168,7 @@ async def server_pause(pod_id: str) -> Resp:
                 return Resp(status=False, msg=f"cluster: docker.errors.APIError")
 
             server.set_paused()
+            subscriptions.unsubscribe(server.get_node_id())
 
     except Exception as e:
         print(e)
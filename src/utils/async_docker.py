@@ -0,0 +1,148 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterator
+
+import docker
+
+"""
+The one place the cluster talks to Docker from.
+
+docker-py is blocking, and calling it from an async route stalls every other
+request and the load monitor, so every call runs on a bounded thread pool. Each
+kind of operation also has its own concurrency limit, so that for example a
+burst of container creations cannot starve the stats or exec calls.
+
+FakeDocker in src/utils/fake_docker.py has the same interface and keeps
+everything in memory, so the API can be load tested without a daemon.
+"""
+
+KINDS = ("create", "lifecycle", "exec", "archive", "inspect", "stats", "image")
+
+
+class AsyncDocker(object):
+    def __init__(self, client: docker.DockerClient, workers: int, limits: dict):
+        self.__client: docker.DockerClient = client
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="docker"
+        )
+        self.__limits: dict[str, asyncio.Semaphore] = {
+            kind: asyncio.Semaphore(limits[kind]) for kind in KINDS
+        }
+
+    async def __run(self, kind: str, fn: Callable, *args, **kwargs) -> Any:
+        async with self.__limits[kind]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.__executor, partial(fn, *args, **kwargs)
+            )
+
+    # Containers
+
+    async def create(self, image: str, name: str, command: list[str], **kwargs) -> str:
+        """Creates a container and returns its short id, kwargs go to docker-py"""
+        container = await self.__run(
+            "create",
+            self.__client.containers.create,
+            image,
+            command,
+            name=name,
+            detach=True,
+            **kwargs,
+        )
+        return container.id[0:12]
+
+    async def start(self, container_id: str):
+        await self.__run("lifecycle", self.__client.api.start, container_id)
+
+    async def stop(self, container_id: str, timeout: int = 10):
+        await self.__run(
+            "lifecycle", self.__client.api.stop, container_id, timeout=timeout
+        )
+
+    async def restart(self, container_id: str, timeout: int = 10):
+        await self.__run(
+            "lifecycle", self.__client.api.restart, container_id, timeout=timeout
+        )
+
+    async def remove(self, container_id: str):
+        await self.__run(
+            "lifecycle", self.__client.api.remove_container, container_id, force=True
+        )
+
+    async def rename(self, container_id: str, name: str):
+        await self.__run("lifecycle", self.__client.api.rename, container_id, name)
+
+    async def inspect(self, container_id: str) -> dict:
+        return await self.__run(
+            "inspect", self.__client.api.inspect_container, container_id
+        )
+
+    async def status(self, container_id: str) -> str:
+        return (await self.inspect(container_id))["State"]["Status"]
+
+    async def list_containers(
+        self, all: bool = True, filters: dict | None = None
+    ) -> list[dict]:
+        """Returns the raw container summaries of the daemon"""
+        return await self.__run(
+            "inspect", self.__client.api.containers, all=all, filters=filters
+        )
+
+    # Jobs
+
+    async def put_archive(self, container_id: str, path: str, data: bytes):
+        await self.__run(
+            "archive", self.__client.api.put_archive, container_id, path, data
+        )
+
+    async def exec_start(self, container_id: str, cmd: list[str]) -> str:
+        """Starts a detached command in the container, returns the exec id"""
+        return await self.__run("exec", self.__exec_start, container_id, cmd)
+
+    def __exec_start(self, container_id: str, cmd: list[str]) -> str:
+        exec_id = self.__client.api.exec_create(container_id, cmd)["Id"]
+        self.__client.api.exec_start(exec_id, detach=True)
+        return exec_id
+
+    async def exec_run(self, container_id: str, cmd: list[str]) -> tuple[int, bytes]:
+        """Runs a command in the container until it exits, returns its exit code and output"""
+        return await self.__run("exec", self.__exec_run, container_id, cmd)
+
+    def __exec_run(self, container_id: str, cmd: list[str]) -> tuple[int, bytes]:
+        exec_id = self.__client.api.exec_create(container_id, cmd)["Id"]
+        output = self.__client.api.exec_start(exec_id)
+        return self.__client.api.exec_inspect(exec_id)["ExitCode"], output
+
+    async def exec_inspect(self, exec_id: str) -> dict:
+        """Returns the state of an exec, Running and ExitCode tell if and how it ended"""
+        return await self.__run("inspect", self.__client.api.exec_inspect, exec_id)
+
+    # Monitoring
+
+    async def stats(self, container_id: str) -> dict:
+        return await self.__run(
+            "stats", self.__client.api.stats, container_id, stream=False
+        )
+
+    def stats_stream(self, container_id: str) -> Iterator[dict]:
+        """Blocking, meant for a dedicated thread. Yields a sample every second"""
+        return self.__client.api.stats(container_id, stream=True, decode=True)
+
+    # Images and daemon
+
+    async def image_exists(self, tag: str) -> bool:
+        try:
+            await self.__run("image", self.__client.api.inspect_image, tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    async def pull(self, repository: str):
+        await self.__run("image", self.__client.images.pull, repository)
+
+    async def build(self, path: str, tag: str):
+        await self.__run("image", self.__client.images.build, path=path, tag=tag)
+
+    async def info(self) -> dict:
+        return await self.__run("inspect", self.__client.info)
@@ -1,3 +1,6 @@
+from datetime import datetime
+
+
 def calculate_cpu_percent(d, cap) -> float:
     cpu_count = d["cpu_stats"]["online_cpus"]
     cpu_percent = 0.0
@@ -10,3 +13,21 @@ def calculate_cpu_percent(d, cap) -> float:
     if system_delta > 0.0:
         cpu_percent = cpu_delta / system_delta * 100.0 * cpu_count
     return cpu_percent / cap
+
+
+def calculate_read_time(d) -> float:
+    """Returns when a stats sample was taken as a unix timestamp"""
+    return datetime.fromisoformat(d["read"]).timestamp()
+
+
+def calculate_rate(previous: int, current: int, elapsed: float) -> float:
+    """Turns two readings of a cumulative counter into a per second rate"""
+    if current < previous:
+        # the counter started over from 0, the container was restarted
+        return current / elapsed
+    return (current - previous) / elapsed
+
+
+def calculate_job_slots(cpu: float, mem: int, slot_cpu: float, slot_mem: int) -> int:
+    """How many jobs of slot_cpu cpus and slot_mem MB fit in a node, at least 1"""
+    return max(1, min(int(cpu / slot_cpu + 1e-9), int(mem // slot_mem)))
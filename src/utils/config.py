@@ -3,11 +3,91 @@ import docker
 
 
 from src.internal.cluster import Cluster
+from src.utils.async_docker import AsyncDocker
+from src.utils.fake_docker import FakeDocker
 
 cluster: Cluster = Cluster()
-dc = docker.from_env()
 
 with open("config.json", "r") as f:
     config = json.load(f)
     cluster_type = config["cluster_type"]
     address = config["address"]
+    # older config files lack the sections below, so fall back to the defaults
+    monitor = {
+        "interval": 0.5,
+        "concurrency": 8,
+        "backend": "docker",  # or "cgroup"
+        "cgroup_root": "/sys/fs/cgroup",
+        "proc_root": "/proc",
+        **config.get("monitor", {}),
+    }
+    pool = {"size": 2, **config.get("pool", {})}  # warm job containers per pod
+    job = {
+        "audit_scripts": False,  # keep scripts in tmp
+        "abort_timeout": 2,  # seconds between SIGTERM and SIGKILL on abort
+        "reaper_interval": 1,  # seconds between two checks for expired jobs
+        # what one job slot needs, a job node gets as many slots as fit in the
+        # cpu and mem of the cluster type (unless the type sets job_slots)
+        "slot_cpu": 0.1,
+        "slot_mem": 100,
+        # "callback": the launcher curls the cluster with the output and the
+        # exit code. "watch": the cluster follows the exec through the Docker
+        # API, so the containers need no network access to the cluster, and
+        # reads the output of a job once it exited
+        "completion": "callback",
+        "watch_interval": 1,  # seconds between two checks of a watched job
+        **config.get("job", {}),
+    }
+    log = {
+        "compression": "gzip",  # or "zstd" (needs zstandard) or "none"
+        "level": 6,
+        "job_cap": 64 * 1024 * 1024,  # bytes of output kept per job, 0 for no cap
+        "node_cap": 512 * 1024 * 1024,  # bytes on disk per node, 0 for no cap
+        "max_age": 7 * 24 * 3600,  # seconds, 0 to keep logs forever
+        "max_total": 4 * 1024 * 1024 * 1024,  # bytes on disk, 0 for no cap
+        "retention_interval": 60,  # seconds between two retention passes
+        **config.get("log", {}),
+    }
+    history = {
+        "path": "jobs.db",  # SQLite archive of the finished jobs
+        "memory_jobs": 1000,  # finished jobs still kept in memory
+        "sync_interval": 5,  # seconds between two archive passes
+        **config.get("history", {}),
+    }
+    state = {
+        # where the cluster state is kept across restarts: "file", "sqlite" or
+        # "none" to start from scratch every time
+        "backend": "file",
+        "path": "state",  # a directory for "file", a database for "sqlite"
+        "fsync": False,  # a crash of the host can lose the last records
+        "compact_every": 10000,  # records in the log before a snapshot
+        "flush_interval": 0.1,  # seconds, requests flush when they are done
+        **config.get("state", {}),
+    }
+    docker_config = {
+        "backend": "real",  # or "fake" to run without a Docker daemon
+        "workers": 32,
+        "fake_latency": 0.0,
+        "fake_exec_time": 0.0,  # how long a fake job runs for
+        **config.get("docker", {}),
+    }
+    # concurrent calls allowed per kind of operation
+    docker_config["limits"] = {
+        "create": 4,
+        "lifecycle": 8,
+        "exec": 16,
+        "archive": 8,
+        "inspect": 16,
+        "stats": monitor["concurrency"],
+        "image": 1,
+        **docker_config.get("limits", {}),
+    }
+
+# Always go through adc, the raw client is blocking
+if docker_config["backend"] == "fake":
+    adc: AsyncDocker | FakeDocker = FakeDocker(
+        docker_config["fake_latency"], exec_time=docker_config["fake_exec_time"]
+    )
+else:
+    dc = docker.from_env()
+    adc = AsyncDocker(dc, docker_config["workers"], docker_config["limits"])
@@ -0,0 +1,237 @@
+import asyncio
+import io
+import random
+import secrets
+import tarfile
+import time
+from datetime import datetime, timezone
+from typing import Iterator
+
+import docker.errors
+
+"""
+An in-memory stand-in for AsyncDocker, used when docker.backend is "fake".
+
+Containers, images and execs only exist as dicts, every call sleeps for the
+configured latency, and stats are made up. It keeps the state transitions and
+errors of the real daemon (a missing container raises docker.errors.NotFound,
+a taken name raises docker.errors.APIError), so the routers behave the same
+and the whole API can be load tested without Docker.
+"""
+
+
+class FakeDocker(object):
+    def __init__(self, latency: float = 0.0, ncpu: int = 4, exec_time: float = 0.0):
+        self.__latency: float = latency
+        self.__exec_time: float = exec_time  # how long every exec "runs" for
+        self.__ncpu: int = ncpu
+        self.__containers: dict[str, dict] = dict()  # key is the full id
+        self.__images: set[str] = set()
+        self.__execs: dict[str, dict] = dict()  # key is the exec id
+
+    async def __delay(self):
+        await asyncio.sleep(self.__latency)
+
+    def __get(self, container_id: str) -> dict:
+        for full_id, container in self.__containers.items():
+            if full_id.startswith(container_id) or container["name"] == container_id:
+                return container
+        raise docker.errors.NotFound(f"No such container: {container_id}")
+
+    # Containers
+
+    async def create(self, image: str, name: str, command: list[str], **kwargs) -> str:
+        await self.__delay()
+        if image not in self.__images:
+            raise docker.errors.ImageNotFound(f"No such image: {image}")
+        if any(c["name"] == name for c in self.__containers.values()):
+            raise docker.errors.APIError(f"Conflict. The name {name} is already in use")
+        full_id = secrets.token_hex(32)
+        self.__containers[full_id] = {
+            "id": full_id,
+            "name": name,
+            "image": image,
+            "command": command,
+            "labels": kwargs.get("labels", {}),
+            "status": "created",
+            "files": dict(),
+            "cpu_usage": 0,
+            "rx_bytes": 0,
+            "tx_bytes": 0,
+        }
+        return full_id[0:12]
+
+    async def start(self, container_id: str):
+        await self.__delay()
+        self.__get(container_id)["status"] = "running"
+
+    async def stop(self, container_id: str, timeout: int = 10):
+        await self.__delay()
+        self.__get(container_id)["status"] = "exited"
+
+    async def restart(self, container_id: str, timeout: int = 10):
+        await self.__delay()
+        container = self.__get(container_id)
+        container["status"] = "running"
+        container["cpu_usage"] = container["rx_bytes"] = container["tx_bytes"] = 0
+
+    async def remove(self, container_id: str):
+        await self.__delay()
+        self.__containers.pop(self.__get(container_id)["id"])
+
+    async def rename(self, container_id: str, name: str):
+        await self.__delay()
+        if any(c["name"] == name for c in self.__containers.values()):
+            raise docker.errors.APIError(f"Conflict. The name {name} is already in use")
+        self.__get(container_id)["name"] = name
+
+    async def inspect(self, container_id: str) -> dict:
+        await self.__delay()
+        container = self.__get(container_id)
+        return {
+            "Id": container["id"],
+            "Name": "/" + container["name"],
+            "State": {
+                "Status": container["status"],
+                "Running": container["status"] == "running",
+                "Pid": 0,
+            },
+            "Config": {"Image": container["image"], "Labels": container["labels"]},
+        }
+
+    async def status(self, container_id: str) -> str:
+        return (await self.inspect(container_id))["State"]["Status"]
+
+    async def list_containers(
+        self, all: bool = True, filters: dict | None = None
+    ) -> list[dict]:
+        await self.__delay()
+        labels = (filters or {}).get("label", [])
+        labels = [labels] if isinstance(labels, str) else labels
+        rtn = []
+        for container in self.__containers.values():
+            if not all and container["status"] != "running":
+                continue
+            if any(
+                container["labels"].get(key) != value
+                for key, _, value in (label.partition("=") for label in labels)
+            ):
+                continue
+            rtn.append(
+                {
+                    "Id": container["id"],
+                    "Names": ["/" + container["name"]],
+                    "Image": container["image"],
+                    "Labels": container["labels"],
+                    "State": container["status"],
+                }
+            )
+        return rtn
+
+    # Jobs
+
+    async def put_archive(self, container_id: str, path: str, data: bytes):
+        await self.__delay()
+        container = self.__get(container_id)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                f = tar.extractfile(member)
+                if f != None:
+                    container["files"][path.rstrip("/") + "/" + member.name] = f.read()
+
+    async def exec_start(self, container_id: str, cmd: list[str]) -> str:
+        await self.__delay()
+        container = self.__get(container_id)
+        if container["status"] != "running":
+            raise docker.errors.APIError(f"Container {container_id} is not running")
+        exec_id = secrets.token_hex(32)
+        ends_at = time.time() + self.__exec_time
+        if cmd[0] == "setsid" and "--wait" not in cmd:
+            # like runc, every exec is a session leader, so setsid forks the
+            # command into the background and the exec ends at once
+            ends_at = time.time()
+        self.__execs[exec_id] = {
+            "container": container["id"],
+            "cmd": cmd,
+            "ends_at": ends_at,
+            "exit_code": 0,
+        }
+        return exec_id
+
+    async def exec_run(self, container_id: str, cmd: list[str]) -> tuple[int, bytes]:
+        exec_id = await self.exec_start(container_id, cmd)
+        self.__execs[exec_id]["ends_at"] = time.time()
+        return 0, b""
+
+    async def exec_inspect(self, exec_id: str) -> dict:
+        await self.__delay()
+        try:
+            execution = self.__execs[exec_id]
+        except KeyError:
+            raise docker.errors.NotFound(f"No such exec instance: {exec_id}")
+        running = time.time() < execution["ends_at"]
+        return {
+            "ID": exec_id,
+            "ContainerID": execution["container"],
+            "Running": running,
+            "ExitCode": None if running else execution["exit_code"],
+            "Pid": 0,
+        }
+
+    # Monitoring
+
+    def __sample(self, container: dict) -> dict:
+        # a random load of up to one cpu since the previous sample
+        now = time.time_ns()
+        precpu_stats = {
+            "cpu_usage": {"total_usage": container["cpu_usage"]},
+            "system_cpu_usage": now - 1000000000 * self.__ncpu,
+            "online_cpus": self.__ncpu,
+        }
+        container["cpu_usage"] += random.randint(0, 1000000000)
+        container["rx_bytes"] += random.randint(0, 100000)
+        container["tx_bytes"] += random.randint(0, 100000)
+        return {
+            "read": datetime.now(timezone.utc).isoformat(),
+            "cpu_stats": {
+                "cpu_usage": {"total_usage": container["cpu_usage"]},
+                "system_cpu_usage": now,
+                "online_cpus": self.__ncpu,
+            },
+            "precpu_stats": precpu_stats,
+            "memory_stats": {"usage": random.randint(10, 100) * 1024 * 1024},
+            "networks": {
+                "eth0": {
+                    "rx_bytes": container["rx_bytes"],
+                    "tx_bytes": container["tx_bytes"],
+                }
+            },
+        }
+
+    async def stats(self, container_id: str) -> dict:
+        await self.__delay()
+        return self.__sample(self.__get(container_id))
+
+    def stats_stream(self, container_id: str) -> Iterator[dict]:
+        container = self.__get(container_id)
+        while container["id"] in self.__containers and container["status"] == "running":
+            yield self.__sample(container)
+            time.sleep(1)
+
+    # Images and daemon
+
+    async def image_exists(self, tag: str) -> bool:
+        await self.__delay()
+        return tag in self.__images
+
+    async def pull(self, repository: str):
+        await self.__delay()
+        self.__images.add(repository)
+
+    async def build(self, path: str, tag: str):
+        await self.__delay()
+        self.__images.add(tag)
+
+    async def info(self) -> dict:
+        await self.__delay()
+        return {"NCPU": self.__ncpu}
@@ -0,0 +1,53 @@
+import hashlib
+import os
+from functools import cache
+
+from src.utils.config import adc
+
+JOB_RUNNER_PATH = "runner"
+JOB_RUNNER_REPOSITORY = "aob-job-runner"
+EXPRESS_PATH = "example/express"
+EXPRESS_REPOSITORY = "aob-example-express"
+
+
+def context_hash(path: str) -> str:
+    """Hashes every file of a build context, so any change gives a new hash"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+async def pull_cached(repository: str):
+    """Pulls the image unless it is already there, a present tag is not refreshed"""
+    if await adc.image_exists(repository):
+        print(f"Image {repository} is present, skipping the pull")
+    else:
+        print(f"Pulling image {repository}")
+        await adc.pull(repository)
+
+
+async def build_cached(path: str, repository: str) -> str:
+    """Builds the image unless one with the same context hash already exists"""
+    tag = f"{repository}:{context_hash(path)[:12]}"
+    if await adc.image_exists(tag):
+        print(f"Image {tag} is up to date, skipping the build")
+    else:
+        print(f"Building image {tag}")
+        await adc.build(path, tag)
+    return tag
+
+
+@cache
+def job_runner_image() -> str:
+    return f"{JOB_RUNNER_REPOSITORY}:{context_hash(JOB_RUNNER_PATH)[:12]}"
+
+
+@cache
+def express_image() -> str:
+    return f"{EXPRESS_REPOSITORY}:{context_hash(EXPRESS_PATH)[:12]}"
@@ -0,0 +1,45 @@
+from src.internal.cluster import Pod
+from src.utils.config import adc, address, cluster
+
+"""
+Every container the cluster creates carries these labels. Other clusters may
+share the Docker host, so the cluster only ever lists, adopts or removes the
+containers labelled with its own address, and can rebuild its pods and nodes
+from them in one listing call.
+
+Labels cannot change after a container is created, so a warm container that
+becomes a job node keeps NODE_TYPE "warm" and no NODE_NAME, its name
+({pod_id}_{node_name}, see src/internal/pool.py) tells which node it is.
+"""
+
+CLUSTER = "aob.cluster"  # the address of the cluster that owns the container
+CLUSTER_TYPE = "aob.cluster_type"
+POD_ID = "aob.pod_id"
+POD_NAME = "aob.pod_name"
+NODE_NAME = "aob.node_name"
+NODE_TYPE = "aob.node_type"  # "job", "server" or "warm"
+PORT = "aob.port"
+
+
+def container_labels(
+    pod: Pod, node_type: str, node_name: str | None = None, port: int | None = None
+) -> dict[str, str]:
+    labels = {
+        CLUSTER: address["cluster"],
+        CLUSTER_TYPE: cluster.get_type(),
+        POD_ID: pod.get_pod_id(),
+        POD_NAME: pod.get_pod_name(),
+        NODE_TYPE: node_type,
+    }
+    if node_name != None:
+        labels[NODE_NAME] = node_name
+    if port != None:
+        labels[PORT] = str(port)
+    return labels
+
+
+async def list_cluster_containers() -> list[dict]:
+    """Returns the summaries of the containers of this cluster, stopped ones too"""
+    return await adc.list_containers(
+        all=True, filters={"label": f"{CLUSTER}={address['cluster']}"}
+    )
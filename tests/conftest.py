@@ -0,0 +1,81 @@
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+from unittest import mock
+
+import pytest
+
+"""
+The cluster reads config.json from the working directory when src is first
+imported, so the tests run from a scratch directory holding the dev config on
+the fake Docker backend. Jobs "run" for fake_exec_time seconds, which is long
+enough for a test to see them running.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_EXEC_TIME = 2.0
+
+with open(os.path.join(ROOT, "dev-config.json"), "r") as f:
+    config = json.load(f)
+config["docker"]["backend"] = "fake"
+config["docker"]["fake_exec_time"] = FAKE_EXEC_TIME
+config["pool"]["size"] = 0
+
+os.chdir(tempfile.mkdtemp(prefix="cluster-tests-"))
+with open("config.json", "w") as f:
+    json.dump(config, f)
+sys.path.insert(0, ROOT)
+
+
+def reset():
+    """Forgets the cluster, its containers and everything it stored"""
+    from src.internal.archive import archive
+    from src.internal.logstore import logs
+    from src.internal.state import clear_state
+    from src.utils.config import adc
+
+    restart()
+    adc.__init__(exec_time=FAKE_EXEC_TIME)
+    asyncio.run(clear_state())
+    archive.clear()
+    logs.clear()
+
+
+def restart():
+    """Drops what the cluster keeps in memory, as a restart of the process does"""
+    from src.internal import state
+    from src.internal.cluster import journal
+    from src.internal.pool import warm_pool
+    from src.utils.config import cluster, state as state_config
+
+    journal.set_sink(None)
+    cluster.reset()
+    warm_pool.__init__(config["pool"]["size"])
+    state.state_log = state.StateLog(
+        state.BACKENDS[state_config["backend"]](
+            state_config["path"], state_config["fsync"]
+        ),
+        state_config["compact_every"],
+    )
+
+
+@contextlib.contextmanager
+def serve():
+    """Runs the app, the callbacks to the manager go nowhere"""
+    from fastapi.testclient import TestClient
+    from src.main import app
+
+    with mock.patch("httpx.AsyncClient.post", new=mock.AsyncMock()):
+        with TestClient(app) as client:
+            yield client
+
+
+@pytest.fixture
+def client():
+    """A client of a fresh cluster"""
+    reset()
+    with serve() as client:
+        yield client
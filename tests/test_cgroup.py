@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from src.internal.cgroup import CgroupCollector
+from src.utils.calculate import calculate_cpu_percent
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0       0          0
+  eth0:  {rx}      10    0    0    0     0          0         0  {tx}      12    0    0    0     0       0          0
+"""
+
+
+def write(path: str, data: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def write_proc(proc: str, pid: int, cgroup: str, ticks: int, rx: int, tx: int):
+    write(os.path.join(proc, str(pid), "cgroup"), cgroup)
+    write(os.path.join(proc, str(pid), "net", "dev"), NET_DEV.format(rx=rx, tx=tx))
+    # user, nice, system, idle, iowait, irq, softirq and steal, then guest ones
+    write(
+        os.path.join(proc, "stat"),
+        f"cpu  {ticks} 0 0 0 0 0 0 0 0 0\n"
+        f"cpu0 {ticks // 2} 0 0 0 0 0 0 0 0 0\n"
+        f"cpu1 {ticks // 2} 0 0 0 0 0 0 0 0 0\n"
+        "intr 0\n",
+    )
+
+
+class V1(object):
+    cgroup = (
+        "12:memory:/docker/abc\n"
+        "4:cpu,cpuacct:/docker/abc\n"
+        "1:name=systemd:/docker/abc\n"
+        "0::/system.slice/docker.service\n"
+    )
+
+    @staticmethod
+    def write_usage(root: str, cpu_ns: int, mem: int):
+        write(
+            os.path.join(root, "cpu,cpuacct", "docker", "abc", "cpuacct.usage"),
+            str(cpu_ns),
+        )
+        write(
+            os.path.join(root, "memory", "docker", "abc", "memory.usage_in_bytes"),
+            str(mem),
+        )
+
+
+class V2(object):
+    cgroup = "0::/system.slice/docker-abc.scope\n"
+
+    @staticmethod
+    def write_usage(root: str, cpu_ns: int, mem: int):
+        cgroup = os.path.join(root, "system.slice", "docker-abc.scope")
+        write(
+            os.path.join(cgroup, "cpu.stat"),
+            f"usage_usec {cpu_ns // 1000}\nuser_usec 0\nsystem_usec 0\n",
+        )
+        write(os.path.join(cgroup, "memory.current"), str(mem))
+
+
+@pytest.mark.parametrize("version", [V1, V2])
+def test_collect(tmp_path, version):
+    root = str(tmp_path / "cgroup")
+    proc = str(tmp_path / "proc")
+    hz = os.sysconf("SC_CLK_TCK")
+    collector = CgroupCollector(root, proc)
+
+    version.write_usage(root, 1000000000, 50 * 1024 * 1024)
+    write_proc(proc, 42, version.cgroup, 10 * hz, 1000, 2000)
+    collector.track("node", 42)
+    assert collector.collect(["node"]) == {}  # nothing to compare it to yet
+
+    # 0.5 s of cpu over 2 s of host time on 2 cpus
+    version.write_usage(root, 1500000000, 60 * 1024 * 1024)
+    write_proc(proc, 42, version.cgroup, 12 * hz, 5000, 8000)
+    sample = collector.collect(["node"])["node"]
+
+    assert sample["cpu_stats"]["cpu_usage"]["total_usage"] == 1500000000
+    assert sample["precpu_stats"]["cpu_usage"]["total_usage"] == 1000000000
+    assert sample["cpu_stats"]["system_cpu_usage"] == 12 * 1000000000
+    assert sample["cpu_stats"]["online_cpus"] == 2
+    assert calculate_cpu_percent(sample, 1) == pytest.approx(50.0)
+    assert sample["memory_stats"]["usage"] == 60 * 1024 * 1024
+    assert sample["networks"]["eth0"] == {"rx_bytes": 5000, "tx_bytes": 8000}
+
+
+def test_forgets_containers_that_are_gone(tmp_path):
+    root = str(tmp_path / "cgroup")
+    proc = str(tmp_path / "proc")
+    collector = CgroupCollector(root, proc)
+    V2.write_usage(root, 1000000000, 1024)
+    write_proc(proc, 42, V2.cgroup, 100, 0, 0)
+    collector.track("node", 42)
+    collector.collect(["node"])
+
+    os.remove(os.path.join(root, "system.slice", "docker-abc.scope", "cpu.stat"))
+    assert collector.collect(["node"]) == {}
+    with pytest.raises(Exception):
+        collector.resolve("node")
+
+
+def test_no_cgroup(tmp_path):
+    proc = str(tmp_path / "proc")
+    write_proc(proc, 42, "1:name=systemd:/docker/abc\n", 100, 0, 0)
+    with pytest.raises(Exception):
+        CgroupCollector(str(tmp_path / "cgroup"), proc).track("node", 42)
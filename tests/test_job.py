@@ -0,0 +1,245 @@
+import asyncio
+import threading
+import time
+
+import docker.errors
+
+from conftest import FAKE_EXEC_TIME
+from src.internal.logstore import logs
+from src.routers import job as job_router
+from src.utils.config import adc, cluster, job as job_config
+
+
+def call(client, method: str, url: str, **kwargs) -> dict:
+    resp = getattr(client, method)(url, **kwargs).json()
+    assert resp["status"], resp["msg"]
+    return resp
+
+
+def setup_job_node(client) -> str:
+    """Initializes the cluster with one job node, returns its id"""
+    call(client, "post", "/cloud/", params={"type": "heavy"})
+    pod_id = call(client, "post", "/cloud/pod/", params={"pod_name": "p"})["data"]
+    return call(
+        client,
+        "post",
+        "/cloud/node/",
+        params={"node_name": "n", "node_type": "job", "pod_id": pod_id},
+    )["data"]
+
+
+def launch(client, job_id: str) -> dict:
+    return call(
+        client,
+        "post",
+        "/cloud/job/",
+        params={"job_name": "job", "job_id": job_id},
+        files={"job_script": ("job.sh", b"echo hello")},
+    )
+
+
+def get_jobs(client) -> dict[str, dict]:
+    jobs = call(client, "get", "/cloud/job/")["data"]["jobs"]
+    return {job["job_id"]: job for job in jobs}
+
+
+def test_watched_job_runs_until_its_exec_exits(client, monkeypatch):
+    monkeypatch.setitem(job_config, "completion", "watch")
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    setup_job_node(client)
+    launch(client, "j")
+    reads = []
+    exec_run = adc.exec_run
+
+    async def record(container_id: str, cmd: list[str]) -> tuple[int, bytes]:
+        reads.append(cmd)
+        return await exec_run(container_id, cmd)
+
+    monkeypatch.setattr(adc, "exec_run", record)
+    time.sleep(3 * job_config["watch_interval"])
+    assert cluster.has_running_job("j")
+    assert get_jobs(client)["j"]["job_status"] == "running"
+    assert reads == []  # the output is only read once the job exited
+
+    time.sleep(FAKE_EXEC_TIME)
+    job = get_jobs(client)["j"]
+    assert job["job_status"] == "completed"
+    assert job["exit_code"] == 0
+
+
+def test_watched_job_whose_exec_is_lost_fails(client, monkeypatch):
+    monkeypatch.setitem(job_config, "completion", "watch")
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    node_id = setup_job_node(client)
+    launch(client, "j")
+
+    async def exec_inspect(exec_id: str) -> dict:
+        raise docker.errors.NotFound(f"No such exec instance: {exec_id}")
+
+    monkeypatch.setattr(adc, "exec_inspect", exec_inspect)
+    time.sleep(3 * job_config["watch_interval"])
+    assert get_jobs(client)["j"]["job_status"] == "failed"
+    call(client, "delete", "/cloud/node/", params={"node_id": node_id})
+
+
+def test_callback_fails_jobs_that_exit_with_an_error(client):
+    node_id = setup_job_node(client)
+    launch(client, "ok")
+    launch(client, "ko")
+
+    for job_id, exit_code in [("ok", 0), ("ko", 3)]:
+        call(
+            client,
+            "post",
+            "/internal/callback",
+            params={"job_id": job_id, "node_id": node_id, "exit_code": exit_code},
+            json={},
+        )
+    jobs = get_jobs(client)
+    assert (jobs["ok"]["job_status"], jobs["ok"]["exit_code"]) == ("completed", 0)
+    assert (jobs["ko"]["job_status"], jobs["ko"]["exit_code"]) == ("failed", 3)
+
+
+def test_jobs_that_fail_to_launch_stay_listed(client, monkeypatch):
+    setup_job_node(client)
+
+    async def exec_start(container_id: str, cmd: list[str]) -> str:
+        raise Exception("the daemon is gone")
+
+    monkeypatch.setattr(adc, "exec_start", exec_start)
+    resp = client.post("/cloud/job/batch/", json={"script": "echo", "job_ids": ["j"]})
+    assert resp.json()["data"]["rejected"][0]["job_id"] == "j"
+    assert get_jobs(client)["j"]["job_status"] == "failed"
+
+
+def test_job_files_are_removed_from_the_container(client, monkeypatch):
+    monkeypatch.setitem(job_config, "completion", "watch")
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    node_id = setup_job_node(client)
+    removed = []
+    exec_run = adc.exec_run
+
+    async def record(container_id: str, cmd: list[str]) -> tuple[int, bytes]:
+        if cmd[0] == "rm":
+            removed.extend(cmd[2:])
+        return await exec_run(container_id, cmd)
+
+    monkeypatch.setattr(adc, "exec_run", record)
+    launch(client, "done")
+    launch(client, "aborted")
+    call(client, "delete", "/cloud/job/", params={"job_id": "aborted"})
+    time.sleep(FAKE_EXEC_TIME + 3 * job_config["watch_interval"])
+
+    assert get_jobs(client)["done"]["job_status"] == "completed"
+    for job_id in ["done", "aborted"]:
+        path = f"tmp/{node_id}/{job_id}"
+        assert {f"{path}.out", f"{path}.out.chunk", f"{path}.pid"} <= set(removed)
+
+
+def test_log_chunks_are_stored_on_the_log_thread(client, monkeypatch):
+    node_id = setup_job_node(client)
+    launch(client, "j")
+    threads = []
+    append = logs.append
+
+    def record(*args):
+        threads.append(threading.current_thread().name)
+        return append(*args)
+
+    monkeypatch.setattr(logs, "append", record)
+    call(
+        client,
+        "post",
+        "/internal/log",
+        params={"job_id": "j", "node_id": node_id, "offset": 0},
+        content=b"hello",
+    )
+    assert threads[0].startswith("job-logs")
+    assert client.get("/cloud/job/log/", params={"job_id": "j"}).text == "hello"
+
+
+def test_jobs_sharing_a_node_upload_their_files_once(client, monkeypatch):
+    setup_job_node(client)  # a heavy node has 5 slots
+    uploads = []
+    put_archive = adc.put_archive
+
+    async def record(container_id: str, path: str, data: bytes):
+        uploads.append(container_id)
+        await put_archive(container_id, path, data)
+
+    monkeypatch.setattr(adc, "put_archive", record)
+    job_ids = [f"j{i}" for i in range(5)]
+    resp = call(
+        client, "post", "/cloud/job/batch/", json={"script": "echo", "job_ids": job_ids}
+    )
+    assert len(resp["data"]["launched"]) == 5
+    assert len(uploads) == 1
+
+
+def test_abort_frees_the_slot_when_the_container_cannot_be_replaced(
+    client, monkeypatch
+):
+    node_id = setup_job_node(client)
+    launch(client, "j")
+
+    async def kill_job(node, job) -> bool:
+        return False
+
+    async def restart(container_id: str, timeout: int = 10):
+        raise Exception("the daemon is gone")
+
+    monkeypatch.setattr(job_router, "kill_job", kill_job)
+    monkeypatch.setattr(adc, "restart", restart)
+    call(client, "delete", "/cloud/job/", params={"job_id": "j"})
+    assert get_jobs(client)["j"]["job_status"] == "aborted"
+    call(client, "delete", "/cloud/node/", params={"node_id": node_id})
+
+
+def test_a_job_that_cannot_be_killed_keeps_its_slot(client, monkeypatch):
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    node_id = setup_job_node(client)
+    node = cluster.get_node_by_id(node_id)
+    launch(client, "stuck")
+    launch(client, "other")
+
+    async def kill_job(node, job) -> bool:
+        return job.get_job_id() != "stuck"
+
+    monkeypatch.setattr(job_router, "kill_job", kill_job)
+    call(client, "delete", "/cloud/job/", params={"job_id": "stuck"})
+    assert get_jobs(client)["stuck"]["job_status"] == "aborted"
+    assert len(node.get_running_jobs()) == 2
+
+    # its launcher calls back once it is over, after its exec exits
+    time.sleep(FAKE_EXEC_TIME + 3 * job_config["watch_interval"])
+    assert len(node.get_running_jobs()) == 1
+    call(
+        client,
+        "post",
+        "/internal/callback",
+        params={"job_id": "stuck", "node_id": node_id, "exit_code": 0},
+        json={},
+    )
+    assert get_jobs(client)["stuck"]["job_status"] == "aborted"
+
+
+def test_jobs_being_aborted_stay_listed(client, monkeypatch):
+    setup_job_node(client)
+    launch(client, "j")
+
+    async def kill_job(node, job) -> bool:
+        await asyncio.sleep(0.5)  # waiting for the abort timeout
+        return True
+
+    monkeypatch.setattr(job_router, "kill_job", kill_job)
+    abort = threading.Thread(
+        target=call,
+        args=(client, "delete", "/cloud/job/"),
+        kwargs={"params": {"job_id": "j"}},
+    )
+    abort.start()
+    time.sleep(0.2)
+    assert not cluster.has_running_job("j")
+    assert get_jobs(client)["j"]["job_status"] == "running"
+    abort.join()
+    assert get_jobs(client)["j"]["job_status"] == "aborted"
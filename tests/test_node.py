@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import docker.errors
+
+from conftest import reset, restart, serve
+from test_job import call
+from src.internal.pool import warm_pool
+from src.internal.type import Resp
+from src.routers.node import node_register
+from src.utils.config import adc, cluster
+
+
+def setup_pod(client, type: str = "heavy") -> str:
+    call(client, "post", "/cloud/", params={"type": type})
+    return call(client, "post", "/cloud/pod/", params={"pod_name": "p"})["data"]
+
+
+def register(client, pod_id: str, node_name: str, node_type: str = "job") -> dict:
+    return client.post(
+        "/cloud/node/",
+        params={"node_name": node_name, "node_type": node_type, "pod_id": pod_id},
+    ).json()
+
+
+def wait_warm(pod_id: str, warm: int):
+    for _ in range(100):
+        if warm_pool.get_warm(pod_id) == warm:
+            return
+        time.sleep(0.01)
+    assert warm_pool.get_warm(pod_id) == warm
+
+
+def test_failed_rename_puts_the_warm_container_back(client, monkeypatch):
+    pod_id = setup_pod(client)
+    call(client, "post", "/cloud/pod/pool/", params={"pod_id": pod_id, "size": 1})
+    wait_warm(pod_id, 1)
+
+    async def rename(container_id: str, name: str):
+        raise docker.errors.APIError("the daemon is gone")
+
+    monkeypatch.setattr(adc, "rename", rename)
+    assert not register(client, pod_id, "n")["status"]
+    assert warm_pool.get_warm(pod_id) == 1
+
+
+def test_restart_does_not_warm_server_only_pods():
+    reset()
+    with serve() as client:
+        pod_id = setup_pod(client)
+        call(
+            client,
+            "post",
+            "/cloud/node/",
+            params={"node_name": "s", "node_type": "server", "pod_id": pod_id},
+        )
+
+    restart()
+    warm_pool.__init__(2)
+    with serve() as client:
+        time.sleep(0.1)
+        assert warm_pool.get_warm(pod_id) == 0
+
+
+def test_concurrent_registrations_keep_to_the_node_limit(client):
+    pod_id = setup_pod(client)  # heavy pods take 10 nodes
+
+    async def register_all(names: list[str]) -> list[Resp]:
+        return await asyncio.gather(
+            *[node_register(name, "server", pod_id) for name in names]
+        )
+
+    results = asyncio.run(register_all([f"s{i}" for i in range(15)]))
+    assert sum(r.status for r in results) == 10
+    assert len(cluster.get_pod_by_id(pod_id).get_nodes()) == 10
+
+    call(client, "delete", "/cloud/node/", params={"node_id": results[0].data})
+    results = asyncio.run(register_all(["twin", "twin"]))
+    assert [r.status for r in results] == [True, False]
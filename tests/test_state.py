@@ -0,0 +1,100 @@
+import threading
+import time
+
+from conftest import FAKE_EXEC_TIME, reset, restart, serve
+from test_job import call, get_jobs, launch, setup_job_node
+from src.internal import state
+from src.utils.config import cluster, job as job_config
+
+
+def setup_queue(client):
+    """One job running on a light node, which has a single slot, and two queued"""
+    call(client, "post", "/cloud/", params={"type": "light"})
+    pod_id = call(client, "post", "/cloud/pod/", params={"pod_name": "p"})["data"]
+    call(
+        client,
+        "post",
+        "/cloud/node/",
+        params={"node_name": "n", "node_type": "job", "pod_id": pod_id},
+    )
+    for job_id in ["j0", "j1", "j2"]:
+        launch(client, job_id)
+    assert cluster.get_job_slots() == 1
+
+
+def test_restart_restores_running_queued_and_cancelled_jobs(monkeypatch):
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    reset()
+    with serve() as client:
+        setup_queue(client)
+        call(client, "delete", "/cloud/job/queue/", params={"job_id": "j2"})
+        before = get_jobs(client)
+    assert [before[j]["job_status"] for j in ["j0", "j1", "j2"]] == [
+        "running",
+        "registered",
+        "aborted",
+    ]
+
+    restart()
+    with serve() as client:
+        assert get_jobs(client) == before
+        # j0 is still running and calls back when it is over
+        time.sleep(3 * job_config["watch_interval"])
+        assert get_jobs(client)["j0"]["job_status"] == "running"
+
+
+def test_restart_completes_jobs_that_exited_meanwhile(monkeypatch):
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    reset()
+    with serve() as client:
+        setup_queue(client)
+
+    restart()
+    time.sleep(FAKE_EXEC_TIME)  # j0 exits while the cluster is down
+    with serve() as client:
+        time.sleep(3 * job_config["watch_interval"])
+        jobs = get_jobs(client)
+        assert (jobs["j0"]["job_status"], jobs["j0"]["exit_code"]) == ("completed", 0)
+        assert jobs["j1"]["job_status"] == "running"  # it got the freed slot
+
+
+def test_reset(client):
+    setup_job_node(client)
+    launch(client, "j")
+    call(client, "delete", "/cloud/")
+    assert not cluster.is_initialized()
+
+    restart()
+    with serve() as client:
+        assert not cluster.is_initialized()
+        call(client, "post", "/cloud/", params={"type": "heavy"})
+        assert cluster.get_pods() == []
+        assert get_jobs(client) == {}
+
+
+def test_queued_jobs_share_one_script_record(monkeypatch):
+    appended = []
+    append = state.FileBackend.append
+
+    def record_append(self, records: list[dict]):
+        appended.extend((threading.current_thread().name, r) for r in records)
+        append(self, records)
+
+    monkeypatch.setattr(state.FileBackend, "append", record_append)
+    monkeypatch.setitem(job_config, "completion", "watch")
+    monkeypatch.setitem(job_config, "watch_interval", 0.1)
+    reset()
+    with serve() as client:
+        setup_queue(client)
+    assert all(name.startswith("cluster-state") for name, _ in appended)
+    scripts = [r for _, r in appended if r["kind"] == "script" and r["state"] != None]
+    assert len(scripts) == 1  # j1 and j2 wait with the same script
+
+    restart()
+    with serve() as client:
+        call(client, "delete", "/cloud/job/queue/", params={"job_id": "j2"})
+        assert get_jobs(client)["j1"]["job_status"] == "registered"
+        assert len(cluster.get_pending_scripts()) == 1
+        time.sleep(FAKE_EXEC_TIME + 3 * job_config["watch_interval"])
+        assert get_jobs(client)["j1"]["job_status"] == "running"
+        assert cluster.get_pending_scripts() == {}